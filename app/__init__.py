@@ -3,7 +3,7 @@ from config import config_options
 from app.database import Database
 import os
 from config import Config
-from app.models import db
+from app.models import db, is_database_schema_stale
 
 def create_app():
     """
@@ -27,8 +27,10 @@ def create_app():
     db.init_app(app)
 
     with app.app_context():
-        db.drop_all()
-        print('DB dropped from __init__.py')
+        # A database created by an older version of the app is rebuilt, and the activities have to be imported again.
+        if Config.RESET_DATABASE_ON_START or is_database_schema_stale():
+            db.drop_all()
+            print('DB dropped from __init__.py')
         db.create_all()
         print('DB created from __init__.py')
 
@@ -36,6 +38,9 @@ def create_app():
         from .routes import main  # import main from the routes file
         app.register_blueprint(main)  # register main in app
 
+    from .cli import strava_cli  # import the flask strava commands from the cli file
+    app.cli.add_command(strava_cli)
+
     print(f'app.config["SQLALCHEMY_DATABASE_URI"] is: {app.config["SQLALCHEMY_DATABASE_URI"]}')
 
     os.makedirs(Config.UPLOAD_FOLDER_STRAVA, exist_ok=True)  # Ensure the upload activities directory exists in the same
@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+
+from config import Config
+
+# Values that are calculated from the whole activity table and only change when activities are imported. The cache is
+# cleared by Database.create_db_tables() after the import is committed. The totals and charts are cached for every set
+# of filters, so the cache keeps only the Config.CACHE_MAX_ENTRIES most recently used values.
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def cached(key, calculate):
+    """
+    Get a value from the app level cache, calculating and saving it first if it is not cached. When the cache is full,
+    the least recently used value is removed.
+    :param key: (str) The name of the cached value.
+    :param calculate: (function) The function that calculates the value, called without arguments.
+    :return: The cached value.
+    """
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    value = calculate()
+
+    with _cache_lock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > Config.CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+    return value
+
+
+def clear_cache():
+    """
+    Remove every value from the app level cache.
+    :return: None
+    """
+    with _cache_lock:
+        _cache.clear()
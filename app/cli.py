@@ -0,0 +1,95 @@
+import time
+
+import click
+from flask.cli import AppGroup
+
+from app.routes import convert_activity_csv_to_db, import_new_activity_files
+from app.timing import record_stages
+from app.watcher import get_watched_folders, watch_activity_folders
+from config import Config
+
+# The flask strava commands, registered on the app in create_app().
+strava_cli = AppGroup('strava', help='Manage the Strava and Garmin activity data.')
+
+
+def echo_stage_timings(stage_timings):
+    """
+    Print the time of every stage of an import, one stage per line.
+    :param stage_timings: (dict) The milliseconds of each stage, from record_stages().
+    :return: None
+    """
+    for stage, milliseconds in stage_timings.items():
+        click.echo(f'{stage:>12} {milliseconds / 1000:8.2f} s')
+
+
+@strava_cli.command('import')
+@click.option('--workers', type=click.IntRange(min=1), default=None,
+              help='The number of processes that read the activity files. Every CPU is used by default.')
+@click.option('--incremental', is_flag=True,
+              help='Only add the activities that are not in the database yet, instead of rebuilding every table.')
+@click.option('--only', type=click.Choice(['strava', 'garmin']), default=None,
+              help='Import only the activities of the Strava or the Garmin export.')
+@click.option('--warm-stream-cache', is_flag=True,
+              help='Decompress and extract the activity files, so the activity pages can read them right away.')
+def import_activities(workers, incremental, only, warm_stream_cache):
+    """
+    Import the Strava and Garmin exports in the uploads folder, the same way the /create-db route does, without
+    starting the web server. The progress of reading the activity files and the time of every stage are printed.
+    :param workers: (int) The number of processes that read the activity files, or None to use every CPU.
+    :param incremental: (bool) Only add the activities that are not in the database yet.
+    :param only: (str) 'strava' or 'garmin' to import only one export, or None to import both.
+    :param warm_stream_cache: (bool) Decompress and extract the activity files after the import.
+    :return: None
+    """
+    if workers is not None:
+        Config.STREAM_PROCESS_WORKERS = workers
+
+    progress_bar = None
+
+    def show_progress(activity_count, read_count):
+        nonlocal progress_bar
+        if progress_bar is None:
+            progress_bar = click.progressbar(length=activity_count, label='Reading activity files')
+            progress_bar.__enter__()
+        progress_bar.update(read_count - progress_bar.pos)
+
+    start = time.perf_counter()
+    try:
+        with record_stages() as stage_timings:
+            activity_count = convert_activity_csv_to_db(
+                only=only,
+                incremental=incremental,
+                warm_file_cache=warm_stream_cache,
+                progress=show_progress
+            )
+    finally:
+        if progress_bar is not None:
+            progress_bar.__exit__(None, None, None)
+
+    click.echo(f'\n{activity_count} activities imported in {time.perf_counter() - start:.1f} s.')
+    echo_stage_timings(stage_timings)
+
+
+@strava_cli.command('watch')
+@click.option('--poll', is_flag=True, help='Check the folders on a timer instead of using inotify.')
+def watch(poll):
+    """
+    Watch the Strava activities folder and the Garmin uploaded files folder, and import new activity files as they are
+    copied in, without reading the Strava or Garmin export again. Stop with Ctrl+C.
+    :param poll: (bool) Check the folders every Config.WATCH_POLL_INTERVAL seconds instead of using inotify.
+    :return: None
+    """
+    def import_files(file_paths):
+        click.echo(f'Importing {len(file_paths)} new files...')
+        start = time.perf_counter()
+        with record_stages() as stage_timings:
+            activity_count = import_new_activity_files(file_paths)
+
+        click.echo(f'{activity_count} activities imported in {time.perf_counter() - start:.1f} s.')
+        echo_stage_timings(stage_timings)
+
+    click.echo(f'Watching {", ".join(get_watched_folders())} for new activity files.')
+    try:
+        watch_activity_folders(import_files, polling=poll)
+    except KeyboardInterrupt:
+        click.echo('Stopped watching.')
@@ -1,14 +1,24 @@
-from datetime import datetime, timezone
-from app.models import Activity, db
+from datetime import datetime, timedelta, timezone
+from app.models import (
+    Activity, ActivityTotal, BestEffort, HeartRateHistogram, HeartRateZoneTime, MeanMaxCurve, db, to_local_time
+)
+from app.streams import analyze_activity, analyze_new_activity_file, get_best_effort_sport
+from app.cache import clear_cache
+from app.timing import timed
 
 import pandas as pd
+import numpy as np
 import sqlite3
-from sqlalchemy import create_engine
+from sqlalchemy import cast, create_engine, func, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from config import Config
 import json
 import glob
+import gzip
 import os
+import shutil
 from zoneinfo import ZoneInfo
+from concurrent.futures import ProcessPoolExecutor
 from zipfile import ZipFile
 from fitparse import FitFile
 from io import BytesIO
@@ -199,6 +209,7 @@ class Database:
                 row = {
                     'Activity ID': activity.get('activityId'),
                     'Activity Date': activity.get('startTimeLocal'),
+                    'Start Time UTC': activity.get('startTimeGmt'),
                     'Activity Name': activity.get('name'),
 
                     # activityType is usually nested
@@ -223,7 +234,10 @@ class Database:
 
             # df['filename'] =
 
-            # Convert timestamps
+            # Convert timestamps. The local time minus the GMT time is the offset of the timezone the activity was
+            # recorded in.
+            df['UTC Offset Seconds'] = ((df['Activity Date'] - df['Start Time UTC']) // 1000).astype('Int64')
+            df['Start Time UTC'] = (df['Start Time UTC'] // 1000).astype('Int64')
             df['Activity Date'] = pd.to_datetime(df['Activity Date'], unit='ms').dt.strftime('%Y-%m-%d %H:%M:%S')
 
             print(f'merge_csv_files {df["Activity Date"]}')
@@ -232,8 +246,9 @@ class Database:
             df['Distance'] = df['Distance'].fillna(0)
             df['Distance'] = df['Distance'].apply(self.convert_centimeter_to_mile)
 
-            # Convert elapsed time
+            # Convert elapsed time, keeping the seconds for sorting and filtering.
             df['Activity Duration'] = df['Activity Duration'].fillna('0')
+            df['Duration Seconds'] = (df['Activity Duration'].astype(float) // 1000).astype(int)
             df['Activity Duration'] = df['Activity Duration'].apply(self.convert_milliseconds_to_time_format)
 
             # Convert avg speed
@@ -267,10 +282,13 @@ class Database:
                 columns=
                 {'Activity ID': 'garmin_activity_id',
                  'Activity Date': 'start_time',
+                 'Start Time UTC': 'start_time_utc',
+                 'UTC Offset Seconds': 'utc_offset_seconds',
                  'Activity Name': 'activity_name',
                  'Activity Description': 'activity_description',
                  'Activity Type': 'activity_type',
                  'Activity Duration': 'activity_duration',
+                 'Duration Seconds': 'duration_seconds',
                  'Distance': 'distance',
                  'Moving Time': 'activity_duration',
                  'Average Speed': 'average_speed',
@@ -280,9 +298,12 @@ class Database:
                  }
             )
 
+            # The fit file start times are in UTC, so they are matched to the activities by the UTC start time.
             # garmin_fit_file_activity_df['start_time'] = pd.to_datetime(garmin_fit_file_activity_df['start_time'])
-            garmin_fit_file_activity_df['start_time'] = garmin_fit_file_activity_df['start_time'].astype(str)
-            garmin_fit_file_activity_df['start_time'] = garmin_fit_file_activity_df['start_time'].apply(self.convert_utc_time_to_local_time_format2)
+            # Only the first fit file of each start time is kept, so two files of one activity do not make two rows.
+            garmin_fit_files = garmin_fit_file_activity_df.drop(columns=['start_time']).assign(
+                start_time_utc=self.convert_datetime_to_epoch(garmin_fit_file_activity_df['start_time'])
+            ).dropna(subset=['start_time_utc']).drop_duplicates(subset=['start_time_utc'])
 
             # renamed_column_titles['start_time'] = pd.to_datetime(renamed_column_titles['start_time'])
 
@@ -302,8 +323,8 @@ class Database:
             print(f'garmin_fit_file_activities_df.columns is: {garmin_fit_file_activity_df.columns}')
 
             merged_garmin_df = renamed_column_titles.merge(
-                garmin_fit_file_activity_df,
-                on="start_time",
+                garmin_fit_files,
+                on="start_time_utc",
                 how="left"
             )
 
@@ -372,7 +393,11 @@ class Database:
             converted_highest_elevation = highest_elevation.apply(self.convert_meter_to_foot)
             desired_data['Elevation High'] = converted_highest_elevation
 
-            # Convert the activity date from UTC to users local time, then convert the time format.
+            # Keep the UTC start time, then convert the activity date from UTC to users local time and convert the
+            # time format.
+            desired_data['Start Time UTC'] = self.convert_datetime_to_epoch(
+                pd.to_datetime(desired_data['Activity Date'], format='%b %d, %Y, %I:%M:%S %p', errors='coerce')
+            )
             desired_data['Activity Date'] = desired_data['Activity Date'].astype(str)
             desired_data['Activity Date'] = desired_data['Activity Date'].apply(self.convert_utc_time_to_local_time_format1)
             desired_data['Activity Date'] = desired_data['Activity Date'].apply(self.convert_time_format)
@@ -385,6 +410,7 @@ class Database:
 
             # Convert the activity moving time to seconds.
             desired_data['Moving Time Seconds'] = desired_data['Moving Time'].copy()
+            desired_data['Duration Seconds'] = desired_data['Moving Time'].copy()
             desired_data['Moving Time'] = desired_data['Moving Time'].apply(self.convert_seconds_to_time_format)
             desired_data['Moving Time'] = desired_data['Moving Time'].fillna(0)
 
@@ -404,12 +430,14 @@ class Database:
                 columns=
                 {'Activity ID': 'strava_activity_id',
                  'Activity Date': 'start_time',
+                 'Start Time UTC': 'start_time_utc',
                  'Activity Name': 'activity_name',
                  'Activity Description': 'activity_description',
                  'Activity Type': 'activity_type',
                  'Distance': 'distance',
                  'Moving Time': 'activity_duration',
                  'Moving Time Seconds': 'moving_time_seconds',
+                 'Duration Seconds': 'duration_seconds',
                  # 'Commute': 'commute',
                  'Max Speed': 'max_speed',
                  'Elevation Gain': 'elevation_gain',
@@ -428,25 +456,19 @@ class Database:
             return renamed_column_titles
 
 
-    def merge_csv_files(self):
-
-        # garmin_csv = f'{self.garmin_activities_csv_file_dir_path}/{self.garmin_activity_data_csv_file}'
-        garmin_csv = f'{self.merged_garmin_files}'
+    def merge_csv_files(self, sources=('strava', 'garmin')):
+        """
+        Merge the Strava and Garmin activity CSV files into one row per activity, matching the activities recorded on
+        both by their UTC start time.
+        :param sources: (tuple) The sources to merge, strava and/or garmin. The CSV file of a source that is left out is
+        not read, so an import of one source does not pick up the file of an earlier import.
+        :return: (Pandas dataframe) The merged activity data.
+        """
+        # The Garmin CSV file written by process_garmin_activity_file(), with the fit file of each activity merged in.
+        garmin_csv = f'{self.garmin_activities_csv_file_dir_path}/{self.garmin_activity_data_csv_file}'
+        # garmin_csv = f'{self.merged_garmin_files}'
         strava_csv = self.strava_activities_csv_file
 
-        # =========================
-        # LOAD CSV FILES
-        # =========================
-        garmin_df = pd.read_csv(garmin_csv)
-        strava_df = pd.read_csv(strava_csv)
-
-        garmin_df = garmin_df.rename(
-            columns=
-            {
-                'filename': 'garmin_filename'
-            }
-        )
-
         # =========================
         # KEEP ONLY REQUIRED COLUMNS
         # =========================
@@ -454,6 +476,8 @@ class Database:
             'strava_activity_id',
             'garmin_activity_id',
             'start_time',
+            'start_time_utc',
+            'utc_offset_seconds',
             'activity_name',
             'activity_type',
             'distance',
@@ -464,12 +488,26 @@ class Database:
             'garmin_filename',
             'activity_duration',
             'moving_time_seconds',
+            'duration_seconds',
             'average_speed',
             'max_speed',
             'elevation_gain',
             'highest_elevation'
         ]
 
+        # =========================
+        # LOAD CSV FILES
+        # =========================
+        garmin_df = pd.read_csv(garmin_csv) if 'garmin' in sources else pd.DataFrame(columns=required_columns)
+        strava_df = pd.read_csv(strava_csv) if 'strava' in sources else pd.DataFrame(columns=required_columns)
+
+        garmin_df = garmin_df.rename(
+            columns=
+            {
+                'filename': 'garmin_filename'
+            }
+        )
+
         # =========================
         # Keep only columns that exist
         # =========================
@@ -492,6 +530,8 @@ class Database:
         # =========================
         garmin_df['start_time'] = pd.to_datetime(garmin_df['start_time'], errors='coerce')
         strava_df['start_time'] = pd.to_datetime(strava_df['start_time'], errors='coerce')
+        garmin_df['start_time_utc'] = garmin_df['start_time_utc'].astype('Int64')
+        strava_df['start_time_utc'] = strava_df['start_time_utc'].astype('Int64')
 
         # =========================
         # OPTIONAL: ROUND DISTANCE
@@ -521,7 +561,7 @@ class Database:
         merged_df = pd.merge(
             left=garmin_df,
             right=strava_df,
-            on=['start_time'],
+            on=['start_time_utc'],
             how='outer',
             suffixes=('_garmin', '_strava')
         )
@@ -563,12 +603,15 @@ class Database:
             'strava_activity_id',
             'garmin_activity_id',
             'start_time',
+            'start_time_utc',
+            'utc_offset_seconds',
             'activity_name',
             'activity_type',
             'distance',
             # 'commute',
             'activity_description',
             'moving_time_seconds',
+            'duration_seconds',
             'activity_gear',
             'strava_filename',
             'garmin_filename',
@@ -602,10 +645,12 @@ class Database:
             elif col in merged_df.columns:
                 result_df[col] = merged_df[col]
 
+        result_df = self.drop_duplicate_activities(result_df)
+
         # =========================
         # SORT BY DATE
         # =========================
-        result_df = result_df.sort_values('start_time', ascending=False)
+        result_df = result_df.sort_values('start_time_utc', ascending=False)
 
         print(f'result_df["garmin_filename"] is: {result_df["garmin_filename"]}')
         print(f'result_df.columns is: {result_df.columns}')
@@ -629,6 +674,570 @@ class Database:
 
         return result_df
 
+    @staticmethod
+    def drop_duplicate_activities(data_frame):
+        """
+        Remove the merged rows that repeat a Strava or Garmin activity id, keeping the first one. The merge on the UTC
+        start time copies an id to every row with the same start time, for example an activity uploaded to Strava twice,
+        and the activity table only allows each id once.
+        :param data_frame: (Pandas dataframe) The merged activity data.
+        :return: (Pandas dataframe) The merged activity data with one row for each activity id.
+        """
+        for column in ['strava_activity_id', 'garmin_activity_id']:
+            if column not in data_frame.columns:
+                continue
+
+            duplicated = data_frame[column].notna() & data_frame[column].duplicated()
+            if duplicated.any():
+                print(f'{duplicated.sum()} activities with a {column} that is already imported were skipped.')
+                data_frame = data_frame[~duplicated]
+
+        return data_frame
+
+    def build_garmin_zip_file_index(self):
+        """
+        Map the name of each file in the Garmin upload zip files to the zip file it is stored in.
+        :return: (dict) The filename as the key and the path to the zip file as the value.
+        """
+        zip_file_index = {}
+
+        for zip_path in glob.glob(f"{self.garmin_activities_csv_file_dir_path}/UploadedFiles*.zip"):
+            with ZipFile(zip_path) as z:
+                for filename in z.namelist():
+                    zip_file_index[filename] = zip_path
+
+        return zip_file_index
+
+    def locate_activity_file(self, row, garmin_zip_file_index):
+        """
+        Find the activity file for an activity. The Strava file is used if it exists, otherwise the Garmin file is read
+        from the zip file it is stored in.
+        :param row: (pandas dataframe row) The merged activity data of the activity.
+        :param garmin_zip_file_index: (dict) The Garmin zip file of each filename, from build_garmin_zip_file_index().
+        :return: (tuple) The file path and the name of the file in the zip file (None for Strava files), the arguments
+        of read_stored_activity_file() in streams.py, or None if there is no activity file.
+        """
+        strava_filename = self.clean(row.get('strava_filename'))
+        garmin_filename = self.clean(row.get('garmin_filename'))
+
+        if strava_filename:
+            strava_file_path = os.path.join(Config.UPLOAD_FOLDER_STRAVA, strava_filename)
+
+            if os.path.exists(strava_file_path):
+                return strava_file_path, None
+
+        if garmin_filename and garmin_filename in garmin_zip_file_index:
+            return garmin_zip_file_index[garmin_filename], garmin_filename
+
+        return None
+
+    def warm_activity_file_cache(self, data_frame):
+        """
+        Prepare the fit files the activity pages read, so the first view of an activity does not wait for them. The
+        Strava .fit.gz files are decompressed into Config.DECOMPRESSED_ACTIVITY_FILES_FOLDER, and the Garmin fit files
+        are extracted into a folder named after the zip file they are stored in. Files that are already there are
+        skipped.
+        :param data_frame: (Pandas dataframe) The merged activity data, from merge_csv_files().
+        :return: (int) The number of files decompressed or extracted.
+        """
+        garmin_zip_file_index = self.build_garmin_zip_file_index()
+        os.makedirs(Config.DECOMPRESSED_ACTIVITY_FILES_FOLDER, exist_ok=True)
+        file_count = 0
+
+        for _, row in data_frame.iterrows():
+            activity_file = self.locate_activity_file(row, garmin_zip_file_index)
+            if activity_file is None:
+                continue
+
+            file_path, zip_member_name = activity_file
+            if zip_member_name is not None:
+                if not zip_member_name.lower().endswith('.fit'):
+                    continue
+                output_file = os.path.join(os.path.splitext(file_path)[0], zip_member_name)
+                if not os.path.exists(output_file):
+                    with ZipFile(file_path) as z:
+                        z.extract(zip_member_name, os.path.splitext(file_path)[0])
+                    file_count += 1
+
+            elif file_path.lower().endswith('.fit.gz'):
+                output_file = os.path.join(Config.DECOMPRESSED_ACTIVITY_FILES_FOLDER, os.path.basename(file_path)[:-3])
+                if not os.path.exists(output_file):
+                    with gzip.open(file_path, 'rb') as f_in, open(output_file, 'wb') as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+                    file_count += 1
+
+        return file_count
+
+    def find_new_activity_files(self, file_paths):
+        """
+        List the activity files in new or changed upload files that are not in the activity table yet. A Strava file is
+        one activity file, and a Garmin upload zip file holds many .fit files.
+        :param file_paths: (list) The paths of the new or changed files in the upload folders.
+        :return: (list) The file path and the name of the file in the zip file (None for Strava files) of each new
+        activity file, the arguments of read_stored_activity_file() in streams.py.
+        """
+        strava_filenames = {
+            filename for filename, in db.session.query(Activity.strava_filename)
+            .filter(Activity.strava_filename.isnot(None))
+        }
+        garmin_filenames = {
+            filename for filename, in db.session.query(Activity.garmin_filename)
+            .filter(Activity.garmin_filename.isnot(None))
+        }
+
+        activity_files = []
+        for file_path in file_paths:
+            if file_path.lower().endswith('.zip'):
+                with ZipFile(file_path) as z:
+                    activity_files.extend(
+                        (file_path, filename) for filename in z.namelist()
+                        if filename.lower().endswith('.fit') and filename not in garmin_filenames
+                    )
+
+            elif os.path.relpath(file_path, Config.UPLOAD_FOLDER_STRAVA) not in strava_filenames:
+                activity_files.append((file_path, None))
+
+        return activity_files
+
+    def import_activity_files(self, file_paths):
+        """
+        Import new activity files without the Strava or Garmin export. The summary of each activity (start time,
+        duration, distance, speeds and elevation) is calculated from the file itself, together with the stream values
+        from process_activity_streams(), in one read of the file. A file that starts within Config.WATCH_MATCH_SECONDS
+        of an activity that is already in the database is added to that activity, which keeps its summary, otherwise a
+        new activity is inserted without a Strava or Garmin id. The totals and heart rate zone times of the new
+        activities are added in the same transaction, and the app cache is cleared.
+        :param file_paths: (list) The paths of the new or changed files in the upload folders.
+        :return: (list) The Activity instances that were added or updated.
+        """
+        with timed('locate'):
+            activity_files = self.find_new_activity_files(file_paths)
+
+        if not activity_files:
+            return []
+
+        with timed('streams'), ProcessPoolExecutor(max_workers=Config.STREAM_PROCESS_WORKERS) as executor:
+            results = list(executor.map(analyze_new_activity_file, activity_files, chunksize=8))
+
+        activities = []
+        new_activities = []
+        streamed_activities = []
+        with timed('db-insert'):
+            for (file_path, zip_member_name), result in zip(activity_files, results):
+                if result is None:
+                    continue
+
+                streams = result['streams']
+                row = {
+                    'calculated_elevation_gain': self.convert_meter_to_foot(streams['elevation_gain']),
+                    'calculated_elevation_loss': self.convert_meter_to_foot(streams['elevation_loss']),
+                    **streams,
+                }
+                source_filename = {
+                    'strava_filename': os.path.relpath(file_path, Config.UPLOAD_FOLDER_STRAVA)
+                } if zip_member_name is None else {
+                    'garmin_filename': zip_member_name
+                }
+
+                activity = Activity.query.filter(
+                    Activity.start_time_utc.between(
+                        result['start_time_utc'] - Config.WATCH_MATCH_SECONDS,
+                        result['start_time_utc'] + Config.WATCH_MATCH_SECONDS
+                    )
+                ).first()
+
+                if activity is None:
+                    local_start_time = datetime.fromtimestamp(
+                        result['start_time_utc'], ZoneInfo(Config.USER_TIMEZONE)
+                    )
+                    distance = self.convert_meter_to_mile(result['distance'])
+                    activity = Activity(
+                        activity_name=result['activity_name'] or os.path.basename(zip_member_name or file_path),
+                        start_time=local_start_time.replace(tzinfo=None),
+                        start_time_utc=result['start_time_utc'],
+                        utc_offset_seconds=int(local_start_time.utcoffset().total_seconds()),
+                        activity_duration=self.convert_seconds_to_time_format(result['duration_seconds']),
+                        moving_time_seconds=int(result['moving_time_seconds']),
+                        duration_seconds=int(result['duration_seconds']),
+                        distance=distance,
+                        average_speed=(
+                            round(distance / result['moving_time_seconds'] * 3600, 2)
+                            if result['moving_time_seconds'] else 0.0
+                        ),
+                        max_speed=self.convert_max_speed(result['max_speed']),
+                        elevation_gain=row['calculated_elevation_gain'],
+                        highest_elevation=(
+                            None if result['highest_elevation'] is None
+                            else self.convert_meter_to_foot(result['highest_elevation'])
+                        ),
+                        activity_type=result['activity_type'],
+                        **source_filename,
+                    )
+                    self.set_activity_streams(activity, row)
+                    db.session.add(activity)
+                    new_activities.append(activity)
+                    streamed_activities.append(activity)
+
+                else:
+                    # A file of an activity that already has a file from the same source is a duplicate.
+                    column, filename = next(iter(source_filename.items()))
+                    if getattr(activity, column) is not None:
+                        continue
+
+                    setattr(activity, column, filename)
+                    if activity.calculated_elevation_gain is None and activity.route_polyline is None:
+                        self.set_activity_streams(activity, row)
+                        streamed_activities.append(activity)
+
+                activities.append(activity)
+
+            db.session.flush()
+
+        with timed('totals'):
+            self.add_activities_to_totals(new_activities, commit=False)
+
+        with timed('zone-times'):
+            self.add_heart_rate_zone_times(streamed_activities, commit=False)
+
+        with timed('commit'):
+            db.session.commit()
+        clear_cache()
+
+        print(f'{len(new_activities)} activities added and {len(activities) - len(new_activities)} updated from '
+              f'{len(activity_files)} new activity files.')
+
+        return activities
+
+    @staticmethod
+    def filter_new_activities(data_frame):
+        """
+        Remove the activities that are already in the activity table, found by their Strava or Garmin id, so an
+        incremental import only adds the new activities.
+        :param data_frame: (Pandas dataframe) The merged activity data, from merge_csv_files().
+        :return: (Pandas dataframe) The activities that are not in the activity table.
+        """
+        strava_activity_ids = {
+            activity_id for activity_id, in db.session.query(Activity.strava_activity_id)
+            .filter(Activity.strava_activity_id.isnot(None))
+        }
+        garmin_activity_ids = {
+            activity_id for activity_id, in db.session.query(Activity.garmin_activity_id)
+            .filter(Activity.garmin_activity_id.isnot(None))
+        }
+
+        is_new = ~(
+            data_frame['strava_activity_id'].isin(strava_activity_ids) |
+            data_frame['garmin_activity_id'].isin(garmin_activity_ids)
+        )
+        return data_frame[is_new].copy()
+
+    @staticmethod
+    def get_season(start_time):
+        """
+        Get the season an activity belongs to. A season starts in Config.SEASON_START_MONTH and is named after the year
+        it starts in.
+        :param start_time: (datetime) The start time of the activity.
+        :return: (int) The season.
+        """
+        start_time = pd.Timestamp(start_time)
+        return start_time.year if start_time.month >= Config.SEASON_START_MONTH else start_time.year - 1
+
+    def process_activity_streams(self, data_frame, progress=None):
+        """
+        Read the activity file of every activity and calculate the values that come from the activity streams. The
+        files are read in a process pool with analyze_activity() from streams.py. The elevation gain and loss are
+        calculated from the cleaned altitude stream and saved next to the elevation gain from the Strava or Garmin
+        export. The GPS track is simplified and encoded for the
+        route map, and the mean maximal curves, best efforts, and heart rate histograms are saved for their tables.
+        :param data_frame: (Pandas dataframe) The merged activity data, from merge_csv_files().
+        :param progress: (function) Called with the number of activities read so far, or None.
+        :return: (Pandas dataframe) The merged activity data with the calculated columns added.
+        """
+        with timed('locate'):
+            garmin_zip_file_index = self.build_garmin_zip_file_index()
+            activity_files = [
+                self.locate_activity_file(row, garmin_zip_file_index) for _, row in data_frame.iterrows()
+            ]
+
+        with timed('streams'), ProcessPoolExecutor(max_workers=Config.STREAM_PROCESS_WORKERS) as executor:
+            results = []
+            for result in executor.map(analyze_activity, activity_files, data_frame['activity_type'], chunksize=8):
+                results.append(result)
+                if progress is not None:
+                    progress(len(results))
+
+        results = [result or {} for result in results]
+
+        data_frame['calculated_elevation_gain'] = pd.Series(
+            [result.get('elevation_gain') for result in results],
+            index=data_frame.index,
+            dtype='float64'
+        ).apply(self.convert_meter_to_foot)
+        data_frame['calculated_elevation_loss'] = pd.Series(
+            [result.get('elevation_loss') for result in results],
+            index=data_frame.index,
+            dtype='float64'
+        ).apply(self.convert_meter_to_foot)
+        data_frame['route_polyline'] = pd.Series(
+            [result.get('route_polyline') for result in results],
+            index=data_frame.index,
+            dtype='object'
+        )
+        data_frame['mean_max_curves'] = pd.Series(
+            [result.get('mean_max_curves', {}) for result in results],
+            index=data_frame.index,
+            dtype='object'
+        )
+        data_frame['best_efforts'] = pd.Series(
+            [result.get('best_efforts', {}) for result in results],
+            index=data_frame.index,
+            dtype='object'
+        )
+        data_frame['heart_rate_histogram'] = pd.Series(
+            [result.get('heart_rate_histogram', {}) for result in results],
+            index=data_frame.index,
+            dtype='object'
+        )
+
+        return data_frame
+
+    @staticmethod
+    def calculate_max_heart_rate(age, activity_type='general'):
+        """
+        Calculate the max heart rate with the Tanaka formula, which is more accurate for fit individuals.
+        :param age: (int) The age of the user.
+        :param activity_type: (str) general, running, cycling, swimming, rowing, or hiking.
+        :return: (int) The max heart rate in beats per minute.
+        """
+        max_heart_rate = int(208 - (0.7 * int(age)))  # Normal Max HR for running, hiking, walking, etc.
+        if activity_type == 'cycling':
+            max_heart_rate -= 9  # Cycling is ~5-10bpm lower because rider is seated and using less muscle.
+        if activity_type == 'swimming':
+            max_heart_rate -= 14  # Swimming is ~10-15bpm lower because of the horizontal position.
+        if activity_type == 'rowing':
+            max_heart_rate -= 5  # 5bpm lower because of being seated, but using upper body.
+
+        return max_heart_rate
+
+    def get_heart_rate_zone_boundaries(self):
+        """
+        Get the heart rate zones used for the time in zone. These are the zones last calculated on the HR Zones page,
+        or the general zones for Config.USER_AGE if the zones have not been calculated.
+        :return: (list) The heart rate, in beats per minute, that zones 1 to 5 start at.
+        """
+        if Config.HEART_RATE_ZONE_BOUNDARIES:
+            return Config.HEART_RATE_ZONE_BOUNDARIES
+
+        max_heart_rate = self.calculate_max_heart_rate(Config.USER_AGE)
+        return [int(max_heart_rate * percentage) for percentage in Config.HEART_RATE_ZONE_PERCENTAGES]
+
+    def update_heart_rate_zone_times(self, commit=True):
+        """
+        Recalculate the heart_rate_zone_time table from the heart_rate_histogram table, so the time in zone follows the
+        current heart rate zones without reading the activity files again.
+        :param commit: (bool) Commit the changes. False when they are committed with the rest of an import.
+        :return: None
+        """
+        histogram = np.array(
+            db.session.query(
+                HeartRateHistogram.activity_id,
+                HeartRateHistogram.heart_rate,
+                HeartRateHistogram.seconds
+            ).all(),
+            dtype=np.float64
+        ).reshape(-1, 3)
+
+        HeartRateZoneTime.query.delete()
+        self.insert_heart_rate_zone_times(histogram)
+
+        if commit:
+            db.session.commit()
+
+    def add_heart_rate_zone_times(self, activities, commit=True):
+        """
+        Add the heart_rate_zone_time rows of new activities from their heart rate histograms, without reading the
+        histograms of the other activities. The old zone times of the activities are replaced.
+        :param activities: (list) The Activity instances, flushed so they have an id.
+        :param commit: (bool) Commit the changes. False when they are committed with the rest of an import.
+        :return: None
+        """
+        activity_ids = [activity.id for activity in activities]
+        if activity_ids:
+            HeartRateZoneTime.query.filter(HeartRateZoneTime.activity_id.in_(activity_ids)).delete()
+
+        histogram = np.array([
+            (activity.id, row.heart_rate, row.seconds)
+            for activity in activities
+            for row in activity.heart_rate_histogram
+        ], dtype=np.float64).reshape(-1, 3)
+        self.insert_heart_rate_zone_times(histogram)
+
+        if commit:
+            db.session.commit()
+
+    def insert_heart_rate_zone_times(self, histogram):
+        """
+        Insert the heart_rate_zone_time rows of heart rate histogram rows. The zone of every row is found with
+        np.digitize, then the seconds are summed for each activity and zone.
+        :param histogram: (numpy array) One row for each activity_id, heart_rate and seconds.
+        :return: None
+        """
+        if len(histogram) == 0:
+            return
+
+        zones = np.digitize(histogram[:, 1], self.get_heart_rate_zone_boundaries())
+        activity_zones, group = np.unique(
+            np.column_stack((histogram[:, 0], zones)).astype(np.int64),
+            axis=0,
+            return_inverse=True
+        )
+        seconds = np.bincount(group.ravel(), weights=histogram[:, 2])
+
+        db.session.execute(db.insert(HeartRateZoneTime), [
+            {'activity_id': int(activity_id), 'zone': int(zone), 'seconds': float(zone_seconds)}
+            for (activity_id, zone), zone_seconds in zip(activity_zones, seconds)
+        ])
+
+    @staticmethod
+    def get_period_start(period, start_time):
+        """
+        Get the first day of the week (starting on Monday), month or year an activity belongs to.
+        :param period: (str) week, month or year.
+        :param start_time: (datetime) The local start time of the activity.
+        :return: (str) The first day of the period in YYYY-MM-DD format.
+        """
+        start_time = pd.Timestamp(start_time)
+        if period == 'week':
+            return (start_time - timedelta(days=start_time.weekday())).strftime('%Y-%m-%d')
+        if period == 'month':
+            return start_time.strftime('%Y-%m-01')
+        return start_time.strftime('%Y-01-01')
+
+    @staticmethod
+    def get_period_start_column(period):
+        """
+        Build the SQL expression of the first day of the week (starting on Monday), month or year of the activities in
+        the user timezone, the same as get_period_start().
+        :param period: (str) week, month or year.
+        :return: (ColumnElement) The first day of the period in YYYY-MM-DD format.
+        """
+        start_time = func.local_time(Activity.start_time_utc)
+        if period == 'week':
+            # %w is 0 on Sunday, so Sunday goes back 6 days and Monday 0 days.
+            days_since_monday = (cast(func.strftime('%w', start_time), db.Integer) + 6) % 7
+            return func.date(start_time, func.printf('-%d days', days_since_monday))
+        if period == 'month':
+            return func.strftime('%Y-%m-01', start_time)
+        return func.strftime('%Y-01-01', start_time)
+
+    def rebuild_activity_totals(self, commit=True):
+        """
+        Rebuild the activity_total table from the activity table, with one INSERT ... SELECT ... GROUP BY for each period
+        in Config.ACTIVITY_TOTAL_PERIODS. The moving time of an activity without one is its elapsed time.
+        :param commit: (bool) Commit the changes. False when they are committed with the rest of an import.
+        :return: None
+        """
+        ActivityTotal.query.delete()
+
+        activity_gear = func.coalesce(Activity.activity_gear, Config.NO_GEAR_NAME)
+        for period in Config.ACTIVITY_TOTAL_PERIODS:
+            period_start = self.get_period_start_column(period)
+            totals = db.select(
+                literal(period),
+                period_start,
+                Activity.activity_type,
+                activity_gear,
+                func.count(Activity.id),
+                func.coalesce(func.sum(Activity.distance), 0),
+                func.coalesce(func.sum(func.coalesce(func.nullif(Activity.moving_time_seconds, 0),
+                                                     Activity.duration_seconds)), 0),
+                func.coalesce(func.sum(Activity.elevation_gain), 0),
+                func.coalesce(func.max(Activity.max_speed), 0),
+            ).group_by(period_start, Activity.activity_type, activity_gear)
+
+            db.session.execute(db.insert(ActivityTotal).from_select([
+                'period', 'period_start', 'activity_type', 'activity_gear', 'count', 'distance', 'moving_seconds',
+                'elevation_gain', 'max_speed'
+            ], totals))
+
+        if commit:
+            db.session.commit()
+
+    def add_activities_to_totals(self, activities, commit=True):
+        """
+        Add new activities to the activity_total table without reading the other activities. The totals of the new
+        activities are summed for each period, activity type and gear, then upserted: a new row is inserted, or the
+        totals are added to the row that is already there.
+        :param activities: (list) The new Activity instances.
+        :param commit: (bool) Commit the changes. False when they are committed with the rest of an import.
+        :return: None
+        """
+        totals = {}
+        for activity in activities:
+            for period in Config.ACTIVITY_TOTAL_PERIODS:
+                key = (
+                    period,
+                    self.get_period_start(period, to_local_time(activity.start_time_utc)),
+                    activity.activity_type,
+                    activity.activity_gear or Config.NO_GEAR_NAME
+                )
+                total = totals.setdefault(key, {
+                    'period': key[0], 'period_start': key[1], 'activity_type': key[2], 'activity_gear': key[3],
+                    'count': 0, 'distance': 0, 'moving_seconds': 0, 'elevation_gain': 0, 'max_speed': 0
+                })
+                total['count'] += 1
+                total['distance'] += activity.distance or 0
+                total['moving_seconds'] += activity.moving_time_seconds or activity.duration_seconds or 0
+                total['elevation_gain'] += activity.elevation_gain or 0
+                total['max_speed'] = max(total['max_speed'], activity.max_speed or 0)
+
+        if not totals:
+            return
+
+        # Upsert in chunks so the statement stays under the SQLite limit on the number of parameters.
+        rows = list(totals.values())
+        for chunk_start in range(0, len(rows), 1000):
+            statement = sqlite_insert(ActivityTotal).values(rows[chunk_start:chunk_start + 1000])
+            statement = statement.on_conflict_do_update(
+                index_elements=['period', 'period_start', 'activity_type', 'activity_gear'],
+                set_={
+                    'count': ActivityTotal.count + statement.excluded.count,
+                    'distance': ActivityTotal.distance + statement.excluded.distance,
+                    'moving_seconds': ActivityTotal.moving_seconds + statement.excluded.moving_seconds,
+                    'elevation_gain': ActivityTotal.elevation_gain + statement.excluded.elevation_gain,
+                    'max_speed': func.max(ActivityTotal.max_speed, statement.excluded.max_speed),
+                }
+            )
+            db.session.execute(statement)
+
+        if commit:
+            db.session.commit()
+
+    @staticmethod
+    def convert_datetime_to_epoch(utc_times):
+        """
+        Convert UTC date and times without a timezone to seconds since the epoch.
+        :param utc_times: (Pandas series) The UTC date and times.
+        :return: (Pandas series) The seconds since the epoch as Int64, with missing times as <NA>.
+        """
+        utc_times = pd.to_datetime(utc_times, errors='coerce')
+        return ((utc_times - pd.Timestamp('1970-01-01')) // pd.Timedelta(seconds=1)).astype('Int64')
+
+    @staticmethod
+    def convert_local_time_to_epoch(start_time):
+        """
+        Convert a local date and time in the user timezone to seconds since the epoch. Used for activities that were
+        imported without a UTC start time.
+        :param start_time: (datetime) The local date and time.
+        :return: (int) The seconds since the epoch, or None if there is no start time.
+        """
+        if start_time is None or pd.isna(start_time):
+            return None
+        local_time = pd.Timestamp(start_time).tz_localize(
+            Config.USER_TIMEZONE, ambiguous=True, nonexistent='shift_forward'
+        )
+        return int(local_time.timestamp())
+
     @staticmethod
     def convert_time_format(start_time):
         """
@@ -659,7 +1268,7 @@ class Database:
             activity_start_time = datetime.strptime(df_row_value, '%b %d, %Y, %I:%M:%S %p').replace(tzinfo=timezone.utc)
 
             # Convert start time from UTC to Local(user selected) time.
-            adjusted_time = activity_start_time.astimezone(ZoneInfo('America/Los_Angeles'))
+            adjusted_time = activity_start_time.astimezone(ZoneInfo(Config.USER_TIMEZONE))
             new_format = adjusted_time.strftime('%b %d, %Y, %I:%M:%S %p')
 
             return new_format
@@ -684,7 +1293,7 @@ class Database:
             activity_start_time = datetime.strptime(df_row_value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
 
             # Convert start time from UTC to Local(user selected) time.
-            adjusted_time = activity_start_time.astimezone(ZoneInfo('America/Los_Angeles'))
+            adjusted_time = activity_start_time.astimezone(ZoneInfo(Config.USER_TIMEZONE))
             new_format = adjusted_time.strftime('%Y-%m-%d %H:%M:%S')
 
             return new_format
@@ -829,9 +1438,129 @@ class Database:
     def clean(value):
         return None if pd.isna(value) else value
 
+    @staticmethod
+    def is_elevation_gain_mismatch(elevation_gain, calculated_elevation_gain):
+        """
+        Check if the elevation gain calculated from the altitude stream does not agree with the exported elevation gain.
+        :param elevation_gain: (float) The elevation gain from the Strava or Garmin export, in feet.
+        :param calculated_elevation_gain: (float) The elevation gain calculated from the activity file, in feet.
+        :return: (bool) True if the two are more than Config.ELEVATION_GAIN_MISMATCH_FEET and
+        Config.ELEVATION_GAIN_MISMATCH_RATIO apart.
+        """
+        if elevation_gain is None or calculated_elevation_gain is None:
+            return False
+
+        difference = abs(calculated_elevation_gain - elevation_gain)
+        return bool(
+            difference > Config.ELEVATION_GAIN_MISMATCH_FEET and
+            difference > elevation_gain * Config.ELEVATION_GAIN_MISMATCH_RATIO
+        )
+
+    def set_activity_streams(self, activity, row):
+        """
+        Set the values that come from the activity streams on an activity: the calculated elevation gain and loss, the
+        route, and the mean maximal curves, best efforts and heart rate histogram rows. If the calculated elevation
+        gain is too far from the exported elevation gain of the activity, the activity is flagged.
+        :param activity: (Activity) The activity.
+        :param row: (pandas dataframe row or dict) The activity data, with the columns added by
+        process_activity_streams().
+        :return: None
+        """
+        activity.calculated_elevation_gain = self.clean(row.get('calculated_elevation_gain'))
+        activity.calculated_elevation_loss = self.clean(row.get('calculated_elevation_loss'))
+        activity.elevation_gain_mismatch = self.is_elevation_gain_mismatch(
+            activity.elevation_gain, activity.calculated_elevation_gain
+        )
+        activity.route_polyline = self.clean(row.get('route_polyline'))
+
+        mean_max_curves = row.get('mean_max_curves')
+        if isinstance(mean_max_curves, dict) and mean_max_curves:
+            season = self.get_season(activity.start_time)
+            activity.mean_max_curve = [
+                MeanMaxCurve(channel=channel, duration_seconds=duration, value=value, season=season)
+                for channel, curve in mean_max_curves.items()
+                for duration, value in zip(Config.MEAN_MAX_DURATIONS, curve)
+                if value is not None
+            ]
+
+        best_efforts = row.get('best_efforts')
+        if isinstance(best_efforts, dict) and best_efforts:
+            sport = get_best_effort_sport(activity.activity_type)
+            activity.best_efforts = [
+                BestEffort(
+                    sport=sport,
+                    distance_name=distance_name,
+                    distance_meters=Config.BEST_EFFORT_DISTANCES[distance_name],
+                    elapsed_seconds=effort[0],
+                    start_seconds=effort[1],
+                )
+                for distance_name, effort in best_efforts.items()
+                if effort is not None
+            ]
+
+        heart_rate_histogram = row.get('heart_rate_histogram')
+        if isinstance(heart_rate_histogram, dict):
+            activity.heart_rate_histogram = [
+                HeartRateHistogram(heart_rate=heart_rate, seconds=seconds)
+                for heart_rate, seconds in heart_rate_histogram.items()
+            ]
+
+    def add_activities(self, data_frame, commit=True):
+        """
+        Add the activities of a dataframe to the activity table, with their mean maximal curves, best efforts and heart
+        rate histograms. The activity totals and heart rate zone times are not updated.
+        :param data_frame: (Pandas dataframe) The merged activity data, from process_activity_streams().
+        :param commit: (bool) Commit the new activities. False when they are committed with the rest of an import, in
+        which case they are only flushed.
+        :return: (list) The new Activity instances.
+        """
+        activities = []
+        with timed('db-insert'):
+            for _, row in data_frame.iterrows():
+
+                activity = Activity(
+                    strava_activity_id=self.clean(row.get('strava_activity_id')),
+                    garmin_activity_id=self.clean(row.get('garmin_activity_id')),
+                    activity_name=self.clean(row['activity_name']),
+                    activity_description=self.clean(row['activity_description']),
+                    start_time=self.clean(row['start_time']),
+                    start_time_utc=(
+                        self.clean(row.get('start_time_utc'))
+                        if not pd.isna(row.get('start_time_utc'))
+                        else self.convert_local_time_to_epoch(self.clean(row['start_time']))
+                    ),
+                    utc_offset_seconds=self.clean(row.get('utc_offset_seconds')),
+                    activity_duration=self.clean(row['activity_duration']),
+                    moving_time_seconds=self.clean(row['moving_time_seconds']),
+                    duration_seconds=self.clean(row.get('duration_seconds')),
+                    distance=self.clean(row['distance']),
+                    average_speed=self.clean(row['average_speed']),
+                    max_speed=self.clean(row['max_speed']),
+                    elevation_gain=self.clean(row['elevation_gain']),
+                    highest_elevation=self.clean(row['highest_elevation']),
+                    activity_type=self.clean(row['activity_type']),
+                    activity_gear=self.clean(row['activity_gear']),
+                    strava_filename=self.clean(row['strava_filename']),
+                    garmin_filename=self.clean(row['garmin_filename']),
+                )
+                self.set_activity_streams(activity, row)
+
+                db.session.add(activity)
+                activities.append(activity)
+
+            if commit:
+                db.session.commit()
+            else:
+                db.session.flush()
+
+        return activities
+
     def create_db_tables(self, db_name, db_table_name, data_frame):
         """
-        Create the database table, the name is defined in config.py.
+        Create the database table, the name is defined in config.py. The old rows are deleted and the new ones are
+        inserted, with the totals and zone times, in one transaction. The database is in WAL mode (see
+        set_sqlite_pragmas() in models.py), so the pages keep reading the old activities without waiting until the new
+        ones are committed, and never see a partly imported table.
         :param db_name:  (str) The name of the database, defined in config.py.
         :param db_table_name:  (str) The name of the table, defined in config.py.
         :param data_frame: (Pandas dataframe) A dataframe with the activity data.
@@ -841,34 +1570,25 @@ class Database:
         # print(db.engine.url)
         # data_frame.to_sql(db_table_name, connection, if_exists='replace', index=False)
 
+        ActivityTotal.query.delete()
+        MeanMaxCurve.query.delete()
+        BestEffort.query.delete()
+        HeartRateHistogram.query.delete()
+        HeartRateZoneTime.query.delete()
         Activity.query.delete()
-        db.session.commit()
 
         #=============================================== New ===========================================================
-        for _, row in data_frame.iterrows():
+        self.add_activities(data_frame, commit=False)
 
-            activity = Activity(
-                strava_activity_id=self.clean(row.get('strava_activity_id')),
-                garmin_activity_id=self.clean(row.get('garmin_activity_id')),
-                activity_name=self.clean(row['activity_name']),
-                activity_description=self.clean(row['activity_description']),
-                start_time=self.clean(row['start_time']),
-                activity_duration=self.clean(row['activity_duration']),
-                moving_time_seconds=self.clean(row['moving_time_seconds']),
-                distance=self.clean(row['distance']),
-                average_speed=self.clean(row['average_speed']),
-                max_speed=self.clean(row['max_speed']),
-                elevation_gain=self.clean(row['elevation_gain']),
-                highest_elevation=self.clean(row['highest_elevation']),
-                activity_type=self.clean(row['activity_type']),
-                activity_gear=self.clean(row['activity_gear']),
-                strava_filename=self.clean(row['strava_filename']),
-                garmin_filename=self.clean(row['garmin_filename']),
-            )
+        with timed('totals'):
+            self.rebuild_activity_totals(commit=False)
 
-            db.session.add(activity)
+        with timed('zone-times'):
+            self.update_heart_rate_zone_times(commit=False)
 
-        db.session.commit()
+        with timed('commit'):
+            db.session.commit()
+        clear_cache()
         #===============================================================================================================
         connection.close()
 
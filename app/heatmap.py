@@ -0,0 +1,203 @@
+from io import BytesIO
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from app.streams import decode_polyline
+from config import Config
+
+# The highest latitude that can be shown on a web mercator map.
+MAX_LATITUDE = 85.0511287798
+MAX_TILE_COUNT = np.iinfo(np.uint16).max
+
+
+def heatmap_activity_key(strava_activity_id, garmin_activity_id, filename=None):
+    """
+    Build the key that an activity is saved under in the list of activities already drawn on the heatmap tiles.
+    :param strava_activity_id: (int) The Strava activity id, or None.
+    :param garmin_activity_id: (int) The Garmin activity id, or None.
+    :param filename: (str) The activity file name, used for activities imported from a new file without either id.
+    :return: (str) The activity key.
+    """
+    if strava_activity_id is None and garmin_activity_id is None:
+        return f'file-{filename}'
+    return f'{strava_activity_id}-{garmin_activity_id}'
+
+
+def lat_lon_to_pixel(latitude, longitude, zoom):
+    """
+    Convert latitude and longitude to web mercator pixel coordinates of the whole map at a zoom level.
+    :param latitude: (numpy array) Latitude of each point in degrees.
+    :param longitude: (numpy array) Longitude of each point in degrees.
+    :param zoom: (int) The zoom level.
+    :return: (tuple) The x and y pixel coordinates as float numpy arrays.
+    """
+    world_size = Config.HEATMAP_TILE_SIZE * 2 ** zoom
+    sin_latitude = np.sin(np.radians(np.clip(latitude, -MAX_LATITUDE, MAX_LATITUDE)))
+
+    x = (np.asarray(longitude) + 180) / 360 * world_size
+    y = (0.5 - np.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * np.pi)) * world_size
+
+    return x, y
+
+
+def rasterize_track(latitude, longitude, zoom):
+    """
+    Find every pixel a GPS track passes through at a zoom level. Each segment of the track is split into steps of at
+    most one pixel so there are no gaps between the points, and each pixel is returned once so an activity only adds
+    one to the count of a pixel.
+    :param latitude: (numpy array) Latitude of each point in degrees.
+    :param longitude: (numpy array) Longitude of each point in degrees.
+    :param zoom: (int) The zoom level.
+    :return: (numpy array) The unique pixels as y * world size + x.
+    """
+    world_size = Config.HEATMAP_TILE_SIZE * 2 ** zoom
+    x, y = lat_lon_to_pixel(latitude, longitude, zoom)
+
+    if len(x) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    dx = np.diff(x)
+    dy = np.diff(y)
+    steps = np.maximum(np.ceil(np.hypot(dx, dy)), 1).astype(np.int64)
+
+    # Position of every step along its segment, from 0 up to (but not including) 1.
+    segment = np.repeat(np.arange(len(steps)), steps)
+    fraction = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[segment]
+
+    pixel_x = np.append(x[segment] + dx[segment] * fraction, x[-1])
+    pixel_y = np.append(y[segment] + dy[segment] * fraction, y[-1])
+    pixel_x = np.clip(pixel_x.astype(np.int64), 0, world_size - 1)
+    pixel_y = np.clip(pixel_y.astype(np.int64), 0, world_size - 1)
+
+    return np.unique(pixel_y * world_size + pixel_x)
+
+
+def heatmap_tile_path(zoom, x, y):
+    """
+    Get the path of the count grid of a heatmap tile.
+    :param zoom: (int) The zoom level.
+    :param x: (int) The tile column.
+    :param y: (int) The tile row.
+    :return: (str) The path of the .npz file.
+    """
+    return os.path.join(Config.HEATMAP_TILE_FOLDER, str(zoom), str(x), f'{y}.npz')
+
+
+def update_heatmap_tiles(activities):
+    """
+    Add the routes of activities that are not on the heatmap yet to the tile pyramid. Each tile is a uint16 grid with
+    the number of activities that passed through each pixel, saved as a compressed .npz file for every zoom level
+    between HEATMAP_MIN_ZOOM and HEATMAP_MAX_ZOOM. The keys of the activities already added are saved next to the
+    tiles, so importing the same activities again does not count them twice.
+    :param activities: (list) Activities with strava_activity_id, garmin_activity_id and route_polyline attributes, and
+    strava_filename and garmin_filename attributes if they have neither id.
+    :return: (int) The number of activities added to the heatmap.
+    """
+    tile_size = Config.HEATMAP_TILE_SIZE
+    activity_list_path = os.path.join(Config.HEATMAP_TILE_FOLDER, 'activities.json')
+
+    heatmap_activities = set()
+    if os.path.exists(activity_list_path):
+        with open(activity_list_path, 'r') as f:
+            heatmap_activities = set(json.load(f))
+
+    new_activities = {}
+    for activity in activities:
+        if activity.strava_activity_id is None and activity.garmin_activity_id is None:
+            key = heatmap_activity_key(None, None, activity.strava_filename or activity.garmin_filename)
+        else:
+            key = heatmap_activity_key(activity.strava_activity_id, activity.garmin_activity_id)
+        if activity.route_polyline and key not in heatmap_activities:
+            new_activities[key] = decode_polyline(activity.route_polyline)
+
+    if not new_activities:
+        return 0
+
+    for zoom in range(Config.HEATMAP_MIN_ZOOM, Config.HEATMAP_MAX_ZOOM + 1):
+        world_size = tile_size * 2 ** zoom
+        pixels = np.concatenate(
+            [rasterize_track(latitude, longitude, zoom) for latitude, longitude in new_activities.values()]
+        )
+        pixel_y, pixel_x = np.divmod(pixels, world_size)
+
+        # Group the pixels by tile and count them on a flat tile sized grid.
+        tiles = (pixel_x // tile_size) * 2 ** zoom + pixel_y // tile_size
+        local_pixels = (pixel_y % tile_size) * tile_size + pixel_x % tile_size
+        order = np.argsort(tiles, kind='stable')
+        tiles, first_index = np.unique(tiles[order], return_index=True)
+
+        for tile, tile_pixels in zip(tiles, np.split(local_pixels[order], first_index[1:])):
+            tile_x, tile_y = divmod(int(tile), 2 ** zoom)
+            path = heatmap_tile_path(zoom, tile_x, tile_y)
+
+            counts = np.bincount(tile_pixels, minlength=tile_size * tile_size).reshape(tile_size, tile_size)
+            if os.path.exists(path):
+                with np.load(path) as tile_file:
+                    counts = counts + tile_file['counts']
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            np.savez_compressed(path, counts=np.minimum(counts, MAX_TILE_COUNT).astype(np.uint16))
+
+    with open(activity_list_path, 'w') as f:
+        json.dump(sorted(heatmap_activities | new_activities.keys()), f)
+
+    return len(new_activities)
+
+
+def load_heatmap_tile(zoom, x, y):
+    """
+    Load the count grid of a heatmap tile. Zoom levels above HEATMAP_MAX_ZOOM are not saved, so the part of the tile
+    at HEATMAP_MAX_ZOOM that covers the requested tile is enlarged instead.
+    :param zoom: (int) The zoom level.
+    :param x: (int) The tile column.
+    :param y: (int) The tile row.
+    :return: (numpy array) The count grid, or None if no activity passes through the tile.
+    """
+    tile_size = Config.HEATMAP_TILE_SIZE
+    zoom_difference = max(zoom - Config.HEATMAP_MAX_ZOOM, 0)
+    path = heatmap_tile_path(zoom - zoom_difference, x >> zoom_difference, y >> zoom_difference)
+
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as tile_file:
+        counts = tile_file['counts']
+
+    if zoom_difference == 0:
+        return counts
+
+    part_size = max(tile_size >> zoom_difference, 1)
+    part_x = (x % 2 ** zoom_difference) * tile_size >> zoom_difference
+    part_y = (y % 2 ** zoom_difference) * tile_size >> zoom_difference
+    part = counts[part_y:part_y + part_size, part_x:part_x + part_size]
+
+    return np.repeat(np.repeat(part, tile_size // part_size, axis=0), tile_size // part_size, axis=1)
+
+
+def render_heatmap_tile(counts):
+    """
+    Render a heatmap count grid as a PNG image. Pixels without activities are transparent and the color goes from red
+    to yellow to white on a log scale up to HEATMAP_SATURATION_COUNT activities.
+    :param counts: (numpy array) The count grid of the tile, or None for an empty tile.
+    :return: (bytes) The PNG image.
+    """
+    tile_size = Config.HEATMAP_TILE_SIZE
+    if counts is None:
+        counts = np.zeros((tile_size, tile_size), dtype=np.uint16)
+
+    intensity = np.clip(np.log1p(counts) / np.log1p(Config.HEATMAP_SATURATION_COUNT), 0, 1)
+
+    image = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+    image[..., 0] = 255
+    image[..., 1] = np.clip(intensity * 2, 0, 1) * 255
+    image[..., 2] = np.clip(intensity * 2 - 1, 0, 1) * 255
+    image[..., 3] = np.where(counts > 0, 96 + intensity * 159, 0)
+
+    buffer = BytesIO()
+    Image.fromarray(image, 'RGBA').save(buffer, 'PNG')
+
+    return buffer.getvalue()
@@ -1,28 +1,62 @@
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import column, event, func, table
+from sqlalchemy.engine import Engine
+from zoneinfo import ZoneInfo
+from config import Config
 
 db = SQLAlchemy()
 
 class Activity(db.Model):
     """ This class defines the database model. """
+    # Indexes for the activity lookups by Strava or Garmin id, and for the filter and sort columns of the activities
+    # page.
+    __table_args__ = (
+        db.Index('ix_activity_strava_activity_id', 'strava_activity_id', unique=True),
+        db.Index('ix_activity_garmin_activity_id', 'garmin_activity_id', unique=True),
+        db.Index('ix_activity_activity_type_start_time_utc', 'activity_type', 'start_time_utc'),
+        db.Index('ix_activity_start_time_utc', 'start_time_utc'),
+        db.Index('ix_activity_activity_name', 'activity_name'),
+        db.Index('ix_activity_activity_type', 'activity_type'),
+        db.Index('ix_activity_duration_seconds', 'duration_seconds'),
+        db.Index('ix_activity_distance', 'distance'),
+        db.Index('ix_activity_average_speed', 'average_speed'),
+        db.Index('ix_activity_max_speed', 'max_speed'),
+        db.Index('ix_activity_elevation_gain', 'elevation_gain'),
+        db.Index('ix_activity_highest_elevation', 'highest_elevation'),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     strava_activity_id = db.Column(db.BigInteger, nullable=True)
     garmin_activity_id = db.Column(db.BigInteger, nullable=True)
     activity_name = db.Column(db.String(200))
     activity_description = db.Column(db.String(1000))
     # commute = db.Column(db.String(10), nullable=False)
-    start_time = db.Column(db.DateTime, nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)  # Local time of the timezone used for the import.
+    start_time_utc = db.Column(db.Integer)  # Seconds since the epoch, converted to the user timezone when shown.
+    utc_offset_seconds = db.Column(db.Integer)  # Offset of the activity's own timezone, when Garmin provides it.
+    # The start time in the user timezone, converted by SQLite when the activity is read.
+    local_start_time = db.column_property(func.local_time(start_time_utc))
     activity_duration = db.Column(db.String(200), nullable=False)
     moving_time_seconds = db.Column(db.Integer)
+    duration_seconds = db.Column(db.Integer)
     distance = db.Column(db.Double, default=0)
     average_speed = db.Column(db.Double, default=0)
     max_speed = db.Column(db.Double, default=0)
     elevation_gain = db.Column(db.Double, default=0)
+    calculated_elevation_gain = db.Column(db.Double)
+    calculated_elevation_loss = db.Column(db.Double)
+    elevation_gain_mismatch = db.Column(db.Boolean, default=False)
     highest_elevation = db.Column(db.Double, default=0)
     activity_type = db.Column(db.String(40), nullable=False)
     activity_gear = db.Column(db.String(50))
     strava_filename = db.Column(db.String(100))
     garmin_filename = db.Column(db.String(100))
+    route_polyline = db.Column(db.Text)
+    mean_max_curve = db.relationship('MeanMaxCurve', backref='activity', cascade='all, delete-orphan')
+    best_efforts = db.relationship('BestEffort', backref='activity', cascade='all, delete-orphan')
+    heart_rate_histogram = db.relationship('HeartRateHistogram', backref='activity', cascade='all, delete-orphan')
+    heart_rate_zone_times = db.relationship('HeartRateZoneTime', backref='activity', cascade='all, delete-orphan')
 
 
     def __repr__(self):
@@ -43,3 +77,228 @@ class Activity(db.Model):
         return str(timedelta(seconds=self.activity_duration))
 
 
+
+
+class MeanMaxCurve(db.Model):
+    """
+    This class defines the mean maximal curve table. Each row is the best average value of a channel (power or heart
+    rate) over one duration in one activity. The season is saved so the per-season curves do not need the start time.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), nullable=False, index=True)
+    channel = db.Column(db.String(20), nullable=False)
+    duration_seconds = db.Column(db.Integer, nullable=False)
+    value = db.Column(db.Double, nullable=False)
+    season = db.Column(db.Integer, nullable=False)
+
+
+class BestEffort(db.Model):
+    """
+    This class defines the best effort table. Each row is the fastest time over one distance (1 km, 1 mile, 5 km, etc.)
+    in one run or ride, found in the activity streams when the activities are imported.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), nullable=False, index=True)
+    sport = db.Column(db.String(20), nullable=False)
+    distance_name = db.Column(db.String(40), nullable=False)
+    distance_meters = db.Column(db.Double, nullable=False)
+    elapsed_seconds = db.Column(db.Double, nullable=False)
+    start_seconds = db.Column(db.Double, nullable=False)  # When the effort started, in seconds from the activity start.
+
+
+class HeartRateHistogram(db.Model):
+    """
+    This class defines the heart rate histogram table. Each row is the time spent at one heart rate (in beats per
+    minute) in one activity. The heart rate zone times are calculated from this table.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), nullable=False, index=True)
+    heart_rate = db.Column(db.Integer, nullable=False)
+    seconds = db.Column(db.Double, nullable=False)
+
+
+class HeartRateZoneTime(db.Model):
+    """
+    This class defines the heart rate zone time table. Each row is the time spent in one heart rate zone in one
+    activity. Zone 0 is the time below zone 1. The rows are recalculated from the heart_rate_histogram table when the
+    heart rate zones change.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), nullable=False, index=True)
+    zone = db.Column(db.Integer, nullable=False)
+    seconds = db.Column(db.Double, nullable=False)
+
+
+class ActivityTotal(db.Model):
+    """
+    This class defines the activity total table. Each row is the total of the activities of one activity type and gear
+    in one week, month or year, so the totals pages read one row per period instead of every activity. The rows are
+    rebuilt when the activities are imported and updated when activities are added.
+    """
+    __table_args__ = (
+        db.Index(
+            'ix_activity_total_period',
+            'period', 'period_start', 'activity_type', 'activity_gear',
+            unique=True
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    period = db.Column(db.String(10), nullable=False)  # week, month or year.
+    period_start = db.Column(db.String(10), nullable=False)  # The first day of the period, in YYYY-MM-DD format.
+    activity_type = db.Column(db.String(40), nullable=False)
+    activity_gear = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    distance = db.Column(db.Double, nullable=False)
+    moving_seconds = db.Column(db.Integer, nullable=False)
+    elevation_gain = db.Column(db.Double, nullable=False)
+    max_speed = db.Column(db.Double, nullable=False)
+
+
+# Full text index of the activity names and descriptions, searched by the activities page. It is an external content
+# FTS5 table, so the text is only saved in the activity table, and the triggers keep the index in sync with every insert,
+# update and delete of an activity.
+ACTIVITY_SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE activity_search USING fts5(
+        activity_name,
+        activity_description,
+        content='activity',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER activity_search_insert AFTER INSERT ON activity BEGIN
+        INSERT INTO activity_search(rowid, activity_name, activity_description)
+        VALUES (new.id, new.activity_name, new.activity_description);
+    END
+    """,
+    """
+    CREATE TRIGGER activity_search_delete AFTER DELETE ON activity BEGIN
+        INSERT INTO activity_search(activity_search, rowid, activity_name, activity_description)
+        VALUES ('delete', old.id, old.activity_name, old.activity_description);
+    END
+    """,
+    """
+    CREATE TRIGGER activity_search_update AFTER UPDATE OF activity_name, activity_description ON activity BEGIN
+        INSERT INTO activity_search(activity_search, rowid, activity_name, activity_description)
+        VALUES ('delete', old.id, old.activity_name, old.activity_description);
+        INSERT INTO activity_search(rowid, activity_name, activity_description)
+        VALUES (new.id, new.activity_name, new.activity_description);
+    END
+    """,
+]
+
+# The FTS5 table and triggers created with the activity table, checked by is_database_schema_stale().
+ACTIVITY_SEARCH_OBJECTS = {
+    'activity_search', 'activity_search_insert', 'activity_search_delete', 'activity_search_update'
+}
+
+# The FTS5 table is not a model, so it is queried through a lightweight table. The column named after the table is the
+# one FTS5 matches against, and rank is the bm25 score of a match (lower is a better match).
+activity_search = table('activity_search', column('rowid'), column('rank'), column('activity_search'))
+
+
+@event.listens_for(Activity.__table__, 'after_create')
+def create_activity_search(target, connection, **kwargs):
+    """
+    Create the full text index of the activities and its triggers when db.create_all() creates the activity table.
+    :param target: (Table) The activity table.
+    :param connection: (Connection) The connection that created the table.
+    :return: None
+    """
+    for statement in ACTIVITY_SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+
+
+@event.listens_for(Activity.__table__, 'before_drop')
+def drop_activity_search(target, connection, **kwargs):
+    """
+    Drop the full text index of the activities when db.drop_all() drops the activity table. The triggers are dropped
+    with the activity table.
+    :param target: (Table) The activity table.
+    :param connection: (Connection) The connection that drops the table.
+    :return: None
+    """
+    connection.exec_driver_sql('DROP TABLE IF EXISTS activity_search')
+
+
+def is_database_schema_stale():
+    """
+    Check if the database was created by an older version of the app. db.create_all() only adds the missing tables, so
+    a table without a column or index of its model, or an activity table without its full text index, has to be
+    dropped and created again.
+    :return: (bool) True if a table of the database does not match its model.
+    """
+    with db.engine.connect() as connection:
+        inspector = db.inspect(connection)
+        table_names = set(inspector.get_table_names())
+
+        for model_table in db.metadata.sorted_tables:
+            if model_table.name not in table_names:
+                continue
+
+            missing = (
+                {model_column.name for model_column in model_table.columns} -
+                {table_column['name'] for table_column in inspector.get_columns(model_table.name)}
+            ) | (
+                {model_index.name for model_index in model_table.indexes} -
+                {table_index['name'] for table_index in inspector.get_indexes(model_table.name)}
+            )
+            if missing:
+                print(f'The {model_table.name} table is missing {", ".join(sorted(missing))}.')
+                return True
+
+        if Activity.__tablename__ in table_names:
+            schema_names = {
+                name for name, in connection.exec_driver_sql(
+                    "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')"
+                )
+            }
+            if not ACTIVITY_SEARCH_OBJECTS <= schema_names:
+                print('The activity table is missing its full text index.')
+                return True
+
+    return False
+
+
+def to_local_time(start_time_utc):
+    """
+    Convert a UTC start time to the local time of the user timezone set on the settings page.
+    :param start_time_utc: (int) Seconds since the epoch.
+    :return: (str) The local time in YYYY-MM-DD HH:MM:SS format, or None if there is no start time.
+    """
+    if start_time_utc is None:
+        return None
+    local_time = datetime.fromtimestamp(start_time_utc, timezone.utc).astimezone(ZoneInfo(Config.USER_TIMEZONE))
+    return local_time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+@event.listens_for(Engine, 'connect')
+def create_local_time_function(dbapi_connection, connection_record):
+    """
+    Add the local_time() SQL function to every new SQLite connection, so queries can group and format the UTC start
+    times in the user timezone. The timezone is read on every call, so a change on the settings page applies to the
+    next query without importing the activities again.
+    :param dbapi_connection: (sqlite3.Connection) The new connection.
+    :param connection_record: (ConnectionRecord) The pool record of the connection.
+    :return: None
+    """
+    dbapi_connection.create_function('local_time', 1, to_local_time)
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Set Config.SQLITE_PRAGMAS on every new SQLite connection. journal_mode=WAL is saved in the database file, the other
+    pragmas only last as long as the connection.
+    :param dbapi_connection: (sqlite3.Connection) The new connection.
+    :param connection_record: (ConnectionRecord) The pool record of the connection.
+    :return: None
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in Config.SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
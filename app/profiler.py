@@ -0,0 +1,116 @@
+from collections import Counter
+from datetime import datetime
+import os
+import sys
+import threading
+
+from config import Config
+
+
+def frame_name(frame):
+    """
+    Name a stack frame by its function, file and first line, the way it is shown in the profiles.
+    :param frame: (frame) The stack frame.
+    :return: (str) The frame name, for example "activity_info (routes.py:1380)".
+    """
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class SamplingProfiler:
+    """
+    This class samples the call stack of one thread from a background thread every Config.PROFILE_INTERVAL seconds.
+    The profiled thread is not slowed down by tracing every call, only by the sampling thread taking the GIL, so it can
+    profile a request on the running app. Each stack is counted as a collapsed stack, the frames from the outermost to
+    the innermost joined with semicolons.
+    """
+
+    def __init__(self, thread_id=None):
+        """
+        :param thread_id: (int) The id of the thread to profile, the current thread by default.
+        """
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        """
+        Count the stack of the profiled thread until the profiler is stopped.
+        :return: None
+        """
+        while not self._stopped.wait(Config.PROFILE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """
+        Start sampling.
+        :return: None
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and wait for the sampling thread to finish.
+        :return: None
+        """
+        self._stopped.set()
+        self._thread.join()
+
+    def collapsed_stacks(self):
+        """
+        Format the samples as collapsed stacks, one stack and its sample count per line, which flamegraph.pl,
+        speedscope and inferno read.
+        :return: (str) The collapsed stacks.
+        """
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit):
+        """
+        Find the functions that were on the stack in the most samples.
+        :param limit: (int) The number of functions to return.
+        :return: (list) A dictionary with the function name, the samples it was running in (self) and the samples it
+        was on the stack in (total) of each function, with the highest total first.
+        """
+        self_samples = Counter()
+        total_samples = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            self_samples[frames[-1]] += count
+            # A recursive function is only counted once per sample.
+            for name in set(frames):
+                total_samples[name] += count
+
+        return [
+            {'function': name, 'self': self_samples[name], 'total': total}
+            for name, total in total_samples.most_common(limit)
+        ]
+
+    def save(self, name):
+        """
+        Save the collapsed stacks and a table of the top Config.PROFILE_TOP_N functions in Config.PROFILE_FOLDER.
+        :param name: (str) The name of the profiled request, used in the file names.
+        :return: (str) The path of the collapsed stack file. The table is saved next to it with a .txt extension.
+        """
+        os.makedirs(Config.PROFILE_FOLDER, exist_ok=True)
+        path = os.path.join(Config.PROFILE_FOLDER, f'{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}-{name}')
+        sample_count = sum(self.stacks.values()) or 1
+
+        with open(f'{path}.folded', 'w') as f:
+            f.write(self.collapsed_stacks())
+
+        with open(f'{path}.txt', 'w') as f:
+            f.write(f'{sample_count} samples every {Config.PROFILE_INTERVAL * 1000:g} ms\n\n')
+            f.write(f'{"total %":>8} {"self %":>8}  function\n')
+            for row in self.top_functions(Config.PROFILE_TOP_N):
+                f.write(
+                    f'{row["total"] / sample_count:>8.1%} {row["self"] / sample_count:>8.1%}  {row["function"]}\n'
+                )
+
+        return f'{path}.folded'
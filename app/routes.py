@@ -1,32 +1,42 @@
-from app.models import Activity, db
+from app.models import (
+    Activity, ActivityTotal, BestEffort, HeartRateZoneTime, MeanMaxCurve, activity_search, db, to_local_time
+)
 from app.database import Database
+from app.streams import read_fit_file, read_gpx_file, read_tcx_file, clean_sample_frame
+from app.heatmap import update_heatmap_tiles, load_heatmap_tile, render_heatmap_tile
+from app.cache import cached, clear_cache
+from app.profiler import SamplingProfiler
+from app.timing import (
+    finish_request_timing, format_server_timing, get_timing_summary, start_request_timing, timed
+)
 import sqlite3
 from app import create_app
 
 from config import Config
 
-from flask import Blueprint, render_template, request, jsonify, session
+from flask import (
+    Blueprint, render_template, request, jsonify, session, make_response, Response, stream_with_context, g,
+    send_from_directory, abort
+)
 
 from sqlalchemy.sql.operators import ilike_op
-from sqlalchemy import asc, desc,  or_, inspect
+from sqlalchemy import and_, asc, desc,  or_, inspect
 from sqlalchemy.exc import OperationalError
-from sqlalchemy import cast, Date
+from sqlalchemy import case, cast, Date, func, literal_column
 
+import base64
+import csv
+import io
 import json
+import re
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import pandas as pd
 import numpy as np
-import plotly.express as px
 import plotly.graph_objs as go
 import plotly
-from fitparse.utils import FitEOFError
-from fitparse import FitFile, utils
 import gzip
 import os
-import gpxpy
-import tcxparser
-import xml.etree.ElementTree as ET
-from geopy.distance import geodesic
 import pytz
 from pathlib import Path
 from zipfile import ZipFile
@@ -43,26 +53,193 @@ METER_TO_FOOT = 3.28084
 os.makedirs(Config.DECOMPRESSED_ACTIVITY_FILES_FOLDER, exist_ok=True)
 
 
-def convert_activity_csv_to_db():
+def convert_activity_csv_to_db(only=None, incremental=False, warm_file_cache=False, progress=None):
     """
     This function creates an instance of the Database class (defined in database.py), drops(deletes) any existing
     database(Database.DATABASE_NAME), then creates a table(Database.TABLE_NAME) in the defined database
     (Database.DATABASE_NAME) with the defined columns(defined in the Database.convert_csv_to_df() method).
-    :return: None
+    It is used by the /create-db route and the flask strava import command (defined in cli.py).
+    :param only: (str) 'strava' or 'garmin' to import only the activities of one export, or None to import both.
+    :param incremental: (bool) Only add the activities that are not in the database yet, instead of dropping and
+    rebuilding every table.
+    :param warm_file_cache: (bool) Decompress and extract the fit files of the imported activities, so the activity
+    pages do not have to.
+    :param progress: (function) Called with the number of activities and the number read so far while the activity
+    streams are read, or None.
+    :return: (int) The number of activities added.
     """
     db = Database()
-    db.drop_table(Config.DATABASE_NAME)
+    if not incremental:
+        db.drop_table(Config.DATABASE_NAME)
+
+    sources = (only,) if only else ('strava', 'garmin')
+
+    if 'strava' in sources:
+        print('\n\nProcessing Strava Data...')
+        with timed('strava-csv'):
+            db.process_strava_activity_file()
+
+    if 'garmin' in sources:
+        # Build the Garmin fit file index
+        with timed('fit-index'):
+            record = db.build_garmin_file_index()
+
+        print('\n\nProcessing Garmin Data...')
+        with timed('garmin-json'):
+            db.process_garmin_activity_file(record)
+
+    with timed('merge'):
+        merged_activities = db.merge_csv_files(sources)
+        if incremental:
+            merged_activities = db.filter_new_activities(merged_activities)
+
+    print('\n\nProcessing Activity Streams...')
+    activity_count = len(merged_activities)
+    merged_activities = db.process_activity_streams(
+        merged_activities,
+        None if progress is None else lambda read_count: progress(activity_count, read_count)
+    )
 
-    # Build the Garmin fit file index
-    record = db.build_garmin_file_index()
+    if incremental:
+        if activity_count:
+            # The new activities are committed with their totals and zone times.
+            activities = db.add_activities(merged_activities, commit=False)
+            with timed('totals'):
+                db.add_activities_to_totals(activities, commit=False)
+
+            with timed('zone-times'):
+                db.add_heart_rate_zone_times(activities)
+            clear_cache()
+    else:
+        db.create_db_tables(Config.DATABASE_NAME, Config.ACTIVITY_TABLE_NAME, merged_activities)
 
-    print('\n\nProcessing Strava Data...')
-    db.process_strava_activity_file()
+    if warm_file_cache:
+        print('\n\nDecompressing Activity Files...')
+        with timed('file-cache'):
+            print(f'{db.warm_activity_file_cache(merged_activities)} activity files decompressed.')
 
-    print('\n\nProcessing Garmin Data...')
-    db.process_garmin_activity_file(record)
+    print('\n\nUpdating Heatmap Tiles...')
+    with timed('heatmap'):
+        heatmap_activities = Activity.query.with_entities(
+            Activity.strava_activity_id,
+            Activity.garmin_activity_id,
+            Activity.strava_filename,
+            Activity.garmin_filename,
+            Activity.route_polyline
+        ).filter(Activity.route_polyline.isnot(None)).all()
+        print(f'{update_heatmap_tiles(heatmap_activities)} activities added to the heatmap.')
 
-    db.create_db_tables(Config.DATABASE_NAME, Config.ACTIVITY_TABLE_NAME, db.merge_csv_files())
+    return activity_count
+
+
+def import_new_activity_files(file_paths):
+    """
+    Import activity files that were added to the upload folders after the last import, without reading the Strava or
+    Garmin export again. Used by the flask strava watch command (defined in cli.py).
+    :param file_paths: (list) The paths of the new or changed files in the upload folders.
+    :return: (int) The number of activities added or updated.
+    """
+    activities = Database().import_activity_files(file_paths)
+
+    with timed('heatmap'):
+        print(f'{update_heatmap_tiles(activities)} activities added to the heatmap.')
+
+    return len(activities)
+
+
+@main.before_app_request
+def start_timing():
+    """
+    Save the start time of every request, for the Server-Timing header and the /debug/perf page.
+    :return: None
+    """
+    start_request_timing()
+
+
+@main.after_app_request
+def add_server_timing(response):
+    """
+    Record the time of each stage of the request (the spans timed with timed()) and of the whole request, and send
+    them in the Server-Timing header. Requests that do not match a route are not recorded.
+    :param response: (Response) The response of the request.
+    :return: (Response) The response with the Server-Timing header.
+    """
+    if request.url_rule is not None:
+        response.headers['Server-Timing'] = format_server_timing(finish_request_timing(request.url_rule.rule))
+    return response
+
+
+def is_profiling_allowed():
+    """
+    Check if the current request comes from one of Config.PROFILE_ALLOWED_ADDRESSES, which may profile requests and see
+    the /debug pages.
+    :return: (bool) True if the request may use the profiling tools.
+    """
+    return request.remote_addr in Config.PROFILE_ALLOWED_ADDRESSES
+
+
+def stop_profiling():
+    """
+    Stop the profiler of the current request, if it is profiled, and save the profile.
+    :return: (str) The path of the collapsed stack file, or None if the request is not profiled.
+    """
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return None
+
+    profiler.stop()
+    path = profiler.save((request.endpoint or 'request').split('.')[-1])
+    print(f'Profile of {request.full_path} saved to {path}')
+    return path
+
+
+@main.before_app_request
+def start_profiling():
+    """
+    Profile the request with the sampling profiler when the _profile=1 query parameter is set and the request comes from
+    one of Config.PROFILE_ALLOWED_ADDRESSES. Works for every route, including POST requests like /create-db?_profile=1.
+    :return: None
+    """
+    if request.args.get('_profile') == '1' and is_profiling_allowed():
+        g.profiler = SamplingProfiler()
+        g.profiler.start()
+
+
+@main.after_app_request
+def save_profile(response):
+    """
+    Stop the profiler of a profiled request and save the profile. The name of the collapsed stack file is sent in the
+    X-Profile header, and the profile is listed on the /debug/perf page.
+    :param response: (Response) The response of the request.
+    :return: (Response) The response.
+    """
+    path = stop_profiling()
+    if path is not None:
+        response.headers['X-Profile'] = os.path.basename(path)
+    return response
+
+
+@main.teardown_app_request
+def stop_failed_profiling(exception):
+    """
+    Stop and save the profiler of a request whose view raised an exception. The after request hooks do not run then,
+    and the profiler thread would keep sampling for the rest of the process.
+    :param exception: (Exception) The exception that ended the request, or None.
+    :return: None
+    """
+    stop_profiling()
+
+
+@main.app_template_filter('duration')
+def format_duration(time_in_sec):
+    """
+    Template filter that shows a duration saved in seconds in HH:MM:SS format, or MM:SS if less than an hour.
+    :param time_in_sec: (int) Seconds, or None if the activity has no duration.
+    :return: (str) The formatted duration, or an empty string.
+    """
+    if time_in_sec is None:
+        return ''
+    return Database.convert_seconds_to_time_format(time_in_sec)
 
 
 def convert_time_to_seconds(seconds, minutes, hours):
@@ -101,6 +278,18 @@ def split_time_string(time):
         return time.split(':')
 
 
+def split_seconds(time_in_sec):
+    """
+    Returns the hours, minutes, and seconds of a number of seconds. Ex. If 3725 is passed as a parameter, [1, 2, 5]
+    will be returned.
+    :param time_in_sec: (int) Time in seconds.
+    :return: (list) [hour, minute, second]
+    """
+    minutes, seconds = divmod(int(time_in_sec), 60)
+    hours, minutes = divmod(minutes, 60)
+    return [hours, minutes, seconds]
+
+
 def convert_meter_to_mile(meter):
     """
     Converts meters to miles using the convertion factor constant defined at the top of the program. If there is a comma
@@ -146,70 +335,735 @@ def generate_plot(data, title, yaxis_title, xaxis_title):
     """
     This function prepares the data to be plotted using Plotly. It takes a dictionary of the X and Y data, converts them
     to a figure, and finally converts the figure to JSON format. The main data is plotted on the Y-Axis and the distance
-    or time is plotted on the X-Axis.
+    or time is plotted on the X-Axis. Time is plotted as elapsed seconds and only the tick labels are converted to
+    HH:MM:SS format.
     :param data: (dict) The data for the x and y axes.
     :param title: (str) The title of the chart.
     :param yaxis_title: (str) The title of the y-axis.
     :param xaxis_title: (str) The title of the x-axis.
     :return: A JSON object with the plot figure data.
     """
-    fig = go.Figure()
-    fig.add_trace(go.Line(x=data['x'], y=data['y'], mode='lines', name=title))
-    fig.update_layout(title=title, yaxis_title=yaxis_title, xaxis_title=xaxis_title)
-    if xaxis_title == 'Time':
-        fig.update_layout(xaxis=dict(dtick=len(data['x']) / 8))
-    return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+    with timed('figures'):
+        fig = go.Figure()
+        fig.add_trace(go.Line(x=data['x'], y=data['y'], mode='lines', name=title))
+        fig.update_layout(title=title, yaxis_title=yaxis_title, xaxis_title=xaxis_title)
+        if xaxis_title == 'Time' and len(data['x']) > 0:
+            tick_values = np.linspace(0, np.nanmax(data['x']), 9)
+            fig.update_layout(xaxis=dict(
+                tickvals=tick_values,
+                ticktext=[Database.convert_seconds_to_time_format(value) for value in tick_values]
+            ))
+    with timed('json'):
+        return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def generate_activity_plots(sample_frame, activity_type):
+    """
+    Convert the sample frame of an activity to display units and generate a plot for each channel that has data. Indoor
+    activities are plotted against time and all other activities are plotted against distance.
+    :param sample_frame: (Pandas dataframe) The sample frame of the activity, defined in streams.py.
+    :param activity_type: (str) The activity type, used to check if the activity is an indoor activity.
+    :return data_dict: (dict) A dictionary with the JSON plot data for each graph.
+    """
+    data_dict = {}
 
+    display_frame = pd.DataFrame({
+        'time': sample_frame['time'],
+        'distance': convert_meter_to_mile(sample_frame['distance']),
+        'elevation': convert_meters_to_feet(sample_frame['altitude']),
+        'speed': convert_meters_per_second_to_miles_per_hour(sample_frame['speed']),
+        'heart_rate': sample_frame['heart_rate'],
+        'cadence': sample_frame['cadence'],
+        'temperature': convert_celsius_to_fahrenheit(sample_frame['temperature']),
+        'power': sample_frame['power'],
+    })
+
+    if activity_type in Config.INDOOR_ACTIVITIES:
+        x_data = display_frame['time']
+        xaxis_title = 'Time'
+        cadence_units = 'Strokes Per Minute'
+    else:
+        x_data = display_frame['distance']
+        xaxis_title = 'Distance'
+        cadence_units = 'RPM'
+
+    # (graph name, title, y-axis title)
+    graphs = [
+        ('speed', 'Speed', 'MPH'),
+        ('elevation', 'Elevation', 'Feet'),
+        ('heart_rate', 'Heart Rate', 'BPM'),
+        ('cadence', 'Cadence', cadence_units),
+        ('temperature', 'Temperature', 'F'),
+        ('power', 'Power', 'Watts'),
+    ]
+
+    for graph_name, title, yaxis_title in graphs:
+
+        # There is no elevation data to plot for an indoor activity.
+        if graph_name == 'elevation' and xaxis_title == 'Time':
+            continue
+
+        if display_frame[graph_name].mean() > 0:
+            data_dict[graph_name] = generate_plot(
+                {'x': x_data.to_numpy(), 'y': display_frame[graph_name].to_numpy()},
+                title,
+                yaxis_title,
+                xaxis_title
+            )
 
-def calculate_speed(trackpoints):
+    return data_dict
+
+
+def get_mean_max_envelopes(channel, activity_type=None):
     """
-    Calculate the moving speed using the GPS coordinates(a.k.a. trackpoints).
-    :param trackpoints: (list) The longitude and latitude points of the GPS activity.
-    :return speed_list: (list) A list of the speed for each datapoint.
+    Get the best mean maximal curve of all time and of each season with one aggregate query over the mean_max_curve
+    table. The query returns the best value of each season and duration, and the all time curve is the best value of
+    each duration over the seasons.
+    :param channel: (str) The channel of the curves, one of Config.MEAN_MAX_CHANNELS.
+    :param activity_type: (str) Only use activities of this activity type, or None to use every activity.
+    :return: (tuple) The all time curve (list) and the curve of each season (dict), aligned to Config.MEAN_MAX_DURATIONS
+    with None for durations that no activity reached.
     """
-    speed_list = []
+    query = db.session.query(
+        MeanMaxCurve.season,
+        MeanMaxCurve.duration_seconds,
+        func.max(MeanMaxCurve.value)
+    ).filter(MeanMaxCurve.channel == channel)
+
+    if activity_type:
+        query = query.join(Activity).filter(Activity.activity_type == activity_type)
+
+    season_values = {}
+    for season, duration, value in query.group_by(MeanMaxCurve.season, MeanMaxCurve.duration_seconds).all():
+        season_values.setdefault(season, {})[duration] = value
+
+    season_curves = {
+        season: [values.get(duration) for duration in Config.MEAN_MAX_DURATIONS]
+        for season, values in sorted(season_values.items())
+    }
+    all_time_curve = [
+        max((values[duration] for values in season_values.values() if duration in values), default=None)
+        for duration in Config.MEAN_MAX_DURATIONS
+    ]
 
-    for i in range(1, len(trackpoints)):
-        t1, lat1, lon1 = trackpoints[i - 1]
-        t2, lat2, lon2 = trackpoints[i]
+    return all_time_curve, season_curves
 
-        # Calculate time difference in seconds
-        time_diff = (t2 - t1).total_seconds()
 
-        if time_diff > 0:
-            # Calculate distance in meters
-            distance = geodesic((lat1, lon1), (lat2, lon2)).meters
-            speed = distance / time_diff  # meters per second (m/s)
-            speed_list.append(convert_meters_per_second_to_miles_per_hour(speed))
+def generate_mean_max_plot(curves, title, yaxis_title):
+    """
+    Prepare a mean maximal curve chart with Plotly. The durations are plotted on a log scale so the short and long
+    durations are both readable, and the tick labels are converted to HH:MM:SS format.
+    :param curves: (dict) The curve (list aligned to Config.MEAN_MAX_DURATIONS) of each trace, by trace name.
+    :param title: (str) The title of the chart.
+    :param yaxis_title: (str) The title of the y-axis.
+    :return: A JSON object with the plot figure data.
+    """
+    with timed('figures'):
+        fig = go.Figure()
+        for name, curve in curves.items():
+            fig.add_trace(go.Scatter(x=Config.MEAN_MAX_DURATIONS, y=curve, mode='lines+markers', name=name))
+        fig.update_layout(title=title, yaxis_title=yaxis_title, xaxis_title='Duration', xaxis=dict(
+            type='log',
+            tickvals=Config.MEAN_MAX_DURATIONS,
+            ticktext=[Database.convert_seconds_to_time_format(duration) for duration in Config.MEAN_MAX_DURATIONS]
+        ))
+    with timed('json'):
+        return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def generate_activity_mean_max_plots(activity_data):
+    """
+    Generate a chart for each mean maximal curve of an activity, compared to the all time curve of its activity type.
+    :param activity_data: (Activity) The activity.
+    :return: (dict) A dictionary with the JSON plot data for each graph.
+    """
+    data_dict = {}
 
-    return speed_list
+    # (channel, title, y-axis title)
+    graphs = [
+        ('power', 'Power Curve', 'Watts'),
+        ('heart_rate', 'Heart Rate Curve', 'BPM'),
+    ]
+
+    for channel, title, yaxis_title in graphs:
+        activity_values = {
+            curve.duration_seconds: curve.value for curve in activity_data.mean_max_curve if curve.channel == channel
+        }
+
+        if activity_values:
+            all_time_curve, _ = get_mean_max_envelopes(channel, activity_data.activity_type)
+            data_dict[f'mean_max_{channel}'] = generate_mean_max_plot(
+                {
+                    'This Activity': [activity_values.get(duration) for duration in Config.MEAN_MAX_DURATIONS],
+                    f'All Time ({activity_data.activity_type})': all_time_curve,
+                },
+                title,
+                yaxis_title
+            )
+
+    return data_dict
 
 
-def parse_tcx(filepath):
+def format_best_effort_pace(sport, distance_meters, elapsed_seconds):
     """
-    Parses the trackpoints from the tcx activity file.
-    :param filepath: (str) The decompressed_activity_files/ path with the filename of the file being parsed.
-    :return trackpoints: (list) The longitude and latitude points of the GPS activity.
+    Format the pace of a best effort, in minutes per mile for runs and in miles per hour for every other sport.
+    :param sport: (str) The sport of the best effort, a key of Config.BEST_EFFORT_SPORTS.
+    :param distance_meters: (float) The distance of the best effort in meters.
+    :param elapsed_seconds: (float) The time of the best effort in seconds.
+    :return: (str) The pace with its units.
     """
-    tree = ET.parse(filepath)
-    root = tree.getroot()
+    miles = distance_meters * METER_TO_MILE
+
+    if sport == 'Run':
+        return f'{Database.convert_seconds_to_time_format(round(elapsed_seconds / miles))} /mi'
+
+    return f'{round(miles / (elapsed_seconds / 3600), 1)} MPH'
+
+
+def get_best_effort_progression(sport):
+    """
+    Get the personal record progression of each best effort distance of a sport. All the best efforts of the sport are
+    read with one query in start time order, and an effort is a new personal record when it is faster than every effort
+    before it.
+    :param sport: (str) The sport, a key of Config.BEST_EFFORT_SPORTS.
+    :return: (dict) The list of personal records, oldest first, for each distance in Config.BEST_EFFORT_DISTANCES.
+    """
+    efforts = db.session.query(
+        BestEffort.distance_name,
+        BestEffort.distance_meters,
+        BestEffort.elapsed_seconds,
+        Activity.local_start_time,
+        Activity.activity_name,
+        Activity.strava_activity_id,
+        Activity.garmin_activity_id,
+    ).join(Activity).filter(BestEffort.sport == sport).order_by(Activity.start_time_utc).all()
+
+    progression = {distance_name: [] for distance_name in Config.BEST_EFFORT_DISTANCES}
+    for effort in efforts:
+        records = progression.setdefault(effort.distance_name, [])
+
+        if not records or effort.elapsed_seconds < records[-1]['elapsed_seconds']:
+            records.append({
+                'elapsed_seconds': effort.elapsed_seconds,
+                'time': Database.convert_seconds_to_time_format(round(effort.elapsed_seconds)),
+                'pace': format_best_effort_pace(sport, effort.distance_meters, effort.elapsed_seconds),
+                'date': effort.local_start_time.split(' ')[0],
+                'activity_name': effort.activity_name,
+                'activity_id': effort.strava_activity_id or effort.garmin_activity_id,
+            })
+
+    return progression
+
+
+def build_search_query(search_text):
+    """
+    Convert the text typed in the search box to an FTS5 query. Every word has to match the start of a word in the
+    activity name or description, so "mor rid" finds "Morning Ride". The words are quoted so characters that have a
+    meaning in the FTS5 query syntax are searched for as text.
+    :param search_text: (str) The text from the search box.
+    :return: (str) The FTS5 query, or None if the text has no words.
+    """
+    words = re.findall(r'\w+', search_text or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def get_activity_search_matches(search_text):
+    """
+    Build a subquery of the activities that match the text typed in the search box, using the activity_search full
+    text index.
+    :param search_text: (str) The text from the search box.
+    :return: (Subquery) The activity_id and search_rank (lower is a better match) of each match, or None if the text
+    has no words.
+    """
+    search_query = build_search_query(search_text)
+    if search_query is None:
+        return None
+
+    return (
+        db.select(activity_search.c.rowid.label('activity_id'), activity_search.c.rank.label('search_rank'))
+        .where(activity_search.c.activity_search.match(search_query))
+        .subquery('activity_search_match')
+    )
+
+
+def local_date_to_epoch(date_string):
+    """
+    Convert the start of a day in the user timezone to seconds since the epoch, to compare with the UTC start times.
+    :param date_string: (str) The date in YYYY-MM-DD format.
+    :return: (int) The seconds since the epoch at midnight of the date.
+    """
+    midnight = datetime.strptime(date_string, '%Y-%m-%d').replace(tzinfo=ZoneInfo(Config.USER_TIMEZONE))
+    return int(midnight.timestamp())
+
+
+def apply_activity_filters(query, activity_filters):
+    """
+    Apply the filters chosen on the activities page to a query. Empty start and end dates are set to the first and last
+    activity dates, in activity_filters as well, so the date pickers show the range that was used.
+    :param query: (Query) The query of the Activity table to filter.
+    :param activity_filters: (dict) The filter form data saved in the session by the activities page.
+    :return: (Query) The filtered query.
+    """
+    if not activity_filters:
+        return query
+
+    date_format = '%Y-%m-%d'
+
+    # Fix empty dates with the cached first and last start times. Without activities there is no first or last date, and
+    # the date stays empty.
+    if not activity_filters.get('start-date') or not activity_filters.get('end-date'):
+        first_start_time, last_start_time = get_activity_filter_bounds()['start_time_utc']
+
+        if not activity_filters.get('start-date') and first_start_time is not None:
+            activity_filters['start-date'] = to_local_time(first_start_time).split(' ')[0]
+
+        if not activity_filters.get('end-date') and last_start_time is not None:
+            activity_filters['end-date'] = to_local_time(last_start_time).split(' ')[0]
+
+    start_date = activity_filters.get('start-date')
+    end_date = activity_filters.get('end-date')
+
+    # Ensure valid date range
+    if start_date and end_date and start_date > end_date:
+        start_date = activity_filters['start-date'] = end_date
 
-    # Namespaces in TCX files
-    ns = {'tcx': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'}
+    # Build dynamic filters
+    filters = {}
 
-    trackpoints = []
-    for tp in root.findall('.//tcx:Trackpoint', ns):
-        tcx_time = tp.find('tcx:Time', ns)
-        position = tp.find('tcx:Position', ns)
+    if activity_filters.get('type-options') not in [None, 'All']:
+        filters['activity_type'] = activity_filters['type-options']
 
-        if tcx_time is not None and position is not None:
-            timestamp = datetime.fromisoformat(tcx_time.text.replace("Z", "+00:00"))
-            lat = float(position.find('tcx:LatitudeDegrees', ns).text)
-            lon = float(position.find('tcx:LongitudeDegrees', ns).text)
+    if activity_filters.get('gear-options') not in [None, 'All']:
+        filters['activity_gear'] = activity_filters['gear-options']
 
-            trackpoints.append((timestamp, lat, lon))
+    if activity_filters.get('commute') == 'commute':
+        filters['commute'] = 1
 
-    return trackpoints
+    # Apply filters
+    query = query.filter_by(**filters)
+
+    if start_date:
+        query = query.filter(Activity.start_time_utc >= local_date_to_epoch(start_date))
+
+    if end_date:
+        # Extend end date by 1 day
+        end_date_str = (datetime.strptime(end_date, date_format) + timedelta(days=1)).strftime(date_format)
+        query = query.filter(Activity.start_time_utc < local_date_to_epoch(end_date_str))
+
+    # Only keep the activities whose name or description match the search box.
+    search_matches = get_activity_search_matches(activity_filters.get('activity-search'))
+    if search_matches is not None:
+        query = query.join(search_matches, Activity.id == search_matches.c.activity_id)
+
+    # Example numeric filters (safe checks)
+    if activity_filters.get('more-than-distance'):
+        query = query.filter(Activity.distance >= activity_filters['more-than-distance'])
+
+    if activity_filters.get('less-than-distance'):
+        query = query.filter(Activity.distance <= activity_filters['less-than-distance'])
+
+    if any(activity_filters.get(f'more-than-{unit}') for unit in ['hours', 'minutes', 'seconds']):
+        query = query.filter(Activity.duration_seconds >= convert_time_to_seconds(
+            activity_filters.get('more-than-seconds'),
+            activity_filters.get('more-than-minutes'),
+            activity_filters.get('more-than-hours')
+        ))
+
+    if any(activity_filters.get(f'less-than-{unit}') for unit in ['hours', 'minutes', 'seconds']):
+        query = query.filter(Activity.duration_seconds <= convert_time_to_seconds(
+            activity_filters.get('less-than-seconds'),
+            activity_filters.get('less-than-minutes'),
+            activity_filters.get('less-than-hours')
+        ))
+
+    return query
+
+
+def query_activity_filter_bounds():
+    """
+    Read the minimum and maximum of each filter on the activities page with one aggregate query, and the activity types
+    and gear for the dropdown boxes with one query each.
+    :return: (dict) The filter ranges (with the same keys as the filter form), the first and last start time in
+    seconds since the epoch (None without activities), the activity types, and the activity gear.
+    """
+    bounds = db.session.query(
+        func.min(Activity.distance),
+        func.max(Activity.distance),
+        func.min(Activity.elevation_gain),
+        func.max(Activity.elevation_gain),
+        func.min(Activity.highest_elevation),
+        func.max(Activity.highest_elevation),
+        func.min(Activity.duration_seconds),
+        func.max(Activity.duration_seconds),
+        func.min(Activity.average_speed),
+        func.max(Activity.average_speed),
+        func.min(Activity.max_speed),
+        func.max(Activity.max_speed),
+        func.min(Activity.start_time_utc),
+        func.max(Activity.start_time_utc),
+    ).one()
+
+    shortest_activity_duration_split = split_seconds(bounds[6] or 0)
+    longest_activity_duration_split = split_seconds(bounds[7] or 0)
+
+    return {
+        'ranges': {
+            'more-than-distance': bounds[0],
+            'less-than-distance': bounds[1],
+            'more-than-elevation-gain': bounds[2],
+            'less-than-elevation-gain': bounds[3],
+            'more-than-highest-elevation': bounds[4],
+            'less-than-highest-elevation': bounds[5],
+            'more-than-hours': shortest_activity_duration_split[0],
+            'more-than-minutes': shortest_activity_duration_split[1],
+            'more-than-seconds': shortest_activity_duration_split[2],
+            'less-than-hours': longest_activity_duration_split[0],
+            'less-than-minutes': longest_activity_duration_split[1],
+            'less-than-seconds': longest_activity_duration_split[2],
+            'more-than-average-speed': bounds[8],
+            'less-than-average-speed': bounds[9],
+            'more-than-max-speed': bounds[10],
+            'less-than-max-speed': bounds[11],
+        },
+        # Saved in UTC, so a change of the user timezone applies without reading them again.
+        'start_time_utc': (bounds[12], bounds[13]),
+        'activity_types': [
+            row.activity_type for row in
+            Activity.query.with_entities(Activity.activity_type).group_by(Activity.activity_type).all()
+        ],
+        'activity_gear': [
+            row.activity_gear for row in
+            Activity.query.with_entities(Activity.activity_gear).group_by(Activity.activity_gear).all()
+        ],
+    }
+
+
+def get_activity_filter_bounds():
+    """
+    Get the filter ranges and dropdown options of the activities page from the app level cache. They only change when
+    activities are imported, so they are read from the database once after each import.
+    :return: (dict) The result of query_activity_filter_bounds().
+    """
+    return cached('activity_filter_bounds', query_activity_filter_bounds)
+
+
+def get_filter_signature(activity_filters):
+    """
+    Build a key for a set of filters on the activities page, used to cache the values calculated from the filtered
+    activities.
+    :param activity_filters: (dict) The filters used by the query.
+    :return: (str) The filters as a JSON string with sorted keys.
+    """
+    return json.dumps(activity_filters, sort_keys=True, default=str)
+
+
+def query_filtered_activity_totals(query):
+    """
+    Calculate the totals row of the activities page with one aggregate query over the filtered activities. The average
+    speed is weighted by moving time (the total distance over the total moving time of the activities that have one),
+    so long activities count more than short ones. The elapsed time (duration_seconds) is used for the activities
+    without a moving time.
+    :param query: (Query) The filtered query of the Activity table.
+    :return: (dict) The count, distance, elapsed and moving time in seconds, elevation gain, average speed, and max
+    speed.
+    """
+    filtered = query.order_by(None).subquery()
+    moving_time = func.coalesce(func.nullif(filtered.c.moving_time_seconds, 0), filtered.c.duration_seconds)
+    moving_distance = func.sum(case((moving_time > 0, filtered.c.distance)))
+    moving_seconds = func.sum(case((moving_time > 0, moving_time)))
+
+    totals = db.session.query(
+        func.count(filtered.c.id).label('count'),
+        func.coalesce(func.sum(filtered.c.distance), 0).label('distance'),
+        func.coalesce(func.sum(filtered.c.duration_seconds), 0).label('duration_seconds'),
+        func.coalesce(moving_seconds, 0).label('moving_seconds'),
+        func.coalesce(func.sum(filtered.c.elevation_gain), 0).label('elevation_gain'),
+        (moving_distance * 3600.0 / moving_seconds).label('average_speed'),
+        func.max(filtered.c.max_speed).label('max_speed'),
+    ).one()
+
+    return totals._asdict()
+
+
+def get_filtered_activity_totals(query, activity_filters):
+    """
+    Get the totals row of the activities page from the app level cache, so the aggregate query is only run once for
+    each set of filters instead of on every page. The count is also used for the pagination.
+    :param query: (Query) The filtered query of the Activity table.
+    :param activity_filters: (dict) The filters used by the query.
+    :return: (dict) The result of query_filtered_activity_totals().
+    """
+    return cached(
+        f'activity_totals:{get_filter_signature(activity_filters)}',
+        lambda: query_filtered_activity_totals(query)
+    )
+
+
+def encode_page_cursor(value, activity_id):
+    """
+    Build the cursor of a page boundary on the activities page from the sort value and id of the activity at the
+    boundary.
+    :param value: The sort column value of the first or last activity of the page.
+    :param activity_id: (int) The id of the first or last activity of the page.
+    :return: (str) The URL safe cursor.
+    """
+    if isinstance(value, datetime):
+        value = value.isoformat()
+
+    return base64.urlsafe_b64encode(json.dumps([value, activity_id]).encode()).decode()
+
+
+def decode_page_cursor(cursor, sort_column):
+    """
+    Read the sort value and id from a cursor made by encode_page_cursor().
+    :param cursor: (str) The cursor from the page URL.
+    :param sort_column: (Column) The column the activities are sorted by.
+    :return: (tuple) The sort value and the activity id, or None if the cursor is not valid.
+    """
+    try:
+        value, activity_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if value is not None and isinstance(sort_column.type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        return value, int(activity_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def apply_keyset_pagination(query, sort_column, descending, cursor=None, before=False):
+    """
+    Sort a query by a column and the activity id, and keep only the activities after (or before) a cursor. Seeking to
+    the cursor uses the index on the sort column, so every page takes the same time instead of reading and skipping
+    every earlier row like an OFFSET does. SQLite sorts NULL values first, so activities without a value are the first
+    ones in ascending order and the last ones in descending order.
+    :param query: (Query) The filtered query of the Activity table.
+    :param sort_column: (Column) The column to sort by.
+    :param descending: (bool) True to sort from the highest to the lowest value.
+    :param cursor: (tuple) The sort value and id of the boundary activity from decode_page_cursor(), or None for the
+    first page.
+    :param before: (bool) True to get the activities before the cursor, in reverse order, for the previous page.
+    :return: (Query) The sorted query.
+    """
+    # Going back a page walks the same order backwards from the cursor.
+    backwards = descending != before
+    if cursor is not None:
+        value, activity_id = cursor
+        id_after_cursor = Activity.id < activity_id if backwards else Activity.id > activity_id
+
+        if value is None:
+            # The cursor is in the NULL values, which come before every other value in ascending order.
+            seek = and_(sort_column.is_(None), id_after_cursor)
+            if not backwards:
+                seek = or_(seek, sort_column.isnot(None))
+        else:
+            value_after_cursor = sort_column < value if backwards else sort_column > value
+            seek = or_(value_after_cursor, and_(sort_column == value, id_after_cursor))
+            if backwards:
+                seek = or_(seek, sort_column.is_(None))
+
+        query = query.filter(seek)
+
+    if backwards:
+        return query.order_by(desc(sort_column), desc(Activity.id))
+    return query.order_by(asc(sort_column), asc(Activity.id))
+
+
+def query_activity_charts(query):
+    """
+    Prepare the summary charts of the activities page with Plotly, from one aggregate query that totals the filtered
+    activities by month and one that counts them by activity type. The moving time of an activity without one is its
+    elapsed time.
+    :param query: (Query) The filtered query of the Activity table, from apply_activity_filters().
+    :return: (str) A JSON object with the figure data of each chart, keyed by the id of the chart on the page.
+    """
+    month = func.strftime('%Y-%m', Activity.local_start_time).label('month')
+    monthly_totals = (
+        query.order_by(None)
+        .with_entities(
+            month,
+            func.sum(func.coalesce(func.nullif(Activity.moving_time_seconds, 0), Activity.duration_seconds)),
+            func.sum(Activity.distance),
+            func.avg(Activity.average_speed),
+            func.max(Activity.max_speed),
+            func.sum(Activity.elevation_gain),
+        )
+        .group_by(month)
+        .order_by(month)
+        .all()
+    )
+    months = [row[0] for row in monthly_totals]
+
+    def monthly_chart(values, title, y_axis_title):
+        fig = go.Figure(go.Scatter(x=months, y=values, mode='lines+markers'))
+        fig.update_layout(title=title, xaxis_title='Month', yaxis_title=y_axis_title)
+        return fig
+
+    type_counts = (
+        query.order_by(None)
+        .with_entities(Activity.activity_type, func.count(Activity.id))
+        .group_by(Activity.activity_type)
+        .all()
+    )
+    activity_type_fig = go.Figure(go.Pie(
+        labels=[row[0] for row in type_counts],
+        values=[row[1] for row in type_counts]
+    ))
+    activity_type_fig.update_layout(title='Activity Type')
+
+    charts = {
+        'moving-time-plot': monthly_chart(
+            [(row[1] or 0) / 3600 for row in monthly_totals], 'Moving Time per Month', 'Hours'
+        ),
+        'distance-plot': monthly_chart([row[2] for row in monthly_totals], 'Distance per Month', 'Distance'),
+        'avg-speed-plot': monthly_chart(
+            [row[3] for row in monthly_totals], 'Average Speed per Month', 'Average Speed'
+        ),
+        'max-speed-plot': monthly_chart([row[4] for row in monthly_totals], 'Max Speed per Month', 'Max Speed'),
+        'elevation-gain-plot': monthly_chart(
+            [row[5] for row in monthly_totals], 'Elevation Gain per Month', 'Elevation Gain'
+        ),
+        'activity-type-plot': activity_type_fig,
+    }
+    return json.dumps(charts, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def get_activity_totals(period, group_by=None, activity_type=None, activity_gear=None):
+    """
+    Read the activity totals from the activity_total table, which has one row per period, activity type and gear, so
+    the query reads one row per period instead of every activity. The all time totals are the sum of the yearly rows.
+    :param period: (str) week, month, year or all.
+    :param group_by: (str) activity_type or activity_gear to keep the totals of each type or gear apart, or None to add
+    them together.
+    :param activity_type: (str) Only include this activity type, or None for every type.
+    :param activity_gear: (str) Only include this gear, or None for all gear.
+    :return: (list) A dict for each row with the period start (for the weekly, monthly, and yearly totals), the group,
+    count, distance, moving time in seconds, elevation gain, and max speed.
+    """
+    group_columns = []
+    if period != 'all':
+        group_columns.append(ActivityTotal.period_start)
+    if group_by is not None:
+        group_columns.append(getattr(ActivityTotal, group_by))
+
+    query = db.session.query(
+        *group_columns,
+        func.sum(ActivityTotal.count).label('count'),
+        func.sum(ActivityTotal.distance).label('distance'),
+        func.sum(ActivityTotal.moving_seconds).label('moving_seconds'),
+        func.sum(ActivityTotal.elevation_gain).label('elevation_gain'),
+        func.max(ActivityTotal.max_speed).label('max_speed'),
+    ).filter(ActivityTotal.period == ('year' if period == 'all' else period))
+
+    if activity_type is not None:
+        query = query.filter(ActivityTotal.activity_type == activity_type)
+    if activity_gear is not None:
+        query = query.filter(ActivityTotal.activity_gear == activity_gear)
+
+    return [row._asdict() for row in query.group_by(*group_columns).order_by(*group_columns).all()]
+
+
+def generate_activity_export(query, export_format):
+    """
+    Generate the rows of the activity export a few at a time. The rows are read with yield_per, so only
+    Config.EXPORT_BATCH_SIZE activities are in memory at once, and each batch is sent as soon as it is read.
+    :param query: (Query) The filtered query of the Activity table.
+    :param export_format: (str) ndjson or csv.
+    :return: (generator) The export as chunks of text.
+    """
+    statement = (
+        query.order_by(desc(Activity.start_time_utc), desc(Activity.id))
+        .with_entities(*[getattr(Activity, column) for column in Config.EXPORT_COLUMNS])
+        .statement
+    )
+    rows = db.session.execute(statement, execution_options={'yield_per': Config.EXPORT_BATCH_SIZE})
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == 'csv':
+        writer.writerow(Config.EXPORT_COLUMNS)
+
+    for batch in rows.partitions():
+        for row in batch:
+            if export_format == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(Config.EXPORT_COLUMNS, row)), default=str) + '\n')
+
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def query_activity_page(query, sort_column, per_page):
+    """
+    Read one page of the activities table. Only the columns shown in the table are selected, and the rows are read
+    with a Core statement, so they come back as plain rows instead of Activity instances that are added to the session
+    and tracked for changes.
+    :param query: (Query) The filtered and sorted query of the Activity table, from apply_keyset_pagination().
+    :param sort_column: (Column) The column the activities are sorted by, returned as sort_value for the page cursors.
+    :param per_page: (int) The number of activities on the page.
+    :return: (list) The rows, with the Config.LISTING_COLUMNS and sort_value as attributes.
+    """
+    statement = (
+        query.with_entities(
+            *[getattr(Activity, column) for column in Config.LISTING_COLUMNS],
+            sort_column.label('sort_value')
+        )
+        .limit(per_page)
+        .statement
+    )
+    return db.session.execute(statement).all()
+
+
+def get_heart_rate_zone_totals(query):
+    """
+    Get the total time spent in each heart rate zone by the activities of a query, with one SUM over the
+    heart_rate_zone_time table.
+    :param query: (Query) The query of the Activity table, for example from apply_activity_filters().
+    :return: (list) The seconds spent below zone 1 and in zones 1 to 5.
+    """
+    zone_seconds = dict(
+        query.order_by(None)
+        .join(HeartRateZoneTime)
+        .with_entities(HeartRateZoneTime.zone, func.sum(HeartRateZoneTime.seconds))
+        .group_by(HeartRateZoneTime.zone)
+        .all()
+    )
+
+    return [zone_seconds.get(zone, 0) for zone in range(6)]
+
+
+def get_zone_times_for_filtered_activities():
+    """
+    Get the time spent in each heart rate zone by the activities that match the filters on the activities page, or by
+    every activity if no filters are set.
+    :return: (list) The time below zone 1 and in zones 1 to 5 in HH:MM:SS format.
+    """
+    query = apply_activity_filters(Activity.query, session.get('filters', {}))
+    return [Database.convert_seconds_to_time_format(seconds) for seconds in get_heart_rate_zone_totals(query)]
+
+
+def generate_heart_rate_zone_plot(zone_seconds, title):
+    """
+    Prepare a bar chart of the time spent in each heart rate zone with Plotly.
+    :param zone_seconds: (list) The seconds spent below zone 1 and in zones 1 to 5, from get_heart_rate_zone_totals().
+    :param title: (str) The title of the chart.
+    :return: A JSON object with the plot figure data.
+    """
+    with timed('figures'):
+        fig = go.Figure()
+        fig.add_trace(go.Bar(
+            x=['Below Zone 1', 'Zone 1', 'Zone 2', 'Zone 3', 'Zone 4', 'Zone 5'],
+            y=[seconds / 60 for seconds in zone_seconds],
+            text=[Database.convert_seconds_to_time_format(seconds) for seconds in zone_seconds],
+            name=title
+        ))
+        fig.update_layout(title=title, yaxis_title='Minutes', xaxis_title='Heart Rate Zone')
+    with timed('json'):
+        return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
 
 
 def decompress_gz_file(input_file_path_and_name):
@@ -262,16 +1116,11 @@ def get_activity_tcx_file(activity_id, filepath, activity_data):
     data in the data_dict and return it.
     :param activity_id: (str) The activity id of the tcx activity.
     :param filepath: (str) The filepath of uploads folder, where activity files are stored.
+    :param activity_data: (Activity) The activity, already read by the activity page.
     :return data_dict: (dict) A dictionary of info for the tcx activity graphs.
     """
-
-    data_dict = {}
-    activity_dict = {}
-    speed_list = []
     file_is_found = False
 
-    activity_data = Activity.query.filter_by(strava_activity_id=activity_id).first()
-
     if activity_data is None:
         print(f'No activity found for strava_activity_id={activity_id}')
         return {}
@@ -282,187 +1131,25 @@ def get_activity_tcx_file(activity_id, filepath, activity_data):
     input_file_path = f'{filepath}/{sub_dir}'
 
     # Linear search for file
-    for file in os.listdir(input_file_path):
-        if file == filename:
-            file_is_found = True
-            filepath = os.path.join(input_file_path, file)
-            decompress_gz_file(filepath)
-            break  # Stop searching once the file is found.
+    with timed('locate'):
+        for file in os.listdir(input_file_path):
+            if file == filename:
+                file_is_found = True
+                filepath = os.path.join(input_file_path, file)
+                break  # Stop searching once the file is found.
 
     if file_is_found:
+        with timed('decompress'):
+            decompress_gz_file(filepath)
         xml_filename = Config.DECOMPRESSED_ACTIVITY_FILES_FOLDER + '/' + filepath.split('/')[-1].split('.gz')[0]
-        modify_tcx_file(xml_filename)
-        with open(xml_filename, 'r') as f:
-            tcx = tcxparser.TCXParser(f)
-
-            # Get activity data points
-            altitude_list = [int(convert_meters_to_feet(alt_point)) for alt_point in tcx.altitude_points()]
-            distance_list = [float(convert_meter_to_mile(value)) for value in tcx.distance_values()]
-            time_list = tcx.time_values()
-            hr_list = tcx.hr_values()
-            position_list = tcx.position_values()
-            cadence_list = tcx.cadence_values()
-            power_list = tcx.power_values()
-
-            # Make all the other lists the same length as the time_list by appending their last data point to the list
-            # repeatedly until it is the same length as the time_list.
-            if len(time_list) > 0:
-
-                # Check if the altitude list is the same length as the time_list, if not, then make it the same length,
-                # if it has any data in it.
-                while len(altitude_list) < len(time_list):
-                    if len(altitude_list) > 0:
-                        altitude_list.append(altitude_list[-1])
-                    else:
-                        altitude_list.append(0)
-
-                activity_dict['elevation'] = {'x': distance_list, 'y': altitude_list}
-
-                # Check if the distance list is the same length as the time_list, if not, then make it the same length,
-                # if it has any data in it.
-                while len(distance_list) < len(time_list):
-                    if len(distance_list) > 0:
-                        distance_list.append(distance_list[-1])
-                    else:
-                        distance_list.append(0)
 
-                # Create the speed list
-                tcx_file = xml_filename
-                trackpoints = parse_tcx(tcx_file)
-                # data_dict['trackpoints'] = trackpoints
-                speed_list = calculate_speed(trackpoints)
+        with timed('parse'):
+            modify_tcx_file(xml_filename)
+            samples = read_tcx_file(xml_filename)
+        with timed('convert'):
+            sample_frame = clean_sample_frame(samples, activity_type)
 
-                while len(speed_list) < len(time_list):
-                    if len(speed_list) > 0:
-                        speed_list.append(speed_list[-1])
-                    else:
-                        speed_list.append(0)
-
-                if activity_type in Config.INDOOR_ACTIVITIES:
-                    activity_dict['speed_indoor'] = {'x': time_list, 'y': speed_list}
-                else:
-                    activity_dict['speed'] = {'x': distance_list, 'y': speed_list}
-
-                # Check if the heartrate list is the same length as the time_list, if not, then make it the same length,
-                # if it has any data in it.
-                while len(hr_list) < len(time_list):
-                    if len(hr_list) > 0:
-                        hr_list.append(hr_list[-1])
-                    else:
-                        hr_list.append(0)
-
-                if activity_type in Config.INDOOR_ACTIVITIES:
-                    activity_dict['heart_rate_indoor'] = {'x': time_list, 'y': hr_list}
-                else:
-                    activity_dict['heart_rate'] = {'x': distance_list, 'y': hr_list}
-
-                # Check if the position list is the same length as the time_list, if not, then make it the same length,
-                # if it has any data in it.
-                while len(position_list) < len(time_list):
-                    if len(position_list) > 0:
-                        position_list.append(position_list[-1])
-                    else:
-                        position_list.append(0)
-
-                # Check if the cadence list is the same length as the time_list, if not, then make it the same length,
-                # if it has any data in it.
-                while len(cadence_list) < len(time_list):
-                    if len(cadence_list) > 0:
-                        cadence_list.append(cadence_list[-1])
-                    else:
-                        cadence_list.append(0)
-
-                if activity_type in Config.INDOOR_ACTIVITIES:
-                    activity_dict['cadence_indoor'] = {'x': time_list, 'y': cadence_list}
-                else:
-                    activity_dict['cadence'] = {'x': distance_list, 'y': cadence_list}
-
-                # Check if the power list is the same length as the time_list, if not, then make it the same length,
-                # if it has any data in it.
-                while len(power_list) < len(time_list):
-                    if len(power_list) > 0:
-                        power_list.append(power_list[-1])
-                    else:
-                        power_list.append(0)
-
-            if activity_type in Config.INDOOR_ACTIVITIES:
-                activity_dict['power_indoor'] = {'x': time_list, 'y': power_list}
-            else:
-                activity_dict['power'] = {'x': distance_list, 'y': power_list}
-
-            if 'heart_rate' in activity_dict and np.average(hr_list) > 0:
-                data_dict['heart_rate'] = generate_plot(
-                    activity_dict['heart_rate'],
-                    'Heart Rate',
-                    'BPM',
-                    'Distance'
-                )
-
-            if 'heart_rate_indoor' in activity_dict and np.average(hr_list) > 0:
-                data_dict['heart_rate'] = generate_plot(
-                    activity_dict['heart_rate_indoor'],
-                    'Heart Rate',
-                    'BPM',
-                    'Time'
-                )
-
-            if 'speed' in activity_dict and np.average(speed_list) > 0:
-                data_dict['speed'] = generate_plot(
-                    activity_dict['speed'],
-                    'Speed',
-                    'MPH',
-                    'Distance'
-                )
-
-            if 'speed_indoor' in activity_dict and np.average(speed_list) > 0:
-                data_dict['speed'] = generate_plot(
-                    activity_dict['speed_indoor'],
-                    'Speed',
-                    'MPH',
-                    'Time'
-                )
-
-            if np.average(altitude_list) > 0:
-                data_dict['elevation'] = generate_plot(
-                    activity_dict['elevation'],
-                    'Elevation',
-                    'Feet',
-                    'Distance'
-                )
-
-            if 'cadence' in activity_dict and np.average(cadence_list) > 0:
-                data_dict['cadence'] = generate_plot(
-                    activity_dict['cadence'],
-                    'Cadence',
-                    'RPM',
-                    'Distance'
-                )
-
-            if 'cadence_indoor' in activity_dict and np.average(cadence_list) > 0:
-                data_dict['cadence'] = generate_plot(
-                    activity_dict['cadence_indoor'],
-                    'Cadence',
-                    'RPM',
-                    'Time'
-                )
-
-            if 'power' in activity_dict and np.average(power_list) > 0:
-                data_dict['power'] = generate_plot(
-                    activity_dict['power'],
-                    'Power',
-                    'Watts',
-                    'Distance'
-                )
-
-            if 'power_indoor' in activity_dict and np.average(power_list) > 0:
-                data_dict['power'] = generate_plot(
-                    activity_dict['power_indoor'],
-                    'Power',
-                    'Watts',
-                    'Time'
-                )
-
-            return data_dict
+        return generate_activity_plots(sample_frame, activity_type)
 
     else:
         print('The file was not found. :-(')
@@ -473,14 +1160,9 @@ def get_activity_gpx_file(activity_id, filepath, activity_data):
     data_dict and return it.
     :param activity_id: (datatype: str) The activity_id of the activity associated with the .gpx file.
     :param filepath: (datatype: str) The filepath to the .gpx file.
+    :param activity_data: (datatype: Activity) The activity, already read by the activity page.
     :return: data_dict: (datatype: dict) A dictionary with the data to be plotted.
     """
-    data_dict = {}
-    activity_dict = {}
-
-    activity_data = Activity.query.filter_by(strava_activity_id=activity_id).first()
-    print(f'activity_data is: {activity_data}')
-
     if activity_data is None:
         print(f'No activity found for activity_id={activity_id}')
         return {}
@@ -490,112 +1172,12 @@ def get_activity_gpx_file(activity_id, filepath, activity_data):
     filename = f'{activity_id}.gpx'
     input_file_path = f'{filepath}/activities/{filename}'
 
-    with open(input_file_path, 'r') as f:
-        gpx = gpxpy.parse(f)
-
-    for track in gpx.tracks:
-        for segment in track.segments:
-
-            # start_time = segment.points[0].time
-            elapsed_time = 0
-            time_list = []
-            speed_list = []
-            distance_list = []
-            hr_list = []
-            total_distance = 0
-
-            for data_point in range(0, len(segment.points)):
-                point1 = segment.points[data_point - 1]
-                point2 = segment.points[data_point]
-
-                try:
-                    hr_list.append(
-                        [int(el.text) for el in segment.points[data_point].extensions[0] if 'hr' in el.tag][0]
-                    )
-                except IndexError as e:
-                    message = f'No heart rate data was found.'
-
-                if data_point == 0:
-                    distance = 0
-                else:
-                    # Calculate distance, in meters, between the current GPS point and the previous using haversine
-                    # formula
-                    distance = point1.distance_2d(point2)
-
-                # Calculate overall distance, in meters, between the current GPS point and the starting point using
-                # haversine formula, then convert it from meters to miles.
-                total_distance += distance
-                distance_list.append(convert_meter_to_mile(total_distance))
-
-                # Calculate time difference between two points
-                time_diff = point2.time - point1.time
-
-                # Calculate speed in m/s and then convert it to mi/h
-                if time_diff.total_seconds() > 0:
-                    speed_list.append(convert_meters_per_second_to_miles_per_hour(distance / time_diff.total_seconds()))
-                    elapsed_time += time_diff.total_seconds()
-                else:
-                    speed_list.append(0)
-
-                time_list.append(str(timedelta(seconds=elapsed_time)))
-
-            if activity_type in Config.INDOOR_ACTIVITIES:
-                activity_dict['heart_rate_indoor'] = {'x': time_list, 'y': hr_list}
-            else:
-                activity_dict['heart_rate'] = {'x': distance_list, 'y': hr_list}
-
-            if np.average(hr_list) > 0:
-                if 'heart_rate_indoor' in activity_dict:
-                    data_dict['heart_rate'] = generate_plot(
-                        activity_dict['heart_rate_indoor'],
-                        'Heart Rate',
-                        'BPM',
-                        'Time'
-                    )
-
-                if 'heart_rate' in activity_dict:
-                    data_dict['heart_rate'] = generate_plot(
-                        activity_dict['heart_rate'],
-                        'Heart Rate',
-                        'BPM',
-                        'Distance'
-                    )
-
-            if activity_type in Config.INDOOR_ACTIVITIES:
-                activity_dict['speed_indoor'] = {'x': time_list, 'y': speed_list}
-            else:
-                activity_dict['speed'] = {'x': distance_list, 'y': speed_list}
-
-            if np.average(speed_list) > 0:
-                if 'speed_indoor' in activity_dict:
-                    data_dict['speed'] = generate_plot(
-                        activity_dict['speed_indoor'],
-                        'Speed',
-                        'MPH',
-                        'Time'
-                    )
-                if 'speed' in activity_dict:
-                    data_dict['speed'] = generate_plot(
-                        activity_dict['speed'],
-                        'Speed',
-                        'MPH',
-                        'Distance'
-                    )
-
-            activity_dict['elevation'] = {
-                'x': distance_list,
-                'y': [convert_meters_to_feet(point.elevation) for point in segment.points]
-            }
-
-            if activity_type not in Config.INDOOR_ACTIVITIES:
-                data_dict['elevation'] = generate_plot(
-                    activity_dict['elevation'],
-                    'Elevation',
-                    'Feet',
-                    'Distance'
-                )
+    with timed('parse'), open(input_file_path, 'r') as f:
+        samples = read_gpx_file(f)
+    with timed('convert'):
+        sample_frame = clean_sample_frame(samples, activity_type)
 
-    return data_dict
+    return generate_activity_plots(sample_frame, activity_type)
 
 def get_activity_fit_file(activity_id, filepath, activity_data):
     """
@@ -608,18 +1190,6 @@ def get_activity_fit_file(activity_id, filepath, activity_data):
     :param activity_data: (datatype: )
     :return: data_dict: (datatype: dict) A dictionary with the data to be plotted.
     """
-    time_list = []
-    distance_list = []
-    altitude_list = []
-    speed_list = []
-    hr_list = []
-    cadence_list = []
-    temperature_list = []
-    power_list = []
-    data_dict = {}
-    count = 0
-    activity_dict = {}
-
     #~~~~~~~~~~~~~~~~~ Troubleshooting ~~~~~~~~~~~~~~~~~~~~~~~~~~
     activity_id = int(activity_id)
 
@@ -667,16 +1237,15 @@ def get_activity_fit_file(activity_id, filepath, activity_data):
     #         filepath = os.path.join(input_file_path, file)
     #         break  # Stop searching once the file is found.
     if source == 'garmin':
-        zip_path = Path(filepath)
-
-        # Extract contents directly to the zip file's parent directory
-        with ZipFile(zip_path, "r") as zip_ref:
-            zip_ref.extractall(zip_path.parent)
+        # Build the complete path to the FIT file, in a folder named after the zip file it is stored in.
+        full_path = os.path.join(filepath[:-4], filename_path)
 
-        print(f"Successfully extracted to: {zip_path.parent}")
+        # Extract only this FIT file, the first time the activity is shown or when the import warmed the cache.
+        if not os.path.exists(full_path):
+            with timed('unzip'), ZipFile(filepath, "r") as zip_ref:
+                zip_ref.extract(filename_path, filepath[:-4])
 
-        # Build the complete path to the FIT file
-        full_path = os.path.join(filepath[:-4], filename_path)
+            print(f"Successfully extracted {filename_path} to: {filepath[:-4]}")
 
     else:
         full_path = os.path.join(filepath, filename_path)
@@ -690,10 +1259,8 @@ def get_activity_fit_file(activity_id, filepath, activity_data):
             f"FIT file not found for {source} activity {activity_id}: {full_path}"
         )
 
-    # Decompress .fit.gz files if necessary
+    # Decompress .fit.gz files if necessary. The decompressed file is kept, so it is only decompressed once.
     if filename_path.endswith(".gz"):
-        decompress_gz_file(full_path)
-
         # Remove .gz from the filename
         decompressed_filename = os.path.basename(filename_path)[:-3]
 
@@ -701,272 +1268,22 @@ def get_activity_fit_file(activity_id, filepath, activity_data):
             Config.DECOMPRESSED_ACTIVITY_FILES_FOLDER,
             decompressed_filename
         )
+
+        if not os.path.exists(output_file):
+            with timed('decompress'):
+                decompress_gz_file(full_path)
     else:
         # File is already a .fit file
         output_file = full_path
 
     print(f"Reading FIT file: {output_file}")
 
-    fitFile = FitFile(output_file)
-
-    # for lap in fitFile.get_messages('session'):
-    #     print('Lap:')
-    #     for lap_info in lap:
-    #         print(f'{lap_info.name} - {lap_info.value}')
-
-    try:
-        for record in fitFile.get_messages("record"):
-            for data in record:
-                if data.name == 'timestamp':
-                    count += 1
-                    if count == 1:
-                        initial_time = data.value
-                    elapsed_time = (data.value - initial_time).total_seconds()
-                    time_list.append(Database.convert_seconds_to_time_format(elapsed_time))
-
-                # Append activity distance to the distance_list
-                if data.name == 'distance':
-                    try:
-                        distance = convert_meter_to_mile(data.value)
-                    except KeyError as e:
-                        if len(distance_list) > 0:
-                            distance_list.append(distance_list[-1])
-                        else:
-                            distance_list.append(0)
-                    else:
-                        if distance is None:
-                            distance_list.append(0)
-                        else:
-                            distance_list.append(distance)
-
-                # Append activity altitude to the altitude_list
-                if data.name == 'enhanced_altitude':
-                    try:
-                        altitude = round(convert_meters_to_feet(data.value), 2)
-                    except KeyError as e:
-                        print(f'ERROR: {e}. Skipping for now.')
-                        if len(altitude_list) > 0:
-                            altitude_list.append(altitude_list[-1])
-                    except IndexError as e:
-                        print(f'ERROR: {e}. Skipping for now.')
-                        if len(altitude_list) > 0:
-                            altitude_list.append(altitude_list[-1])
-                        else:
-                            altitude_list.append(0)
-                    else:
-                        if altitude is None:
-                            altitude_list.append(0)
-                        else:
-                            altitude_list.append(altitude)
-
-                # Append speed to the speed_list
-                if data.name == 'enhanced_speed':
-                    try:
-                        speed = convert_meters_per_second_to_miles_per_hour(data.value)
-                    except KeyError as e:
-                        print(f'ERROR: {e}. Skipping for now.')
-                        if len(speed_list) > 0:
-                            speed_list.append(speed_list[-1])
-                        else:
-                            speed_list.append(0)
-                    else:
-                        if speed is None:
-                            speed_list.append(0)
-                        else:
-                            speed_list.append(speed)
-
-                # Append activity heart_rate to the hr_list
-                if data.name == 'heart_rate':
-                    try:
-                        heart_rate = data.value
-                    except KeyError as e:
-                        print(f'ERROR: {e}. Skipping for now.')
-                        if len(hr_list) > 0:
-                            hr_list.append(hr_list[-1])
-                        else:
-                            hr_list.append(0)
-                    else:
-                        if heart_rate is None:
-                            hr_list.append(0)
-                        else:
-                            hr_list.append(heart_rate)
-
-                # Append activity cadence to the cadence_list
-                if data.name == 'cadence':
-                    try:
-                        cadence = data.value
-                    except KeyError as e:
-                        print(f'ERROR: {e}. Skipping for now.')
-                        if len(cadence_list) > 0:
-                            cadence_list.append(cadence_list[-1])
-                        else:
-                            cadence_list.append(0)
-                    else:
-                        if cadence is None:
-                            cadence_list.append(0)
-                        else:
-                            cadence_list.append(cadence)
-
-                # Append activity temperature to the temperature_list
-                if data.name == 'temperature':
-                    try:
-                        temperature = convert_celsius_to_fahrenheit(data.value)
-                    except KeyError as e:
-                        print(f'ERROR: {e}. Skipping for now.')
-                        if len(temperature_list) > 0:
-                            temperature_list.append(temperature_list[-1])
-                        else:
-                            temperature_list.append(0)
-                    else:
-                        if temperature is None:
-                            temperature_list.append(0)
-                        else:
-                            temperature_list.append(temperature)
-
-                # Append activity power to the power_list
-                if data.name == 'power':
-                    try:
-                        power = data.value
-                    except KeyError as e:
-                        print(f'ERROR: {e}. Skipping for now.')
-                        if len(power_list) > 0:
-                            power_list.append(power_list[-1])
-                        else:
-                            power_list.append(0)
-                    else:
-                        if power is None:
-                            power_list.append(0)
-                        else:
-                            power_list.append(power)
-
-        if len(distance_list) != count:
-            distance_list.append(0)
-
-        if len(altitude_list) != count:
-            altitude_list.append(0)
-        activity_dict['elevation'] = {'x': distance_list, 'y': altitude_list}
-
-        if len(speed_list) != count:
-            speed_list.append(0)
-        activity_dict['speed'] = {'x': distance_list, 'y': speed_list}
-
-        if len(hr_list) != count:
-            hr_list.append(0)
-
-        if activity_type in Config.INDOOR_ACTIVITIES:
-            activity_dict['heart_rate_indoor'] = {'x': time_list, 'y': hr_list}
-        else:
-            activity_dict['heart_rate'] = {'x': distance_list, 'y': hr_list}
-
-        if len(cadence_list) != count:
-            cadence_list.append(0)
-
-        if activity_type in Config.INDOOR_ACTIVITIES:
-            activity_dict['cadence_indoor'] = {'x': time_list, 'y': cadence_list}
-        else:
-            activity_dict['cadence'] = {'x': distance_list, 'y': cadence_list}
-
-        if len(temperature_list) != count:
-            temperature_list.append(0)
-
-        if activity_type in Config.INDOOR_ACTIVITIES:
-            activity_dict['temperature_indoor'] = {'x': time_list, 'y': temperature_list}
-        else:
-            activity_dict['temperature'] = {'x': distance_list, 'y': temperature_list}
-
-        if len(power_list) != count:
-            power_list.append(0)
-
-        if activity_type in Config.INDOOR_ACTIVITIES:
-            activity_dict['power_indoor'] = {'x': time_list, 'y': power_list}
-        else:
-            activity_dict['power'] = {'x': distance_list, 'y': power_list}
-
-    # To handle: fitparse.utils.FitEOFError: Tried to read 1 bytes from .FIT file but got 0 (Issue #3 fix)
-    except FitEOFError as e:
-        print(f'FitEOFError is: {e}')
-
-    if 'speed' in activity_dict and np.average(speed_list) > 0:
-        data_dict['speed'] = generate_plot(
-            activity_dict['speed'],
-            'Speed',
-            'MPH',
-            'Distance'
-        )
+    with timed('parse'):
+        samples = read_fit_file(output_file)
+    with timed('convert'):
+        sample_frame = clean_sample_frame(samples, activity_type)
 
-    if 'elevation' in activity_dict and np.average(distance_list) > 0:
-        data_dict['elevation'] = generate_plot(
-            activity_dict['elevation'],
-            'Elevation',
-            'Ft',
-            'Distance'
-        )
-
-    if 'heart_rate' in activity_dict and np.average(hr_list) > 0:
-        data_dict['heart_rate'] = generate_plot(
-            activity_dict['heart_rate'],
-            'Heart Rate',
-            'BPM',
-            'Distance'
-        )
-
-    if 'heart_rate_indoor' in activity_dict and np.average(hr_list) > 0:
-        data_dict['heart_rate'] = generate_plot(
-            activity_dict['heart_rate_indoor'],
-            'Heart Rate',
-            'BPM',
-            'Time'
-        )
-
-    if 'cadence' in activity_dict and np.average(cadence_list) > 0:
-        data_dict['cadence'] = generate_plot(
-            activity_dict['cadence'],
-            'Cadence',
-            'RPM',
-            'Distance'
-        )
-
-    if 'cadence_indoor' in activity_dict and np.average(cadence_list) > 0:
-        data_dict['cadence'] = generate_plot(
-            activity_dict['cadence_indoor'],
-            'Cadence',
-            'Strokes Per Minute',
-            'Time'
-        )
-
-    if 'temperature' in activity_dict and np.average(temperature_list) > 0:
-        data_dict['temperature'] = generate_plot(
-            activity_dict['temperature'],
-            'Temperature',
-            'F',
-            'Distance'
-        )
-
-    if 'temperature_indoor' in activity_dict and np.average(temperature_list) > 0:
-        data_dict['temperature'] = generate_plot(
-            activity_dict['temperature_indoor'],
-            'Temperature',
-            'F',
-            'Time'
-        )
-
-    if 'power' in activity_dict and np.average(power_list) > 0:
-        data_dict['power'] = generate_plot(
-            activity_dict['power'],
-            'Power',
-            'Watts',
-            'Distance'
-        )
-
-    if 'power_indoor' in activity_dict and np.average(power_list) > 0:
-        data_dict['power'] = generate_plot(
-            activity_dict['power_indoor'],
-            'Power',
-            'Watts',
-            'Time'
-        )
-
-    return data_dict
+    return generate_activity_plots(sample_frame, activity_type)
 
 
 @main.route('/')
@@ -990,12 +1307,14 @@ def activity():
     :return: Renders the activities.html page.
     """
     page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', Config.PER_PAGE, type=int)
+    per_page = min(max(request.args.get('per_page', Config.PER_PAGE, type=int), 1), Config.MAX_PER_PAGE)
+    after = request.args.get('after')
+    before = request.args.get('before')
 
 
-    # Sort columns.
-    sort = request.args.get("sort", "start_time")
-    order = request.args.get("order", "desc")
+    # Sort columns. Search results are sorted by how well they match unless another sort is chosen.
+    sort = request.args.get("sort")
+    order = request.args.get("order")
 
     #============================================== Troubleshooting ====================================================
 
@@ -1028,7 +1347,6 @@ def activity():
     # for num, row in enumerate(rows):
     #     print(f'row {num + 1}: {row}')
     #
-    print('-' * 100)
 
     # print(f'Activity.query.first(): {Activity.query.first()}')
     # activities = Activity.query.limit(20).all()
@@ -1040,12 +1358,9 @@ def activity():
     # print(f'Activity.activity_duration: {Activity.activity_duration}')
     # print(f'type(Activity.activity_duration): {type(Activity.activity_duration)}')
     # print(f'db.session.query(Activity.activity_duration).limit(10).all(): {db.session.query(Activity.activity_duration).limit(10).all()}')
-    print(f'db.session.query(Activity.strava_filename).limit(10).all(): {db.session.query(Activity.strava_filename).limit(10).all()}')
-    print(f"Activity.__table__.columns['activity_duration'].type: {Activity.__table__.columns['activity_duration'].type}")
     # query = Activity.query.order_by(Activity.activity_duration)
     # print(f'query.statement: {query.statement}')
     # print(f'query.all()[:5]: {query.all()[:5]}')
-    print(f'Activity count from activity(): {Activity.query.count()}')
     # longest_activity = Activity.query.order_by(
     #     Activity.activity_duration.desc()
     # ).first()
@@ -1069,9 +1384,9 @@ def activity():
 
     # Define columns to sort by.
     column_map = {
-        'start_time': Activity.start_time,
+        'start_time': Activity.start_time_utc,
         'activity_name': Activity.activity_name,
-        'activity_duration': Activity.activity_duration,
+        'activity_duration': Activity.duration_seconds,
         'distance': Activity.distance,
         'average_speed': Activity.average_speed,
         'max_speed': Activity.max_speed,
@@ -1081,81 +1396,66 @@ def activity():
         # 'activity_gear': Activity.activity_gear,
     }
 
-    sort_column = column_map.get(sort, Activity.start_time)
-
     # Handle Filters. If request.method is POST, save, if the request.method is GET, reuse and clear the session filters.
+    # The next and previous page links keep the filters of the pages before them.
     if request.method == 'POST':
         session['filters'] = request.form.to_dict()
 
-    if request.method == 'GET':
+    if request.method == 'GET' and after is None and before is None:
         session.pop('filters', None)
 
     activity_filters = session.get('filters', {})
 
+    searching = build_search_query(activity_filters.get('activity-search')) is not None
+    if sort is None or (sort == 'relevance' and not searching):
+        sort = 'relevance' if searching else 'start_time'
+    if order is None:
+        order = 'asc' if sort == 'relevance' else 'desc'
+
+    if sort == 'relevance':
+        # The bm25 rank of the search matches joined by apply_activity_filters(), where lower is a better match.
+        sort_column = literal_column('activity_search_match.search_rank')
+    else:
+        sort_column = column_map.get(sort, Activity.start_time_utc)
+
     # Base Query
     query = Activity.query
 
     # Apply Filters
-    if activity_filters:
-        date_format = '%Y-%m-%d'
-
-        # Fix empty dates
-        if not activity_filters.get('start-date'):
-            activity_filters['start-date'] = str(
-                Activity.query.order_by(Activity.start_time).first().start_time
-            ).split(' ')[0]
-
-        if not activity_filters.get('end-date'):
-            activity_filters['end-date'] = str(
-                Activity.query.order_by(Activity.start_time.desc()).first().start_time
-            ).split(' ')[0]
-
-        # Ensure valid date range
-        if activity_filters['start-date'] > activity_filters['end-date']:
-            activity_filters['start-date'] = activity_filters['end-date']
-
-        # Extend end date by 1 day
-        end_date_obj = datetime.strptime(activity_filters['end-date'], date_format) + timedelta(days=1)
-        end_date_str = end_date_obj.strftime(date_format)
-
-        # Build dynamic filters
-        filters = {}
-
-        if activity_filters.get('type-options') not in [None, 'All']:
-            filters['activity_type'] = activity_filters['type-options']
-
-        if activity_filters.get('gear-options') not in [None, 'All']:
-            filters['activity_gear'] = activity_filters['gear-options']
-
-        if activity_filters.get('commute') == 'commute':
-            filters['commute'] = 1
-
-        # Apply filters
-        query = (
-            query
-            .filter_by(**filters)
-            .filter(Activity.activity_name.ilike(f"%{activity_filters.get('activity-search', '')}%"))
-            .filter(Activity.start_time >= f"{activity_filters['start-date']} 00:00:00")
-            .filter(Activity.start_time <= f"{end_date_str} 00:00:00")
-        )
-
-        # Example numeric filters (safe checks)
-        if activity_filters.get('more-than-distance'):
-            query = query.filter(Activity.distance >= activity_filters['more-than-distance'])
-
-        if activity_filters.get('less-than-distance'):
-            query = query.filter(Activity.distance <= activity_filters['less-than-distance'])
+    with timed('filters'):
+        query = apply_activity_filters(query, activity_filters)
+
+    # Time spent in each heart rate zone by the filtered activities.
+    with timed('zone-query'):
+        zone_seconds = get_heart_rate_zone_totals(query)
+    plot_heart_rate_zone_data = generate_heart_rate_zone_plot(zone_seconds, 'Time in Heart Rate Zones')
+
+    # Count and total the filtered activities once per set of filters.
+    with timed('count'):
+        filtered_totals = get_filtered_activity_totals(query, activity_filters)
+    num_of_activities = filtered_totals['count']
+    total_pages = (num_of_activities + per_page - 1) // per_page
 
-    # Apply Sorting (After filters)
-    if order == "desc":
-        query = query.order_by(desc(sort_column))
-    else:
-        query = query.order_by(asc(sort_column))
+    # Pagination. The next and previous page links carry the sort value and id of the last and first activity on this
+    # page, and the page query seeks to them (after sorting, after filters). Without a valid cursor the first page is
+    # shown.
+    cursor = decode_page_cursor(before or after or '', sort_column)
+    if cursor is None:
+        page = 1
+    query = apply_keyset_pagination(
+        query,
+        sort_column,
+        descending=order == 'desc',
+        cursor=cursor,
+        before=cursor is not None and before is not None
+    )
+    with timed('page-query'):
+        activities = query_activity_page(query, sort_column, per_page)
+    if cursor is not None and before is not None:
+        activities.reverse()
 
-    # Pagination
-    activities = query.limit(per_page).offset((page - 1) * per_page).all()
-    num_of_activities = query.count()
-    total_pages = (num_of_activities + per_page - 1) // per_page
+    next_cursor = encode_page_cursor(activities[-1].sort_value, activities[-1].id) if activities else None
+    previous_cursor = encode_page_cursor(activities[0].sort_value, activities[0].id) if activities else None
 
     # Num of Activities counter
     if num_of_activities == 0:
@@ -1169,176 +1469,32 @@ def activity():
     # activity_type_list = [x.activity_type for x in Activity.query.with_entities(Activity.activity_type).group_by(Activity.activity_type).all()]
     # activity_gear_list = [x.activity_gear for x in Activity.query.with_entities(Activity.activity_gear).group_by(Activity.activity_gear).all()]
 
-    #====================== Troubleshooting =============================
-    test = Activity.query.order_by(Activity.distance).limit(10).all()
-
-    for i, row in enumerate(test):
-        print(i, row, type(row))
-
-    # ===================================================================
-
-    # Get the minimum and maximum of all the activity distances for the dropdown boxes
-    activity_filters['more-than-distance'] = (Activity.query.order_by(Activity.distance).
-                               first().distance)
-    activity_filters['less-than-distance'] = (Activity.query.order_by(Activity.distance.desc()).
-                               first().distance)
-
-    # Get the minimum and maximum of all the activity elevation gains for the dropdown boxes
-    activity_filters['more-than-elevation-gain'] = (Activity.query.order_by(Activity.elevation_gain).
-                                     first().elevation_gain)
-    activity_filters['less-than-elevation-gain'] = (Activity.query.order_by(Activity.elevation_gain.desc()).
-                                     first().elevation_gain)
-
-    # Get the minimum and maximum of all the activity elevations for the dropdown boxes
-    activity_filters['more-than-highest-elevation'] = Activity.query.order_by(Activity.highest_elevation).first().highest_elevation
-    activity_filters['less-than-highest-elevation'] = (Activity.query.order_by(Activity.highest_elevation.desc()).
-                                        first().highest_elevation)
-
-
-    # Get the minimum and maximum of all the activity moving times for the dropdown boxes
-    longest_activity_duration_split = split_time_string(Activity.query.order_by(Activity.activity_duration.desc()).
-                                                  first().activity_duration)
-    shortest_activity_duration_split = split_time_string(Activity.query.order_by(Activity.activity_duration).
-                                                   first().activity_duration)
-    activity_filters['more-than-hours'] = shortest_activity_duration_split[0]
-    activity_filters['more-than-minutes'] = shortest_activity_duration_split[1]
-    activity_filters['more-than-seconds'] = shortest_activity_duration_split[2]
-    activity_filters['less-than-hours'] = longest_activity_duration_split[0]
-    activity_filters['less-than-minutes'] = longest_activity_duration_split[1]
-    activity_filters['less-than-seconds'] = longest_activity_duration_split[2]
-
-    # ================================================= Graph Plotting =================================================
-    #TODO: Create a filter for when an activity doesn't have GPS data(ex. indoor activities) to display the graph as
-    # data vs time and NOT data vs distance. Alternatively, make a button so the user can toggle between the two options,
-    # but data vs time would be the default then an activity doesn't have GPS data.
-
-    # Get the minimum and maximum of all the activity average speeds for the dropdown boxes
-    activity_filters['more-than-average-speed'] = (Activity.query.order_by(Activity.average_speed).
-                                    first().average_speed)
-    activity_filters['less-than-average-speed'] = (Activity.query.order_by(Activity.average_speed.desc()).
-                                    first().average_speed)
-
-    # Get the minimum and maximum of all the activity max speeds for the dropdown boxes
-    activity_filters['more-than-max-speed'] = (Activity.query.order_by(Activity.max_speed).
-                                first().max_speed)
-    activity_filters['less-than-max-speed'] = (Activity.query.order_by(Activity.max_speed.desc()).
-                                first().max_speed)
-
-    # Group the activity types and create a list of each activity type to be used to populate the dropdown menu options.
-    activity_type_categories = (Activity.query.with_entities(Activity.activity_type).
-                                group_by(Activity.activity_type).all())
-    activity_type_list = [point.activity_type for point in activity_type_categories]
-
-    # Group the activity gear and create a list of each activity gear to be used to populate the dropdown menu options.
-    activity_gear_categories = (Activity.query.with_entities(Activity.activity_gear).
-                                group_by(Activity.activity_gear).all())
-    activity_gear_list = [gear.activity_gear for gear in activity_gear_categories]
-
-    # Create a DataFrame using the desired data, create a simple Plotly line chart, then convert the figure to an HTML
-    moving_time_data = {
-        'Activity Moving Time': [point.moving_time_seconds for point in activities],
-        'Activity Date': [point.start_time for point in activities]
-    }
-    activity_duration_df = pd.DataFrame(moving_time_data)
-    activity_duration_fig = px.line(
-        activity_duration_df,
-        x='Activity Date',
-        y='Activity Moving Time',
-        title="Moving Time vs Activity Date"
-    )
-    plot_activity_duration_data = activity_duration_fig.to_html(full_html=False)
-
-    # Create a DataFrame using the desired data, create a simple Plotly line chart, then convert the figure to an HTML
-    distance_data = {
-        'Activity Distance': [point.distance for point in activities],
-        'Activity Date': [point.start_time for point in activities]
-    }
-    distance_df = pd.DataFrame(distance_data)
-    distance_fig = px.line(
-        distance_df,
-        x='Activity Date',
-        y='Activity Distance',
-        title="Distance vs Activity Date"
-    )
-    plot_distance_data = distance_fig.to_html(full_html=False)
+    # Get the minimum and maximum of each filter and the activity types and gear for the dropdown boxes.
+    with timed('bounds'):
+        filter_bounds = get_activity_filter_bounds()
+    activity_filters = {**activity_filters, **filter_bounds['ranges']}
+    activity_type_list = filter_bounds['activity_types']
+    activity_gear_list = filter_bounds['activity_gear']
 
-    # Create a DataFrame using the desired data, create a simple Plotly line chart, then convert the figure to an HTML
-    avg_speed_data = {
-        'Activity Average Speed': [point.average_speed for point in activities],
-        'Activity Date': [point.start_time for point in activities]
-    }
-    avg_speed_df = pd.DataFrame(avg_speed_data)
-    avg_speed_fig = px.line(
-        avg_speed_df,
-        x='Activity Date',
-        y='Activity Average Speed',
-        title="Average Speed vs Activity Date"
-    )
-    plot_avg_speed_data = avg_speed_fig.to_html(full_html=False)
-
-    # Create a DataFrame using the desired data, create a simple Plotly line chart, then convert the figure to an HTML
-    max_speed_data = {
-        'Activity Max Speed': [point.max_speed for point in activities],
-        'Activity Date': [point.start_time for point in activities]
-    }
-    max_speed_df = pd.DataFrame(max_speed_data)
-    max_speed_fig = px.line(
-        max_speed_df,
-        x='Activity Date',
-        y='Activity Max Speed',
-        title="Max Speed vs Activity Date"
-    )
-    plot_max_speed_data = max_speed_fig.to_html(full_html=False)
-
-    # Create a DataFrame using the desired data, create a simple Plotly line chart, then convert the figure to an HTML
-    elevation_gain_data = {
-        'Activity Elevation Gain': [point.elevation_gain for point in activities],
-        'Activity Date': [point.start_time for point in activities]
-    }
-    elevation_gain_df = pd.DataFrame(elevation_gain_data)
-    elevation_gain_fig = px.line(
-        elevation_gain_df,
-        x='Activity Date',
-        y='Activity Elevation Gain',
-        title="Elevation Gain vs Activity Date"
-    )
-    plot_elevation_gain_data = elevation_gain_fig.to_html(full_html=False)
-
-    # Create a DataFrame using the desired data, create a simple Plotly bar chart, then convert the figure to an HTML
-    activity_type_data = {
-        'Activity Type': [point.activity_type for point in activities],
-    }
-    activity_type_df = pd.DataFrame(activity_type_data)
-    counts = activity_type_df['Activity Type'].value_counts().reset_index()
-    counts.columns = ['Activity Type', 'Count']
-    activity_type_fig = px.pie(
-        counts,
-        names='Activity Type',
-        values='Count',
-        title='Activity Type'
-    )
-    plot_activity_type_data = activity_type_fig.to_html(full_html=False)
-
-    return render_template(
-        'activities.html',
-        activities=activities,
-        activity_type_list=activity_type_list,
-        activity_gear_list=activity_gear_list,
-        num_of_activities_string=num_of_activities_string,
-        page=page,
-        per_page=per_page,
-        total_pages=total_pages,
-        num_of_activities=num_of_activities,
-        activity_filters=activity_filters,
-        sort=sort,
-        order=order,
-        plot_activity_duration_data=plot_activity_duration_data,
-        plot_distance_data=plot_distance_data,
-        plot_avg_speed_data=plot_avg_speed_data,
-        plot_max_speed_data=plot_max_speed_data,
-        plot_elevation_gain_data=plot_elevation_gain_data,
-        plot_activity_type_data=plot_activity_type_data,
-    )
+    with timed('render'):
+        return render_template(
+            'activities.html',
+            activities=activities,
+            activity_type_list=activity_type_list,
+            activity_gear_list=activity_gear_list,
+            num_of_activities_string=num_of_activities_string,
+            page=page,
+            per_page=per_page,
+            filtered_totals=filtered_totals,
+            next_cursor=next_cursor,
+            previous_cursor=previous_cursor,
+            total_pages=total_pages,
+            num_of_activities=num_of_activities,
+            activity_filters=activity_filters,
+            sort=sort,
+            order=order,
+            plot_heart_rate_zone_data=plot_heart_rate_zone_data,
+        )
 
 @main.route('/activity/<int:activity_id>', methods=['GET'])
 def activity_info(activity_id):
@@ -1358,12 +1514,13 @@ def activity_info(activity_id):
     # print(f'Activity.strava_activity_id is: {Activity.strava_activity_id}')
     # print(f'Activity.garmin_activity_id is: {Activity.garmin_activity_id}')
 
-    activity_data = Activity.query.filter(
-        or_(
-            Activity.strava_activity_id == activity_id,
-            Activity.garmin_activity_id == activity_id,
-        )
-    ).first()
+    with timed('activity-query'):
+        activity_data = Activity.query.filter(
+            or_(
+                Activity.strava_activity_id == activity_id,
+                Activity.garmin_activity_id == activity_id,
+            )
+        ).first()
 
     # if activity_data:
     #     print("activity_data =", activity_data)
@@ -1419,19 +1576,20 @@ def activity_info(activity_id):
 
     elif activity_data.garmin_activity_id == activity_id:
 
-        zip_files = glob.glob(f"{Config.UPLOAD_FOLDER_GARMIN}/DI_CONNECT/DI-Connect-Uploaded-Files/*.zip")
+        with timed('locate'):
+            zip_files = glob.glob(f"{Config.UPLOAD_FOLDER_GARMIN}/DI_CONNECT/DI-Connect-Uploaded-Files/*.zip")
 
-        target_file = activity_data.garmin_filename
+            target_file = activity_data.garmin_filename
 
-        for zip_path in zip_files:
+            for zip_path in zip_files:
 
-            with ZipFile(zip_path) as z:
+                with ZipFile(zip_path) as z:
 
-                if target_file in z.namelist():
-                    print(f"Found {target_file} in {zip_path}")
-                    break
-                else:
-                    print(f"{target_file} not found in any ZIP file")
+                    if target_file in z.namelist():
+                        print(f"Found {target_file} in {zip_path}")
+                        break
+                    else:
+                        print(f"{target_file} not found in any ZIP file")
 
         filepath = os.path.join(
             os.getcwd(),
@@ -1486,11 +1644,20 @@ def activity_info(activity_id):
             error_message=f"Unsupported activity file type: {filetype}"
         )
 
-    return render_template(
-        'individual_activity.html',
-        activity_data=activity_data,
-        activity_graph_data=activity_graph_data
-    )
+    activity_graph_data.update(generate_activity_mean_max_plots(activity_data))
+
+    with timed('zone-query'):
+        zone_seconds = get_heart_rate_zone_totals(Activity.query.filter(Activity.id == activity_data.id))
+    if sum(zone_seconds) > 0:
+        activity_graph_data['heart_rate_zones'] = generate_heart_rate_zone_plot(zone_seconds, 'Time in Heart Rate Zones')
+
+    with timed('render'):
+        return render_template(
+            'individual_activity.html',
+            activity_id=activity_id,
+            activity_data=activity_data,
+            activity_graph_data=activity_graph_data
+        )
     # if activity_data.strava_filename is not None:
     #     try:
     #         if activity_data.strava_filename.split(".")[-1] == 'gz':
@@ -1578,6 +1745,217 @@ def activity_info(activity_id):
         activity_graph_data=activity_graph_data
     )
 
+@main.route('/api/activity/<int:activity_id>/route', methods=['GET'])
+def activity_route(activity_id):
+    """
+    Function and route for the route map data of an individual activity. The route is simplified and encoded when the
+    activities are imported, so this only returns the cached encoded polyline.
+    :param activity_id: (datatype: int) The Strava or Garmin activity id.
+    :return: (json) The activity id and the encoded polyline of the route, which is null if there is no GPS data.
+    """
+    activity_data = Activity.query.with_entities(Activity.route_polyline).filter(
+        or_(
+            Activity.strava_activity_id == activity_id,
+            Activity.garmin_activity_id == activity_id,
+        )
+    ).first()
+
+    if activity_data is None:
+        return jsonify({'message': f'No activity found for ID {activity_id}'}), 404
+
+    return jsonify({
+        'activity_id': activity_id,
+        'polyline': activity_data.route_polyline
+    })
+
+@main.route('/api/mean-max-curves', methods=['GET'])
+def mean_max_curves():
+    """
+    Function and route for the all time and per-season mean maximal curves. The channel is selected with the channel
+    query parameter (power by default) and the activities can be filtered with the activity_type query parameter.
+    :return: (json) The durations in seconds, the all time curve, and the curve of each season.
+    """
+    channel = request.args.get('channel', 'power')
+    activity_type = request.args.get('activity_type')
+
+    if channel not in Config.MEAN_MAX_CHANNELS:
+        return jsonify({'message': f'Unknown channel {channel}'}), 400
+
+    all_time_curve, season_curves = get_mean_max_envelopes(channel, activity_type)
+
+    return jsonify({
+        'channel': channel,
+        'durations': Config.MEAN_MAX_DURATIONS,
+        'all_time': all_time_curve,
+        'seasons': season_curves,
+    })
+
+@main.route('/api/activities/charts', methods=['GET'])
+def activity_charts():
+    """
+    Function and route for the summary charts of the activities page, which fetches them after the page has loaded.
+    The charts use the filters saved in the session by the activities page, and are cached for each set of filters
+    until the next import.
+    :return: (json) The Plotly figure data of each chart, keyed by the id of the chart on the page.
+    """
+    activity_filters = dict(session.get('filters', {}))
+    query = apply_activity_filters(Activity.query, activity_filters)
+
+    with timed('charts'):
+        charts = cached(f'activity_charts:{get_filter_signature(activity_filters)}', lambda: query_activity_charts(query))
+
+    response = make_response(charts)
+    response.mimetype = 'application/json'
+    return response
+
+@main.route('/api/activities/export', methods=['GET'])
+def export_activities():
+    """
+    Function and route for the activity export. The activities that match the filters saved in the session by the
+    activities page are streamed as newline delimited JSON or CSV, selected with the format query parameter (ndjson by
+    default), so large exports start downloading right away and do not have to fit in memory.
+    :return: The export file as a streamed response.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    mimetypes = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+    if export_format not in mimetypes:
+        return jsonify({'message': f'Unknown export format {export_format}, use ndjson or csv'}), 400
+
+    query = apply_activity_filters(Activity.query, dict(session.get('filters', {})))
+
+    return Response(
+        stream_with_context(generate_activity_export(query, export_format)),
+        mimetype=mimetypes[export_format],
+        headers={'Content-Disposition': f'attachment; filename=activities.{export_format}'}
+    )
+
+@main.route('/api/activity-totals', methods=['GET'])
+def activity_totals_api():
+    """
+    Function and route for the activity totals. The period is selected with the period query parameter (week, month,
+    year or all), the totals can be kept apart by activity type or gear with the group_by query parameter, and filtered
+    with the activity_type and activity_gear query parameters.
+    :return: (json) The period and the totals.
+    """
+    period = request.args.get('period', 'all')
+    group_by = request.args.get('group_by')
+
+    if period not in Config.ACTIVITY_TOTAL_PERIODS + ['all']:
+        return jsonify({'message': f'Unknown period {period}'}), 400
+
+    if group_by not in [None, 'activity_type', 'activity_gear']:
+        return jsonify({'message': f'Cannot group the totals by {group_by}'}), 400
+
+    return jsonify({
+        'period': period,
+        'totals': get_activity_totals(
+            period,
+            group_by=group_by,
+            activity_type=request.args.get('activity_type'),
+            activity_gear=request.args.get('activity_gear')
+        ),
+    })
+
+@main.route('/debug/perf', methods=['GET'])
+def debug_perf():
+    """
+    Function and route for the performance page, which shows the 50th and 95th percentile time of every route and of
+    each stage of the route, over the last Config.TIMING_SAMPLE_SIZE requests, and the saved profiles.
+    :return: Renders the debug_perf.html page, or a 404 error for addresses that are not in
+    Config.PROFILE_ALLOWED_ADDRESSES.
+    """
+    if not is_profiling_allowed():
+        abort(404)
+
+    profiles = []
+    if os.path.isdir(Config.PROFILE_FOLDER):
+        profiles = sorted(os.listdir(Config.PROFILE_FOLDER), reverse=True)
+
+    return render_template(
+        'debug_perf.html',
+        timings=get_timing_summary(),
+        sample_size=Config.TIMING_SAMPLE_SIZE,
+        profiles=profiles,
+    )
+
+@main.route('/debug/profiles/<path:filename>', methods=['GET'])
+def debug_profile(filename):
+    """
+    Function and route for downloading a profile saved by a ?_profile=1 request.
+    :param filename: (str) The file name of the collapsed stacks (.folded) or the top functions table (.txt).
+    :return: The profile as plain text, or a 404 error for addresses that are not in Config.PROFILE_ALLOWED_ADDRESSES.
+    """
+    if not is_profiling_allowed():
+        abort(404)
+
+    return send_from_directory(Config.PROFILE_FOLDER, filename, mimetype='text/plain')
+
+@main.route('/totals', methods=['GET'])
+def totals():
+    """
+    Function and route for the totals page, which shows the all time count, distance, moving time, climbing and max
+    speed of each activity type and gear, and the totals of each year.
+    :return: Renders the totals.html page.
+    """
+    return render_template(
+        'totals.html',
+        activity_type_totals=get_activity_totals('all', group_by='activity_type'),
+        activity_gear_totals=get_activity_totals('all', group_by='activity_gear'),
+        yearly_totals=get_activity_totals('year'),
+    )
+
+@main.route('/personal-records', methods=['GET'])
+def personal_records():
+    """
+    Function and route for the personal records page, which shows the progression of the best effort of each distance
+    for the selected sport.
+    :return: Renders the personal_records.html page.
+    """
+    sport = request.args.get('sport', next(iter(Config.BEST_EFFORT_SPORTS)))
+
+    if sport not in Config.BEST_EFFORT_SPORTS:
+        return render_template(
+            'error.html',
+            error_message=f"Personal records are not calculated for {sport}"
+        )
+
+    return render_template(
+        'personal_records.html',
+        sports=list(Config.BEST_EFFORT_SPORTS),
+        selected_sport=sport,
+        progression=get_best_effort_progression(sport)
+    )
+
+@main.route('/heatmap', methods=['GET'])
+def heatmap():
+    """
+    Function and route for the heatmap page, which shows every route in the database on one map.
+    :return: Renders the heatmap.html page.
+    """
+    return render_template('heatmap.html')
+
+@main.route('/tiles/<int:zoom>/<int:x>/<int:y>', methods=['GET'])
+def heatmap_tile(zoom, x, y):
+    """
+    Function and route for the heatmap tiles. The tiles are rendered from the count grids saved when the activities
+    are imported, and browsers are allowed to cache them for Config.HEATMAP_TILE_MAX_AGE seconds.
+    :param zoom: (int) The zoom level.
+    :param x: (int) The tile column.
+    :param y: (int) The tile row.
+    :return: (png) The heatmap tile.
+    """
+    if x >= 2 ** zoom or y >= 2 ** zoom:
+        return jsonify({'message': f'Tile {zoom}/{x}/{y} does not exist'}), 404
+
+    response = make_response(render_heatmap_tile(load_heatmap_tile(zoom, x, y)))
+    response.mimetype = 'image/png'
+    response.cache_control.public = True
+    response.cache_control.max_age = Config.HEATMAP_TILE_MAX_AGE
+    response.add_etag()
+
+    return response.make_conditional(request)
+
 @main.route('/create-db', methods=['POST', 'GET'])
 def create_db():
     """
@@ -1712,7 +2090,13 @@ def settings():
         timezone_list.append(tz)
 
     if request.method == 'POST':
-        Config.USER_TIMEZONE = request.form.get('timezone-options')
+        timezone = request.form.get('timezone-options')
+        if timezone in pytz.all_timezones_set and timezone != Config.USER_TIMEZONE:
+            # The start times are saved in UTC and converted when they are read, so only the weekly, monthly and
+            # yearly totals and the cached values need to be calculated again.
+            Config.USER_TIMEZONE = timezone
+            Database().rebuild_activity_totals()
+            clear_cache()
 
     return render_template(
         'settings.html',
@@ -1794,7 +2178,8 @@ def calorie_calculator():
 @main.route('/hr-zones', methods=['POST', 'GET'])
 def heart_rate_zones():
     """
-    Function and route for the heart rate zone page, where the users heart rate zones will be calculated.
+    Function and route for the heart rate zone page, where the users heart rate zones will be calculated. The page also
+    shows the time spent in each zone by the activities that match the filters on the activities page.
     :return: Renders the heart_rate_zones.html page.
     """
     if request.method == 'POST':
@@ -1803,17 +2188,13 @@ def heart_rate_zones():
 
         print(f'activity_type is: {activity_type}')
 
-        # Using the Tanaka formula to calculate Max HR, which is more accurate for fit individuals.
-        max_heart_rate = int(208 - (0.7 * Config.USER_AGE))  # Normal Max HR for running, hiking, walking, etc.
-        if activity_type == 'cycling':
-            max_heart_rate = int(208 - (0.7 * Config.USER_AGE)) - 9  # Cycling is ~5-10bpm lower because rider is seated
-            # and using less muscle.
-        if activity_type == 'swimming':
-            max_heart_rate = int(208 - (0.7 * Config.USER_AGE)) - 14  # Swimming is ~10-15bpm lower because of the
-            # horizontal position.
-        if activity_type == 'rowing':
-            max_heart_rate = int(208 - (0.7 * Config.USER_AGE)) - 5  # 5bpm lower because of being seated, but using
-            # upper body.
+        max_heart_rate = Database.calculate_max_heart_rate(Config.USER_AGE, activity_type)
+
+        # The time in zone of every activity is recalculated for the new zones.
+        Config.HEART_RATE_ZONE_BOUNDARIES = [
+            int(max_heart_rate * percentage) for percentage in Config.HEART_RATE_ZONE_PERCENTAGES
+        ]
+        Database().update_heart_rate_zone_times()
 
         return render_template(
             'heart_rate_zones.html',
@@ -1823,12 +2204,14 @@ def heart_rate_zones():
             zone2_high=int(max_heart_rate * 0.7),  # 70%
             zone3_high=int(max_heart_rate * 0.8),  # 80%
             zone4_high=int(max_heart_rate * 0.9),  # 90%
-            zone5_high=max_heart_rate  # 100%
+            zone5_high=max_heart_rate,  # 100%
+            zone_times=get_zone_times_for_filtered_activities()
         )
     else:
         return render_template(
             'heart_rate_zones.html',
             user_age = Config.USER_AGE,
+            zone_times=get_zone_times_for_filtered_activities()
         )
 
 
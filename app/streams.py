@@ -0,0 +1,881 @@
+from datetime import datetime, timezone
+from io import BytesIO
+from zipfile import ZipFile
+import gzip
+import heapq
+import os
+import xml.etree.ElementTree as ET
+
+import gpxpy
+import numpy as np
+import pandas as pd
+from fitparse import FitFile
+from fitparse.utils import FitEOFError
+
+from config import Config
+
+# Channels in every activity sample frame. All values are stored in SI units (seconds, meters, meters per second,
+# degrees Celsius) and converted to display units only when a chart is built.
+SAMPLE_CHANNELS = [
+    'time',
+    'distance',
+    'altitude',
+    'speed',
+    'heart_rate',
+    'cadence',
+    'temperature',
+    'power',
+    'latitude',
+    'longitude',
+]
+
+EARTH_RADIUS_METERS = 6371000
+SEMICIRCLES_TO_DEGREES = 180 / 2 ** 31
+
+# Namespaces used in TCX files
+TCX_NAMESPACES = {
+    'tcx': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2',
+    'tpx': 'http://www.garmin.com/xmlschemas/ActivityExtension/v2',
+}
+
+# The Garmin activity type of each TCX sport, the same names the .fit and Strava .gpx files use.
+TCX_ACTIVITY_TYPES = {
+    'Biking': 'cycling',
+    'Running': 'running',
+    'Other': 'other',
+}
+
+
+def build_sample_frame(channels, activity_type=None, activity_name=None):
+    """
+    Build the sample frame for an activity. Every channel is aligned to the same elapsed time axis and any channel that
+    was not recorded is filled with NaN, so there is no need to pad the channels to the same length. The start time, in
+    seconds since the epoch, and the activity type and name recorded in the file are saved in the frame attrs.
+    :param channels: (dict) Channel name to a list or array of values. Each channel with values must be the same
+    length as the 'time' channel.
+    :param activity_type: (str) The activity type recorded in the file, or None.
+    :param activity_name: (str) The activity name recorded in the file, or None.
+    :return: (Pandas dataframe) One row per sample with a float column for each of the SAMPLE_CHANNELS.
+    """
+    recorded_channels = {channel: values for channel, values in channels.items() if len(values) > 0}
+    frame = pd.DataFrame(recorded_channels, columns=SAMPLE_CHANNELS, dtype='float64')
+    frame.attrs.update({'start_time': None, 'activity_type': activity_type, 'activity_name': activity_name})
+
+    # Start the elapsed time axis at zero.
+    if len(frame) > 0:
+        frame.attrs['start_time'] = frame['time'].min()
+        frame['time'] = frame['time'] - frame['time'].min()
+
+    return frame
+
+
+def haversine_distance(latitude, longitude):
+    """
+    Calculate the distance between each consecutive GPS point using the haversine formula.
+    :param latitude: (numpy array) Latitude of each point in degrees.
+    :param longitude: (numpy array) Longitude of each point in degrees.
+    :return: (numpy array) The distance, in meters, from the previous point. The first point is 0.
+    """
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    step = 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+    return np.concatenate(([0.0], step))
+
+
+def cumulative_distance(latitude, longitude):
+    """
+    Calculate the cumulative distance along a GPS track. Points without a position do not add any distance.
+    :param latitude: (numpy array) Latitude of each point in degrees.
+    :param longitude: (numpy array) Longitude of each point in degrees.
+    :return: (numpy array) The distance, in meters, from the first point.
+    """
+    if len(latitude) == 0:
+        return np.array([], dtype='float64')
+
+    return np.cumsum(np.nan_to_num(haversine_distance(latitude, longitude)))
+
+
+def derive_speed(time, distance):
+    """
+    Calculate the speed between consecutive samples from the time and distance channels. Samples with no time
+    difference have no speed (NaN).
+    :param time: (numpy array) Elapsed time in seconds.
+    :param distance: (numpy array) Cumulative distance in meters.
+    :return: (numpy array) Speed in meters per second.
+    """
+    if len(time) == 0:
+        return np.array([], dtype='float64')
+
+    time_diff = np.diff(time)
+    distance_diff = np.diff(distance)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(time_diff > 0, distance_diff / time_diff, np.nan)
+
+    return np.concatenate(([0.0], speed))
+
+
+def to_utc_timestamp(timestamp):
+    """
+    Convert the time of a sample to seconds since the epoch. The .fit files, and .gpx files without a time zone, record
+    the time in UTC, so a naive datetime is read as UTC instead of the local time of the computer.
+    :param timestamp: (datetime) The time of the sample.
+    :return: (float) The seconds since the epoch.
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def read_fit_file(fit_file):
+    """
+    Read the record messages from a .fit file into a sample frame.
+    :param fit_file: (str or file object) The decompressed .fit file.
+    :return: (Pandas dataframe) The sample frame of the activity.
+    """
+    channels = {channel: [] for channel in SAMPLE_CHANNELS}
+    activity_type = None
+
+    try:
+        for record in FitFile(fit_file).get_messages(['record', 'sport', 'session']):
+            values = record.get_values()
+
+            if record.name != 'record':
+                activity_type = activity_type or values.get('sport')
+                continue
+
+            timestamp = values.get('timestamp')
+
+            if timestamp is None:
+                continue
+
+            latitude = values.get('position_lat')
+            longitude = values.get('position_long')
+            altitude = values.get('enhanced_altitude', values.get('altitude'))
+            speed = values.get('enhanced_speed', values.get('speed'))
+
+            channels['time'].append(to_utc_timestamp(timestamp))
+            channels['distance'].append(values.get('distance'))
+            channels['altitude'].append(altitude)
+            channels['speed'].append(speed)
+            channels['heart_rate'].append(values.get('heart_rate'))
+            channels['cadence'].append(values.get('cadence'))
+            channels['temperature'].append(values.get('temperature'))
+            channels['power'].append(values.get('power'))
+            channels['latitude'].append(None if latitude is None else latitude * SEMICIRCLES_TO_DEGREES)
+            channels['longitude'].append(None if longitude is None else longitude * SEMICIRCLES_TO_DEGREES)
+
+    # To handle: fitparse.utils.FitEOFError: Tried to read 1 bytes from .FIT file but got 0 (Issue #3 fix)
+    except FitEOFError as e:
+        print(f'FitEOFError is: {e}')
+
+    return build_sample_frame(channels, activity_type)
+
+
+def read_gpx_file(gpx_file):
+    """
+    Read every track point from a .gpx file into a sample frame. The distance and speed are calculated from the GPS
+    coordinates because they are not recorded in the file.
+    :param gpx_file: (file object) The opened .gpx file.
+    :return: (Pandas dataframe) The sample frame of the activity.
+    """
+    gpx = gpxpy.parse(gpx_file)
+    points = [point for track in gpx.tracks for segment in track.segments for point in segment.points]
+
+    heart_rate_list = []
+    cadence_list = []
+    for point in points:
+        extension_values = {
+            element.tag.split('}')[-1]: element.text
+            for extension in point.extensions
+            for element in extension
+        }
+        heart_rate_list.append(extension_values.get('hr'))
+        cadence_list.append(extension_values.get('cad'))
+
+    latitude = np.array([point.latitude for point in points], dtype='float64')
+    longitude = np.array([point.longitude for point in points], dtype='float64')
+    time = np.array([np.nan if point.time is None else to_utc_timestamp(point.time) for point in points], dtype='float64')
+    distance = cumulative_distance(latitude, longitude)
+
+    return build_sample_frame({
+        'time': time,
+        'distance': distance,
+        'altitude': [point.elevation for point in points],
+        'speed': derive_speed(time, distance),
+        'heart_rate': pd.to_numeric(heart_rate_list, errors='coerce'),
+        'cadence': pd.to_numeric(cadence_list, errors='coerce'),
+        'latitude': latitude,
+        'longitude': longitude,
+    }, gpx.tracks[0].type if gpx.tracks else None, gpx.tracks[0].name if gpx.tracks else None)
+
+
+def _find_float(element, path):
+    """
+    Find the text of a child element and convert it to a float.
+    :param element: (Element) The parent XML element.
+    :param path: (str) The path of the child element.
+    :return: (float) The value of the child element, or NaN if it was not found.
+    """
+    child = element.find(path, TCX_NAMESPACES)
+
+    if child is None or child.text is None:
+        return np.nan
+
+    return float(child.text)
+
+
+def read_tcx_file(tcx_file):
+    """
+    Read every trackpoint from a .tcx file into a sample frame. Each trackpoint is one sample, so a value that is
+    missing from a trackpoint is stored as NaN instead of shifting the rest of the channel. If the file has no distance
+    recorded, it is calculated from the GPS coordinates.
+    :param tcx_file: (str or file object) The decompressed_activity_files/ path with the filename of the file being
+    parsed, or the opened file.
+    :return: (Pandas dataframe) The sample frame of the activity.
+    """
+    root = ET.parse(tcx_file).getroot()
+    channels = {channel: [] for channel in SAMPLE_CHANNELS}
+
+    for trackpoint in root.findall('.//tcx:Trackpoint', TCX_NAMESPACES):
+        tcx_time = trackpoint.find('tcx:Time', TCX_NAMESPACES)
+
+        if tcx_time is None:
+            continue
+
+        channels['time'].append(datetime.fromisoformat(tcx_time.text.replace('Z', '+00:00')).timestamp())
+        channels['distance'].append(_find_float(trackpoint, 'tcx:DistanceMeters'))
+        channels['altitude'].append(_find_float(trackpoint, 'tcx:AltitudeMeters'))
+        channels['heart_rate'].append(_find_float(trackpoint, 'tcx:HeartRateBpm/tcx:Value'))
+        channels['cadence'].append(_find_float(trackpoint, 'tcx:Cadence'))
+        channels['power'].append(_find_float(trackpoint, './/tpx:Watts'))
+        channels['latitude'].append(_find_float(trackpoint, 'tcx:Position/tcx:LatitudeDegrees'))
+        channels['longitude'].append(_find_float(trackpoint, 'tcx:Position/tcx:LongitudeDegrees'))
+
+    time = np.array(channels['time'], dtype='float64')
+    distance = np.array(channels['distance'], dtype='float64')
+
+    if len(distance) > 0 and np.isnan(distance).all():
+        distance = cumulative_distance(
+            np.array(channels['latitude'], dtype='float64'),
+            np.array(channels['longitude'], dtype='float64')
+        )
+
+    channels['distance'] = distance
+    channels['speed'] = derive_speed(time, distance)
+
+    activity = root.find('.//tcx:Activity', TCX_NAMESPACES)
+    sport = None if activity is None else activity.get('Sport')
+
+    return build_sample_frame(channels, TCX_ACTIVITY_TYPES.get(sport, sport))
+
+
+def read_activity_file(activity_file, filename):
+    """
+    Read a .fit, .gpx, or .tcx activity file into a sample frame. Files ending in .gz are decompressed in memory.
+    :param activity_file: (str or file object) The path to the activity file, or the opened activity file.
+    :param filename: (str) The name of the activity file, used to determine the file type.
+    :return: (Pandas dataframe) The sample frame of the activity, or None if the file type is not supported.
+    """
+    if filename.endswith('.gz'):
+        activity_file = gzip.open(activity_file)
+        filename = filename[:-3]
+    elif isinstance(activity_file, str):
+        activity_file = open(activity_file, 'rb')
+
+    with activity_file:
+        if filename.endswith('.fit'):
+            return read_fit_file(activity_file)
+
+        if filename.endswith('.gpx'):
+            return read_gpx_file(activity_file)
+
+        if filename.endswith('.tcx'):
+            # Some .tcx files have whitespace before the XML declaration, which the XML parser does not accept.
+            return read_tcx_file(BytesIO(activity_file.read().lstrip()))
+
+    return None
+
+
+def read_stored_activity_file(file_path, zip_member_name=None):
+    """
+    Read an activity file from the uploads folder into a sample frame. Garmin activity files are stored inside zip
+    files, so they are read from the zip file without extracting it.
+    :param file_path: (str) The path to the activity file, or to the zip file it is stored in.
+    :param zip_member_name: (str) The name of the activity file in the zip file, or None if file_path is not a zip file.
+    :return: (Pandas dataframe) The sample frame of the activity, or None if the file type is not supported.
+    """
+    if zip_member_name is None:
+        return read_activity_file(file_path, os.path.basename(file_path))
+
+    with ZipFile(file_path) as z:
+        with z.open(zip_member_name) as activity_file:
+            return read_activity_file(BytesIO(activity_file.read()), zip_member_name)
+
+
+def get_stream_filter_settings(activity_type):
+    """
+    Get the outlier filter settings for an activity type. The settings are defined in config.py.
+    :param activity_type: (str) The activity type.
+    :return: (dict) The max_speed, max_vertical_speed, window, n_sigmas, and min_deviation settings.
+    """
+    return {**Config.STREAM_FILTER_DEFAULTS, **Config.STREAM_FILTER_SETTINGS.get(activity_type, {})}
+
+
+def rolling_median(values, window):
+    """
+    Calculate the centered rolling median of a channel.
+    :param values: (Pandas series) The channel values.
+    :param window: (int) The number of samples in the window.
+    :return: (Pandas series) The rolling median of each sample.
+    """
+    return values.rolling(window, center=True, min_periods=1).median()
+
+
+def hampel_filter(values, window, n_sigmas, min_deviation):
+    """
+    Replace the outliers of a channel with the rolling median using a Hampel filter. A sample is an outlier if it is
+    further than n_sigmas times the scaled median absolute deviation from the rolling median of its window.
+    :param values: (Pandas series) The channel values.
+    :param window: (int) The number of samples in the window.
+    :param n_sigmas: (float) The number of standard deviations a sample can be from the median.
+    :param min_deviation: (float) The smallest distance from the median that can be an outlier. This stops flat parts
+    of the channel, where the median absolute deviation is 0, from replacing every small change.
+    :return: (Pandas series) The channel values with the outliers replaced.
+    """
+    median = rolling_median(values, window)
+    deviation = (values - median).abs()
+
+    # 1.4826 scales the median absolute deviation to a standard deviation for normally distributed data.
+    threshold = (n_sigmas * 1.4826 * rolling_median(deviation, window)).clip(lower=min_deviation)
+
+    return values.where(~(deviation > threshold), median)
+
+
+def reject_impossible_jumps(frame, max_speed, max_vertical_speed):
+    """
+    Remove the samples that imply a physically impossible movement. GPS points that jump out and back faster than
+    max_speed are removed, distance steps faster than max_speed add no distance, and speed and altitude values that are
+    too fast are replaced by interpolating the samples around them.
+    :param frame: (Pandas dataframe) The sample frame of the activity.
+    :param max_speed: (float) The highest possible speed, in meters per second.
+    :param max_vertical_speed: (float) The highest possible climbing or descending rate, in meters per second.
+    :return: (Pandas dataframe) The sample frame with the impossible samples removed.
+    """
+    time_diff = frame['time'].diff().to_numpy()
+
+    # Treat samples at the same time as one second apart so that a duplicate timestamp does not look infinitely fast.
+    time_diff = np.where(time_diff > 0, time_diff, 1)
+
+    # A GPS point is a spike if both the step to it and the step away from it are too fast.
+    position_speed = haversine_distance(frame['latitude'].to_numpy(), frame['longitude'].to_numpy()) / time_diff
+    too_fast_in = position_speed > max_speed
+    too_fast_out = np.concatenate((too_fast_in[1:], [False]))
+    position_spike = too_fast_in & too_fast_out
+    frame.loc[position_spike, ['latitude', 'longitude']] = np.nan
+
+    # Distance steps that are too fast add no distance. The distance starts from the first recorded value, and the
+    # samples before it stay empty.
+    distance_step = frame['distance'].diff()
+    too_far = distance_step / time_diff > max_speed
+    if too_far.any():
+        first = np.flatnonzero(np.isfinite(frame['distance'].to_numpy()))[0]
+        distance_step = distance_step.where(~too_far, 0).fillna(0)
+        distance_step.iloc[:first + 1] = 0
+        distance = frame['distance'].iloc[first] + distance_step.cumsum()
+        distance.iloc[:first] = np.nan
+        frame['distance'] = distance
+
+    # Speed and altitude values that are too fast are interpolated from the samples around them.
+    frame['speed'] = frame['speed'].where(~(frame['speed'] > max_speed))
+    frame['speed'] = frame['speed'].interpolate(limit_area='inside')
+
+    vertical_speed = frame['altitude'].diff().abs() / time_diff
+    frame['altitude'] = frame['altitude'].where(~(vertical_speed > max_vertical_speed))
+    frame['altitude'] = frame['altitude'].interpolate(limit_area='inside')
+
+    return frame
+
+
+def clean_sample_frame(frame, activity_type):
+    """
+    Remove GPS spikes and outliers from the sample frame of an activity before it is plotted. Impossible jumps are
+    rejected first and then the speed and altitude channels are smoothed with a Hampel filter. Every step is vectorized,
+    so the cost grows linearly with the number of samples.
+    :param frame: (Pandas dataframe) The sample frame of the activity.
+    :param activity_type: (str) The activity type, used to get the filter settings from config.py.
+    :return: (Pandas dataframe) A cleaned copy of the sample frame.
+    """
+    settings = get_stream_filter_settings(activity_type)
+    frame = frame.copy()
+
+    if len(frame) == 0:
+        return frame
+
+    frame = reject_impossible_jumps(frame, settings['max_speed'], settings['max_vertical_speed'])
+
+    for channel in ['speed', 'altitude']:
+        frame[channel] = hampel_filter(
+            frame[channel],
+            settings['window'],
+            settings['n_sigmas'],
+            settings['min_deviation']
+        )
+
+    return frame
+
+
+def elevation_gain_and_loss(altitude, threshold, window):
+    """
+    Calculate the elevation gain and loss from the altitude channel. The altitude is smoothed with a rolling mean, then
+    a climb or descent is only counted once it is more than the threshold from the last extreme (hysteresis), so GPS and
+    barometer noise does not add up to extra climbing. While a climb or descent continues, every new high or low is
+    counted and becomes the extreme, so the dips and bumps smaller than the threshold do not cut off part of the climb.
+    Only the turning points of the smoothed altitude can start a climb or descent, so the threshold is only checked at
+    those points.
+    :param altitude: (Pandas series) The altitude channel, in meters.
+    :param threshold: (float) The smallest change in altitude, in meters, that is counted.
+    :param window: (int) The number of samples in the rolling mean.
+    :return: (tuple) The elevation gain and loss in meters, or (None, None) if there is no altitude data.
+    """
+    altitude = altitude.dropna()
+
+    if len(altitude) < 2:
+        return None, None
+
+    smoothed = altitude.rolling(window, center=True, min_periods=1).mean().to_numpy()
+
+    # Find the turning points, where the smoothed altitude changes from climbing to descending or the other way around.
+    altitude_diff = np.diff(smoothed)
+    moving = np.flatnonzero(altitude_diff)
+    direction = np.sign(altitude_diff[moving])
+    turns = moving[np.flatnonzero(direction[1:] != direction[:-1]) + 1]
+    turning_points = np.concatenate(([smoothed[0]], smoothed[turns], [smoothed[-1]]))
+
+    gain = 0.0
+    loss = 0.0
+    # The last extreme, and 1 while climbing, -1 while descending, or 0 before the first climb or descent.
+    reference = turning_points[0]
+    climbing = 0
+    for point in turning_points[1:]:
+        if point - reference >= threshold or (climbing == 1 and point > reference):
+            gain += point - reference
+            reference = point
+            climbing = 1
+        elif reference - point >= threshold or (climbing == -1 and point < reference):
+            loss += reference - point
+            reference = point
+            climbing = -1
+
+    return float(gain), float(loss)
+
+
+def _distance_from_segment(x, y, start_x, start_y, end_x, end_y):
+    """
+    Calculate the distance from each point to the line segment between the start and end points.
+    :param x: (numpy array) The x coordinate of each point.
+    :param y: (numpy array) The y coordinate of each point.
+    :param start_x: (float) The x coordinate of the start of the segment.
+    :param start_y: (float) The y coordinate of the start of the segment.
+    :param end_x: (float) The x coordinate of the end of the segment.
+    :param end_y: (float) The y coordinate of the end of the segment.
+    :return: (numpy array) The distance from each point to the segment.
+    """
+    segment_x = end_x - start_x
+    segment_y = end_y - start_y
+    segment_length_squared = segment_x ** 2 + segment_y ** 2
+
+    if segment_length_squared == 0:
+        return np.hypot(x - start_x, y - start_y)
+
+    # Position of each point along the segment, clamped to the ends of the segment.
+    position = np.clip(((x - start_x) * segment_x + (y - start_y) * segment_y) / segment_length_squared, 0, 1)
+
+    return np.hypot(x - (start_x + position * segment_x), y - (start_y + position * segment_y))
+
+
+def simplify_track(latitude, longitude, max_points):
+    """
+    Simplify a GPS track to at most max_points points using the Douglas-Peucker algorithm. Instead of using a distance
+    tolerance, the segment with the point furthest from it is always split next, so the points that change the shape of
+    the track the most are kept first until max_points is reached. Points without a position are removed.
+    :param latitude: (numpy array) Latitude of each point in degrees.
+    :param longitude: (numpy array) Longitude of each point in degrees.
+    :param max_points: (int) The highest number of points to keep.
+    :return: (tuple) The latitude and longitude numpy arrays of the simplified track.
+    """
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    has_position = ~(np.isnan(latitude) | np.isnan(longitude))
+    latitude = latitude[has_position]
+    longitude = longitude[has_position]
+
+    if len(latitude) <= max_points:
+        return latitude, longitude
+
+    # Project the points onto a flat plane so the distances in both directions are comparable.
+    x = np.radians(longitude) * np.cos(np.radians(np.mean(latitude)))
+    y = np.radians(latitude)
+
+    keep = np.zeros(len(latitude), dtype=bool)
+    keep[[0, -1]] = True
+    segments = []
+
+    def add_segment(start, end):
+        if end - start < 2:
+            return
+        distances = _distance_from_segment(x[start + 1:end], y[start + 1:end], x[start], y[start], x[end], y[end])
+        furthest = int(np.argmax(distances))
+        heapq.heappush(segments, (-distances[furthest], start, end, start + 1 + furthest))
+
+    add_segment(0, len(latitude) - 1)
+    points_kept = 2
+
+    while segments and points_kept < max_points:
+        negative_distance, start, end, furthest = heapq.heappop(segments)
+
+        # The rest of the points are on the simplified track already.
+        if negative_distance == 0:
+            break
+
+        keep[furthest] = True
+        points_kept += 1
+        add_segment(start, furthest)
+        add_segment(furthest, end)
+
+    return latitude[keep], longitude[keep]
+
+
+def encode_polyline(latitude, longitude, precision=5):
+    """
+    Encode a GPS track using the encoded polyline algorithm format, which stores each point as the difference from the
+    previous point in a few printable characters.
+    :param latitude: (numpy array) Latitude of each point in degrees.
+    :param longitude: (numpy array) Longitude of each point in degrees.
+    :param precision: (int) The number of decimal places of the coordinates that are kept.
+    :return: (str) The encoded polyline.
+    """
+    factor = 10 ** precision
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    points = np.column_stack((np.round(latitude * factor), np.round(longitude * factor))).astype(np.int64)
+    deltas = np.diff(points, axis=0, prepend=[[0, 0]]).ravel()
+
+    encoded = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        encoded.append(chr(value + 63))
+
+    return ''.join(encoded)
+
+
+def decode_polyline(encoded, precision=5):
+    """
+    Decode a polyline in the encoded polyline algorithm format, the reverse of encode_polyline().
+    :param encoded: (str) The encoded polyline.
+    :param precision: (int) The number of decimal places the coordinates were encoded with.
+    :return: (tuple) The latitude and longitude numpy arrays of the track.
+    """
+    values = []
+    value = 0
+    shift = 0
+    for character in encoded:
+        chunk = ord(character) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = 0
+            shift = 0
+
+    points = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
+    return points[:, 0], points[:, 1]
+
+
+def route_polyline(frame, max_points):
+    """
+    Simplify and encode the GPS track of an activity for the route map.
+    :param frame: (Pandas dataframe) The sample frame of the activity.
+    :param max_points: (int) The highest number of points on the simplified track.
+    :return: (str) The encoded polyline, or None if the activity has no GPS data.
+    """
+    latitude, longitude = simplify_track(frame['latitude'].to_numpy(), frame['longitude'].to_numpy(), max_points)
+
+    if len(latitude) < 2:
+        return None
+
+    return encode_polyline(latitude, longitude)
+
+
+def resample_to_seconds(time, values, max_gap):
+    """
+    Resample a channel to one value per second by linear interpolation, so that a window of n values is always n
+    seconds long. Seconds inside a gap of more than max_gap seconds between two recorded values are NaN.
+    :param time: (numpy array) Elapsed time of each sample in seconds.
+    :param values: (numpy array) The value of each sample.
+    :param max_gap: (int) The longest gap in seconds that is interpolated.
+    :return: (numpy array) The value of each second, starting at the first recorded value.
+    """
+    time = np.asarray(time, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    recorded = ~(np.isnan(time) | np.isnan(values))
+    order = np.argsort(time[recorded], kind='stable')
+    time = time[recorded][order]
+    values = values[recorded][order]
+
+    if len(time) < 2:
+        return np.empty(0)
+
+    seconds = np.arange(time[0], time[-1] + 1)
+    resampled = np.interp(seconds, time, values)
+
+    next_sample = np.searchsorted(time, seconds).clip(1, len(time) - 1)
+    resampled[time[next_sample] - time[next_sample - 1] > max_gap] = np.nan
+
+    return resampled
+
+
+def mean_maximal_curve(values, durations):
+    """
+    Calculate the best average value over each duration, for example the best 5 minute average power. The averages
+    of every window of a duration are calculated at once from the difference of two prefix sums, so each duration
+    takes O(n) instead of O(n * duration). Windows that include a missing value are not used.
+    :param values: (numpy array) The value of each second, from resample_to_seconds().
+    :param durations: (list) The window lengths in seconds.
+    :return: (list) The best average for each duration, or None if the activity has no complete window that long.
+    """
+    recorded = ~np.isnan(values)
+    sums = np.concatenate(([0], np.cumsum(np.where(recorded, values, 0))))
+    counts = np.concatenate(([0], np.cumsum(recorded)))
+
+    curve = []
+    for duration in durations:
+        if duration > len(values):
+            curve.append(None)
+            continue
+
+        complete = counts[duration:] - counts[:-duration] == duration
+        if not complete.any():
+            curve.append(None)
+            continue
+
+        window_sums = sums[duration:] - sums[:-duration]
+        curve.append(float(window_sums[complete].max() / duration))
+
+    return curve
+
+
+def heart_rate_histogram(time, heart_rate, max_gap):
+    """
+    Calculate the time spent at each heart rate, rounded to the nearest beat per minute. Each sample counts for the time
+    until the next sample, and gaps longer than max_gap seconds (paused recordings) are not counted. The heart rate
+    zone times are calculated from this histogram, so they can be recalculated without reading the activity file again
+    when the zone boundaries change.
+    :param time: (numpy array) Elapsed time of each sample in seconds.
+    :param heart_rate: (numpy array) Heart rate of each sample in beats per minute.
+    :param max_gap: (int) The longest time in seconds that one sample is counted for.
+    :return: (dict) The number of seconds spent at each heart rate.
+    """
+    time = np.asarray(time, dtype=np.float64)
+    heart_rate = np.asarray(heart_rate, dtype=np.float64)
+
+    sample_seconds = np.diff(time, append=time[-1:])
+    sample_seconds[(sample_seconds < 0) | (sample_seconds > max_gap)] = 0
+    recorded = ~(np.isnan(heart_rate) | np.isnan(sample_seconds)) & (heart_rate > 0)
+
+    if not recorded.any():
+        return {}
+
+    seconds = np.bincount(np.rint(heart_rate[recorded]).astype(np.int64), weights=sample_seconds[recorded])
+    return {int(bpm): float(seconds[bpm]) for bpm in np.flatnonzero(seconds)}
+
+
+def best_efforts(time, distance, target_distances):
+    """
+    Find the fastest time over each target distance with a two pointer sweep over the cumulative distance. For each
+    end sample, the start pointer moves forward while the distance from the next sample is still long enough, so each
+    target distance takes O(n). The start time is interpolated between samples so the effort covers exactly the target
+    distance.
+    :param time: (numpy array) Elapsed time of each sample in seconds.
+    :param distance: (numpy array) Cumulative distance of each sample in meters.
+    :param target_distances: (list) The distances to find the best efforts for, in meters.
+    :return: (list) The (elapsed seconds, start seconds) of the best effort for each target distance, or None if the
+    activity is shorter than the target distance.
+    """
+    time = np.asarray(time, dtype=np.float64)
+    distance = np.asarray(distance, dtype=np.float64)
+    recorded = ~(np.isnan(time) | np.isnan(distance))
+    time = time[recorded].tolist()
+    distance = np.maximum.accumulate(distance[recorded]).tolist()
+
+    efforts = []
+    for target in target_distances:
+        if not distance or distance[-1] - distance[0] < target:
+            efforts.append(None)
+            continue
+
+        best = None
+        start = 0
+        for end in range(len(distance)):
+            if distance[end] - distance[0] < target:
+                continue
+
+            while distance[end] - distance[start + 1] >= target:
+                start += 1
+
+            # The effort starts between the start sample and the next sample.
+            start_distance = distance[end] - target
+            step = distance[start + 1] - distance[start]
+            start_time = time[start]
+            if step > 0:
+                start_time += (time[start + 1] - time[start]) * (start_distance - distance[start]) / step
+
+            if best is None or time[end] - start_time < best[0]:
+                best = (time[end] - start_time, start_time)
+
+        efforts.append(best)
+
+    return efforts
+
+
+def get_best_effort_sport(activity_type):
+    """
+    Get the sport an activity type is grouped under for the best efforts, defined in config.py.
+    :param activity_type: (str) The activity type.
+    :return: (str) The sport, or None if best efforts are not calculated for the activity type.
+    """
+    for sport, activity_types in Config.BEST_EFFORT_SPORTS.items():
+        if activity_type in activity_types:
+            return sport
+
+    return None
+
+
+def analyze_sample_frame(sample_frame, activity_type):
+    """
+    Calculate all the values that come from the streams of an activity.
+    :param sample_frame: (Pandas dataframe) The cleaned sample frame of the activity, from clean_sample_frame().
+    :param activity_type: (str) The activity type, used to decide if best efforts are calculated.
+    :return: (dict) The elevation gain and loss in meters, the encoded route polyline, the mean maximal curve of each
+    channel in Config.MEAN_MAX_CHANNELS, the best effort for each distance in Config.BEST_EFFORT_DISTANCES (runs and
+    rides only), and the heart rate histogram.
+    """
+    gain, loss = elevation_gain_and_loss(
+        sample_frame['altitude'],
+        Config.ELEVATION_GAIN_THRESHOLD,
+        Config.ELEVATION_SMOOTHING_WINDOW
+    )
+
+    mean_max_curves = {}
+    for channel in Config.MEAN_MAX_CHANNELS:
+        if sample_frame[channel].notna().any():
+            mean_max_curves[channel] = mean_maximal_curve(
+                resample_to_seconds(sample_frame['time'], sample_frame[channel], Config.MEAN_MAX_MAX_GAP),
+                Config.MEAN_MAX_DURATIONS
+            )
+
+    efforts = {}
+    if get_best_effort_sport(activity_type):
+        efforts = dict(zip(
+            Config.BEST_EFFORT_DISTANCES,
+            best_efforts(sample_frame['time'], sample_frame['distance'], Config.BEST_EFFORT_DISTANCES.values())
+        ))
+
+    return {
+        'elevation_gain': gain,
+        'elevation_loss': loss,
+        'route_polyline': route_polyline(sample_frame, Config.ROUTE_MAX_POINTS),
+        'mean_max_curves': mean_max_curves,
+        'best_efforts': efforts,
+        'heart_rate_histogram': heart_rate_histogram(
+            sample_frame['time'],
+            sample_frame['heart_rate'],
+            Config.HEART_RATE_ZONE_MAX_GAP
+        ),
+    }
+
+
+def analyze_activity(activity_file, activity_type):
+    """
+    Read an activity file and calculate all the values that come from its streams. This runs in a separate process for
+    each activity while the activities are imported, so it only takes and returns plain values.
+    :param activity_file: (tuple) The file_path and zip_member_name arguments of read_stored_activity_file(), or None
+    if the activity has no activity file.
+    :param activity_type: (str) The activity type, used to choose the outlier filter settings.
+    :return: (dict) The values from analyze_sample_frame(), or None if the activity file could not be read.
+    """
+    if activity_file is None:
+        return None
+
+    try:
+        sample_frame = read_stored_activity_file(*activity_file)
+    except Exception as e:
+        print(f'Error reading the activity file {activity_file[-1] or activity_file[0]}: {e}')
+        return None
+
+    if sample_frame is None:
+        return None
+
+    return analyze_sample_frame(clean_sample_frame(sample_frame, activity_type), activity_type)
+
+
+def summarize_sample_frame(sample_frame):
+    """
+    Calculate the summary of an activity that is normally read from the Strava or Garmin export, from its streams.
+    The moving time counts the samples faster than Config.MOVING_SPEED_THRESHOLD, with gaps longer than
+    Config.MOVING_TIME_MAX_GAP not counted.
+    :param sample_frame: (Pandas dataframe) The cleaned sample frame of the activity, from clean_sample_frame().
+    :return: (dict) The duration and moving time in seconds, the distance in meters, the max speed in meters per
+    second, and the highest altitude in meters (None if it was not recorded).
+    """
+    time_diff = np.diff(sample_frame['time'].to_numpy(), prepend=0.0)
+    moving = (sample_frame['speed'] >= Config.MOVING_SPEED_THRESHOLD) & (time_diff <= Config.MOVING_TIME_MAX_GAP)
+
+    def maximum(channel):
+        return None if sample_frame[channel].isna().all() else float(sample_frame[channel].max())
+
+    return {
+        'duration_seconds': float(sample_frame['time'].max()),
+        'moving_time_seconds': float(time_diff[moving.to_numpy()].sum()),
+        'distance': maximum('distance') or 0.0,
+        'max_speed': maximum('speed') or 0.0,
+        'highest_elevation': maximum('altitude'),
+    }
+
+
+def analyze_new_activity_file(activity_file):
+    """
+    Read an activity file that is not in the Strava or Garmin export yet, and calculate both its summary and the values
+    that come from its streams. The activity type and name are the ones recorded in the file. This runs in a separate
+    process for each file, so it only takes and returns plain values.
+    :param activity_file: (tuple) The file_path and zip_member_name arguments of read_stored_activity_file().
+    :return: (dict) The start time in seconds since the epoch, the activity type and name, the values from
+    summarize_sample_frame() and the values from analyze_sample_frame() under 'streams', or None if the file could not
+    be read or has no samples.
+    """
+    try:
+        sample_frame = read_stored_activity_file(*activity_file)
+    except Exception as e:
+        print(f'Error reading the activity file {activity_file[-1] or activity_file[0]}: {e}')
+        return None
+
+    if sample_frame is None or len(sample_frame) == 0 or pd.isna(sample_frame.attrs['start_time']):
+        return None
+
+    activity_type = sample_frame.attrs['activity_type'] or 'other'
+    sample_frame_attrs = dict(sample_frame.attrs)
+    sample_frame = clean_sample_frame(sample_frame, activity_type)
+
+    return {
+        'start_time_utc': int(sample_frame_attrs['start_time']),
+        'activity_type': activity_type,
+        'activity_name': sample_frame_attrs['activity_name'],
+        **summarize_sample_frame(sample_frame),
+        'streams': analyze_sample_frame(sample_frame, activity_type),
+    }
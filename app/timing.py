@@ -0,0 +1,199 @@
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import threading
+import time
+
+from flask import g, has_request_context
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import Config
+
+# The durations in milliseconds of the last Config.TIMING_SAMPLE_SIZE requests of each route, for each stage and the
+# whole request. Only a few floats are added per request, so the timings are always recorded.
+_samples = defaultdict(lambda: deque(maxlen=Config.TIMING_SAMPLE_SIZE))
+_samples_lock = threading.Lock()
+
+
+class _Recorders(threading.local):
+    """
+    The open record_queries() and record_stages() blocks of each thread, so a block only records the statements and
+    stages run by its own thread, and not the ones of requests served by other threads at the same time.
+    """
+
+    def __init__(self):
+        self.queries = []  # The lists of statements of the open record_queries() blocks.
+        self.stages = []  # The stage timings of the open record_stages() blocks.
+
+
+_recorders = _Recorders()
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time a stage of the current request. The time of every span with the same stage name is added together, so a stage
+    that runs in a loop is reported once. The span is also added to the open record_stages() blocks, so the import
+    command can report its stages outside a request.
+    :param stage: (str) The name of the stage, used as the Server-Timing metric name.
+    :return: None
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        milliseconds = (time.perf_counter() - start) * 1000
+
+        if has_request_context():
+            stage_timings = g.setdefault('stage_timings', {})
+            stage_timings[stage] = stage_timings.get(stage, 0) + milliseconds
+
+        for stage_timings in _recorders.stages:
+            stage_timings[stage] = stage_timings.get(stage, 0) + milliseconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timing(conn, cursor, statement, parameters, context, executemany):
+    """
+    Save the start time of a SQL statement on its connection.
+    :param conn: (Connection) The connection that runs the statement.
+    :return: None
+    """
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_query_timing(conn, cursor, statement, parameters, context, executemany):
+    """
+    Count a SQL statement and add its time to the db stage of the current request. Statements slower than
+    Config.SLOW_QUERY_MS are printed with their bound parameters.
+    :param conn: (Connection) The connection that ran the statement.
+    :param statement: (str) The SQL statement.
+    :param parameters: (tuple) The bound parameters of the statement.
+    :return: None
+    """
+    milliseconds = (time.perf_counter() - conn.info['query_start'].pop()) * 1000
+
+    if has_request_context():
+        stage_timings = g.setdefault('stage_timings', {})
+        stage_timings['db'] = stage_timings.get('db', 0) + milliseconds
+        g.query_count = g.get('query_count', 0) + 1
+
+    for statements in _recorders.queries:
+        statements.append(statement)
+
+    if milliseconds >= Config.SLOW_QUERY_MS:
+        print(f'Slow query ({milliseconds:.1f} ms): {statement} | parameters: {parameters}')
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timing(exception_context):
+    """
+    Remove the start time of a SQL statement that failed, so finish_query_timing() does not time the next statement of
+    the connection from it.
+    :param exception_context: (ExceptionContext) The failed statement and its connection.
+    :return: None
+    """
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_start'):
+        connection.info['query_start'].pop()
+
+
+@contextmanager
+def record_queries():
+    """
+    Record every SQL statement run inside the block by the current thread, for example to check how many queries a page
+    needs.
+    :return: (list) The statements, filled in as they run.
+    """
+    statements = []
+    _recorders.queries.append(statements)
+    try:
+        yield statements
+    finally:
+        _recorders.queries.remove(statements)
+
+
+@contextmanager
+def record_stages():
+    """
+    Record the time of every timed() span run inside the block by the current thread, in the order the stages first
+    finish.
+    :return: (dict) The milliseconds of each stage, filled in as the spans finish.
+    """
+    stage_timings = {}
+    _recorders.stages.append(stage_timings)
+    try:
+        yield stage_timings
+    finally:
+        _recorders.stages.remove(stage_timings)
+
+
+def start_request_timing():
+    """
+    Save the start time of the current request and start with no stage timings. The app context, where g is saved, can
+    be shared by several requests, for example in the tests.
+    :return: None
+    """
+    g.stage_timings = {}
+    g.query_count = 0
+    g.request_start = time.perf_counter()
+
+
+def finish_request_timing(route):
+    """
+    Add the stage timings, the total time and the number of SQL statements of the current request to the rolling
+    samples of its route. The db stage is the time spent in SQL statements, which is also part of the other stages.
+    :param route: (str) The URL rule of the request, so every activity page is counted as one route.
+    :return: (dict) The milliseconds of each stage and of the whole request (total), and the number of statements
+    (queries).
+    """
+    timings = dict(g.get('stage_timings', {}))
+    timings['total'] = (time.perf_counter() - g.get('request_start', time.perf_counter())) * 1000
+    timings['queries'] = g.get('query_count', 0)
+
+    with _samples_lock:
+        for stage, milliseconds in timings.items():
+            _samples[(route, stage)].append(milliseconds)
+
+    return timings
+
+
+def format_server_timing(timings):
+    """
+    Format stage timings as a Server-Timing header, which the browser developer tools show in the network timing tab.
+    The number of SQL statements is sent as the description of the queries metric.
+    :param timings: (dict) The milliseconds of each stage and the number of queries, from finish_request_timing().
+    :return: (str) The header value.
+    """
+    return ', '.join(
+        f'{stage};desc="{value}"' if stage == 'queries' else f'{stage};dur={value:.1f}'
+        for stage, value in timings.items()
+    )
+
+
+def get_timing_summary():
+    """
+    Calculate the 50th and 95th percentile of the recent timings of every route and stage.
+    :return: (list) A dictionary with the route, stage, count, p50 and p95 of each stage, sorted by route with the
+    total of each route first.
+    """
+    with _samples_lock:
+        samples = {key: list(values) for key, values in _samples.items()}
+
+    summary = []
+    for (route, stage), values in samples.items():
+        p50, p95 = np.percentile(values, [50, 95])
+        summary.append({'route': route, 'stage': stage, 'count': len(values), 'p50': p50, 'p95': p95})
+
+    return sorted(summary, key=lambda row: (row['route'], row['stage'] != 'total', -row['p50']))
+
+
+def clear_timings():
+    """
+    Remove every recorded timing.
+    :return: None
+    """
+    with _samples_lock:
+        _samples.clear()
@@ -0,0 +1,192 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import time
+
+from flask import current_app
+
+from config import Config
+
+# The inotify events of a file that was written and closed, or moved into a watched folder.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+# The activity files the importer reads from each upload folder.
+STRAVA_ACTIVITY_FILE_PATTERNS = ['*.fit', '*.fit.gz', '*.gpx', '*.gpx.gz', '*.tcx', '*.tcx.gz']
+GARMIN_ACTIVITY_FILE_PATTERNS = ['UploadedFiles*.zip']
+
+
+def get_watched_folders():
+    """
+    Get the upload folders that new activity files are copied to, and the file name patterns read from each one.
+    :return: (dict) The folder path as the key and the list of file name patterns as the value.
+    """
+    return {
+        os.path.join(Config.UPLOAD_FOLDER_STRAVA, 'activities'): STRAVA_ACTIVITY_FILE_PATTERNS,
+        Config.GARMIN_ACTIVITY_CSV_FILE_DIR: GARMIN_ACTIVITY_FILE_PATTERNS,
+    }
+
+
+def is_activity_file(file_path, folders):
+    """
+    Check if a file in a watched folder is an activity file the importer reads.
+    :param file_path: (str) The path of the file.
+    :param folders: (dict) The watched folders and their file name patterns, from get_watched_folders().
+    :return: (bool) True if the file name matches one of the patterns of its folder.
+    """
+    patterns = folders.get(os.path.dirname(file_path), [])
+    return any(fnmatch.fnmatch(os.path.basename(file_path).lower(), pattern.lower()) for pattern in patterns)
+
+
+class InotifyWatcher:
+    """
+    This class watches folders with the Linux inotify API, through ctypes so no extra package is needed. Only the files
+    that were closed after writing or moved into a folder are reported, so a file is not reported while it is copied.
+    """
+
+    def __init__(self, folders):
+        """
+        :param folders: (list) The paths of the folders to watch. Files in subfolders are not watched.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.folders = {}
+        for folder in folders:
+            watch = libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if watch < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {folder}')
+            self.folders[watch] = folder
+
+    def poll(self, timeout):
+        """
+        Wait for files to be written to the watched folders.
+        :param timeout: (float) The most seconds to wait.
+        :return: (set) The paths of the files that were written.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        data = os.read(self.fd, 64 * 1024)
+        file_paths = set()
+        offset = 0
+        while offset < len(data):
+            watch, mask, cookie, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name and watch in self.folders:
+                file_paths.add(os.path.join(self.folders[watch], os.fsdecode(name)))
+
+        return file_paths
+
+    def close(self):
+        """
+        Stop watching the folders.
+        :return: None
+        """
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    This class watches folders by listing them every poll, for systems without inotify. A file is reported when it
+    appears or its size or modification time changes.
+    """
+
+    def __init__(self, folders):
+        """
+        :param folders: (list) The paths of the folders to watch. Files in subfolders are not watched.
+        """
+        self.folders = list(folders)
+        self.files = self._list_files()
+
+    def _list_files(self):
+        """
+        List the files in the watched folders.
+        :return: (dict) The path of each file as the key and its size and modification time as the value.
+        """
+        files = {}
+        for folder in self.folders:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def poll(self, timeout):
+        """
+        Wait, then report the files that were added or changed since the last poll.
+        :param timeout: (float) The seconds to wait.
+        :return: (set) The paths of the files that were added or changed.
+        """
+        time.sleep(timeout)
+        files = self._list_files()
+        file_paths = {file_path for file_path, stat in files.items() if self.files.get(file_path) != stat}
+        self.files = files
+        return file_paths
+
+    def close(self):
+        """
+        Stop watching the folders.
+        :return: None
+        """
+        self.files = {}
+
+
+def create_folder_watcher(folders, polling=False):
+    """
+    Create an inotify watcher for the folders, or a polling watcher if inotify is not available or polling is set.
+    :param folders: (list) The paths of the folders to watch.
+    :param polling: (bool) Always use the polling watcher.
+    :return: (InotifyWatcher or PollingWatcher) The watcher.
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(folders)
+        except (AttributeError, OSError) as e:
+            print(f'inotify is not available ({e}), checking the folders every {Config.WATCH_POLL_INTERVAL} s instead.')
+
+    return PollingWatcher(folders)
+
+
+def watch_activity_folders(import_files, polling=False, stop=None):
+    """
+    Watch the upload folders and import the new activity files. The files are collected until none has changed for
+    Config.WATCH_DEBOUNCE_SECONDS, so a folder of files copied at once is imported in one batch, and a file that is
+    still being copied is not read. A batch that fails to import is logged, and the folders are still watched.
+    :param import_files: (function) Called with the list of new file paths, for example import_new_activity_files()
+    from routes.py. Runs in the app context.
+    :param polling: (bool) Check the folders every Config.WATCH_POLL_INTERVAL seconds instead of using inotify.
+    :param stop: (threading.Event) Stops watching when set, or None to watch until interrupted.
+    :return: None
+    """
+    folders = get_watched_folders()
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    watcher = create_folder_watcher(folders, polling)
+    pending = {}
+    try:
+        while stop is None or not stop.is_set():
+            for file_path in watcher.poll(Config.WATCH_POLL_INTERVAL):
+                if is_activity_file(file_path, folders):
+                    pending[file_path] = time.monotonic()
+
+            if pending and time.monotonic() - max(pending.values()) >= Config.WATCH_DEBOUNCE_SECONDS:
+                file_paths = sorted(pending)
+                pending.clear()
+                try:
+                    import_files(file_paths)
+                except Exception:
+                    current_app.logger.exception(f'The new files {", ".join(file_paths)} could not be imported.')
+    finally:
+        watcher.close()
@@ -14,6 +14,19 @@ class Config:
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
     # DATABASE_PATH = f'instance/{DATABASE_NAME}'
     DATABASE_PATH = os.path.join(BASE_DIR, 'instance', DATABASE_NAME)
+    # Drop and recreate every table when the app starts, including the flask strava commands. The imported activities
+    # are kept by default, /create-db replaces them when the exports are imported again. A database created by an older
+    # version of the app is always rebuilt (see is_database_schema_stale() in models.py).
+    RESET_DATABASE_ON_START = os.getenv('RESET_DATABASE_ON_START', '0') == '1'
+    # The pragmas set on every new SQLite connection. In WAL mode the pages keep reading while an import writes, and
+    # synchronous=NORMAL is safe with WAL. The negative cache_size is in KiB (64 MB), mmap_size is in bytes (256 MB).
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    }
     ACTIVITY_TABLE_NAME = 'activity'
     WORKOUTS_TABLE_NAME = 'workouts'
     EXERCISES_TABLE_NAME = 'exercises'
@@ -32,6 +45,13 @@ class Config:
     ALLOWED_EXTENSIONS = {'gpx', 'fit', 'tcx', 'gz'}
     INDOOR_ACTIVITIES = ['Workout', 'Weight Training', 'Rowing']  # Define indoor activities
     PER_PAGE = 10
+    MAX_PER_PAGE = 1000
+    # The activity columns read for each row of the activities table.
+    LISTING_COLUMNS = [
+        'id', 'strava_activity_id', 'garmin_activity_id', 'activity_name', 'local_start_time', 'duration_seconds',
+        'distance', 'average_speed', 'max_speed', 'elevation_gain', 'highest_elevation', 'activity_type',
+        'activity_gear',
+    ]
     TEXT_SEARCH = ''
     SELECTED_ACTIVITY_TYPE = ''
     SELECTED_ACTIVITY_GEAR = ''
@@ -54,6 +74,100 @@ class Config:
     MAX_AVERAGE_SPEED_VALUE = ''
     MIN_MAX_SPEED_VALUE = ''
     MAX_MAX_SPEED_VALUE = ''
+    HEART_RATE_ZONE_PERCENTAGES = [0.5, 0.6, 0.7, 0.8, 0.9]  # The start of zones 1 to 5 as a fraction of the max HR.
+    HEART_RATE_ZONE_BOUNDARIES = None  # The zones last calculated on the HR Zones page, None uses the zones for USER_AGE.
+    # The activity columns in the activity export, and the number of rows read from the database at a time.
+    EXPORT_COLUMNS = [
+        'strava_activity_id', 'garmin_activity_id', 'activity_name', 'activity_description', 'local_start_time',
+        'start_time_utc', 'utc_offset_seconds', 'duration_seconds', 'distance', 'average_speed', 'max_speed',
+        'elevation_gain', 'calculated_elevation_gain', 'calculated_elevation_loss', 'highest_elevation', 'activity_type',
+        'activity_gear',
+    ]
+    EXPORT_BATCH_SIZE = 1000
+    # The number of recent requests of each route kept for the percentiles on the /debug/perf page.
+    TIMING_SAMPLE_SIZE = 1000
+    SLOW_QUERY_MS = 100  # SQL statements that take longer are printed with their parameters.
+    # Any request with ?_profile=1 from these addresses is profiled, and the profile is saved in PROFILE_FOLDER.
+    PROFILE_ALLOWED_ADDRESSES = ['127.0.0.1', '::1']
+    PROFILE_FOLDER = os.path.join(BASE_DIR, 'instance', 'profiles')
+    PROFILE_INTERVAL = 0.001  # Seconds between the stack samples.
+    PROFILE_TOP_N = 30
+
+    # Variables used in streams.py
+    # Outlier filter settings for the activity streams. Speeds are in meters per second, min_deviation is in meters or
+    # meters per second, and the window is the number of samples used for the rolling median. Activity types that are
+    # not listed use the defaults.
+    STREAM_FILTER_DEFAULTS = {
+        'max_speed': 45,  # ~100 MPH
+        'max_vertical_speed': 10,
+        'window': 7,
+        'n_sigmas': 3,
+        'min_deviation': 1,
+    }
+    STREAM_FILTER_SETTINGS = {
+        'Ride': {'max_speed': 30},  # ~67 MPH
+        'cycling': {'max_speed': 30},
+        'road_biking': {'max_speed': 30},
+        'mountain_biking': {'max_speed': 25},
+        'Run': {'max_speed': 12, 'max_vertical_speed': 3},
+        'running': {'max_speed': 12, 'max_vertical_speed': 3},
+        'street_running': {'max_speed': 12, 'max_vertical_speed': 3},
+        'Walk': {'max_speed': 5, 'max_vertical_speed': 2},
+        'walking': {'max_speed': 5, 'max_vertical_speed': 2},
+        'casual_walking': {'max_speed': 5, 'max_vertical_speed': 2},
+        'Hike': {'max_speed': 5, 'max_vertical_speed': 2},
+        'hiking': {'max_speed': 5, 'max_vertical_speed': 2},
+        'Inline Skate': {'max_speed': 20},
+        'inline_skating': {'max_speed': 20},
+        'Swim': {'max_speed': 4, 'max_vertical_speed': 1},
+        'lap_swimming': {'max_speed': 4, 'max_vertical_speed': 1},
+        'Kayaking': {'max_speed': 8, 'max_vertical_speed': 1},
+    }
+    ELEVATION_GAIN_THRESHOLD = 3  # The smallest climb or descent, in meters, that is counted as elevation gain or loss.
+    ELEVATION_SMOOTHING_WINDOW = 5  # The number of samples used to smooth the altitude before calculating the gain.
+    # The calculated elevation gain is flagged when it is more than the ratio and more than the number of feet away from
+    # the elevation gain in the Strava or Garmin export.
+    ELEVATION_GAIN_MISMATCH_RATIO = 0.25
+    ELEVATION_GAIN_MISMATCH_FEET = 100
+    ROUTE_MAX_POINTS = 500  # The number of points the route map track is simplified to.
+    MEAN_MAX_CHANNELS = ['power', 'heart_rate']  # The channels with a mean maximal (best average) curve.
+    MEAN_MAX_DURATIONS = [1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200]  # The curve durations in seconds.
+    MEAN_MAX_MAX_GAP = 10  # The longest recording gap, in seconds, that is interpolated for the curves.
+    SEASON_START_MONTH = 1  # The month each season starts in, used for the per-season curves. 1 is January.
+    # The distances, in meters, and the activity types of each sport that the best efforts are found for.
+    BEST_EFFORT_DISTANCES = {
+        '1 km': 1000,
+        '1 Mile': 1609.344,
+        '5 km': 5000,
+        '10 km': 10000,
+        'Half Marathon': 21097.5,
+    }
+    BEST_EFFORT_SPORTS = {
+        'Run': ['Run', 'running', 'street_running', 'trail_running', 'treadmill_running'],
+        'Ride': ['Ride', 'Virtual Ride', 'cycling', 'road_biking', 'mountain_biking', 'indoor_cycling'],
+    }
+    HEART_RATE_ZONE_MAX_GAP = 10  # The longest time, in seconds, that one heart rate sample is counted for.
+    MOVING_SPEED_THRESHOLD = 0.5  # The slowest speed, in meters per second, counted as moving time for new files.
+    MOVING_TIME_MAX_GAP = 10  # The longest recording gap, in seconds, counted as moving time for new files.
+    STREAM_PROCESS_WORKERS = None  # The number of processes that read the activity files, None uses every CPU.
+    ACTIVITY_TOTAL_PERIODS = ['week', 'month', 'year']  # The periods the activity totals are saved for.
+    NO_GEAR_NAME = 'No Gear Listed'  # The gear name the activity totals use for activities without gear.
+
+    # Variables used in heatmap.py
+    HEATMAP_TILE_FOLDER = os.path.join(BASE_DIR, 'instance', 'heatmap_tiles')
+    HEATMAP_TILE_SIZE = 256
+    HEATMAP_MIN_ZOOM = 0
+    HEATMAP_MAX_ZOOM = 14  # Higher zoom levels are enlarged from the tiles at this zoom level.
+    HEATMAP_SATURATION_COUNT = 20  # The number of activities through a pixel that is drawn in the brightest color.
+    HEATMAP_TILE_MAX_AGE = 3600  # The number of seconds browsers may cache a tile.
+
+    # Variables used in cache.py
+    CACHE_MAX_ENTRIES = 256  # The most values in the app level cache, the least recently used value is removed first.
+
+    # Variables used in watcher.py
+    WATCH_POLL_INTERVAL = 2  # The number of seconds between checks of the upload folders for new activity files.
+    WATCH_DEBOUNCE_SECONDS = 5  # The number of seconds a new file must be unchanged before it is imported.
+    WATCH_MATCH_SECONDS = 60  # The most seconds a new file's start time may differ from an activity it belongs to.
 
     # Variables in __init__.py
     UPLOAD_FOLDER_STRAVA = 'uploads/Strava'  # Define the directory where the Strava activity files will be saved.
@@ -1,13 +1,35 @@
+import os
 import pytest
+from contextlib import contextmanager
+from datetime import datetime
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+
+os.environ.setdefault('RESET_DATABASE_ON_START', '1')  # The tests start with empty tables.
 from run import app
+from app.cache import clear_cache
+from app.database import Database
+from app.models import Activity, BestEffort, HeartRateHistogram, MeanMaxCurve, db
+from app.timing import record_queries
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
 
 Base = declarative_base()
 
+@contextmanager
+def assert_max_queries(max_queries):
+    """
+    Fail if the code in the block runs more than max_queries SQL statements, and list the statements that ran.
+    :param max_queries: (int) The most statements the block may run.
+    :return: (list) The statements, filled in as they run.
+    """
+    with record_queries() as statements:
+        yield statements
+    assert len(statements) <= max_queries, (
+        f'{len(statements)} queries, expected at most {max_queries}:\n' + '\n'.join(statements)
+    )
+
 @pytest.fixture
 def driver():
     """Set up and return the WebDriver instance for the tests."""
@@ -26,6 +48,116 @@ def client():
 
     yield client
 
+@pytest.fixture
+def sample_activities():
+    """Add a small set of activities to the database for the tests and remove them afterwards."""
+    activities = [
+        Activity(
+            strava_activity_id=1001,
+            activity_name='Morning Ride',
+            activity_description='Up the hill and back',
+            start_time=datetime(2024, 5, 4, 8, 0, 0),
+            start_time_utc=1714834800,
+            activity_duration='1:00:00',
+            moving_time_seconds=3600,
+            duration_seconds=3600,
+            distance=20.5,
+            average_speed=20.5,
+            max_speed=35.2,
+            elevation_gain=1200,
+            highest_elevation=1500,
+            activity_type='Ride',
+            activity_gear='Road Bike',
+            route_polyline='_p~iF~ps|U_ulLnnqC_mqNvxq`@',
+            mean_max_curve=[
+                MeanMaxCurve(channel='power', duration_seconds=5, value=600, season=2024),
+                MeanMaxCurve(channel='power', duration_seconds=60, value=350, season=2024),
+                MeanMaxCurve(channel='heart_rate', duration_seconds=60, value=175, season=2024),
+            ],
+            best_efforts=[
+                BestEffort(sport='Ride', distance_name='5 km', distance_meters=5000, elapsed_seconds=550,
+                           start_seconds=100),
+                BestEffort(sport='Ride', distance_name='10 km', distance_meters=10000, elapsed_seconds=1400,
+                           start_seconds=100),
+            ],
+            heart_rate_histogram=[
+                HeartRateHistogram(heart_rate=100, seconds=600),
+                HeartRateHistogram(heart_rate=150, seconds=300),
+                HeartRateHistogram(heart_rate=190, seconds=60),
+            ],
+        ),
+        Activity(
+            strava_activity_id=1002,
+            activity_name='Last Year Ride',
+            activity_description='Flat',
+            start_time=datetime(2023, 7, 1, 9, 0, 0),
+            start_time_utc=1688227200,
+            activity_duration='2:00:00',
+            moving_time_seconds=7200,
+            duration_seconds=7200,
+            distance=40,
+            average_speed=20,
+            max_speed=30,
+            elevation_gain=200,
+            highest_elevation=300,
+            activity_type='Ride',
+            activity_gear='Road Bike',
+            mean_max_curve=[
+                MeanMaxCurve(channel='power', duration_seconds=5, value=550, season=2023),
+                MeanMaxCurve(channel='power', duration_seconds=60, value=380, season=2023),
+                MeanMaxCurve(channel='power', duration_seconds=3600, value=220, season=2023),
+            ],
+            best_efforts=[
+                BestEffort(sport='Ride', distance_name='5 km', distance_meters=5000, elapsed_seconds=600,
+                           start_seconds=0),
+                BestEffort(sport='Ride', distance_name='10 km', distance_meters=10000, elapsed_seconds=1300,
+                           start_seconds=0),
+            ],
+            heart_rate_histogram=[
+                HeartRateHistogram(heart_rate=120, seconds=1200),
+            ],
+        ),
+        Activity(
+            garmin_activity_id=2002,
+            activity_name='Evening Run',
+            activity_description='Easy run',
+            start_time=datetime(2024, 5, 5, 18, 30, 0),
+            start_time_utc=1714959000,
+            activity_duration='30:00',
+            moving_time_seconds=1800,
+            duration_seconds=1800,
+            distance=3.1,
+            average_speed=6.2,
+            max_speed=9.0,
+            elevation_gain=50,
+            highest_elevation=100,
+            activity_type='Run',
+            activity_gear='No Gear Listed',
+            best_efforts=[
+                BestEffort(sport='Run', distance_name='1 Mile', distance_meters=1609.344, elapsed_seconds=480,
+                           start_seconds=60),
+            ],
+        ),
+    ]
+
+    with app.app_context():
+        db.session.add_all(activities)
+        db.session.commit()
+        clear_cache()
+        Database().update_heart_rate_zone_times()
+        Database().rebuild_activity_totals()
+
+    yield activities
+
+    with app.app_context():
+        for activity in Activity.query.filter(
+            Activity.strava_activity_id.in_([1001, 1002]) | Activity.garmin_activity_id.in_([2002])
+        ).all():
+            db.session.delete(activity)
+        db.session.commit()
+        Database().rebuild_activity_totals()
+        clear_cache()
+
 @pytest.fixture(scope='session')
 def db_session():
     engine = create_engine('sqlite:///strava_data.db')
@@ -0,0 +1,76 @@
+from app.heatmap import lat_lon_to_pixel, load_heatmap_tile, rasterize_track, update_heatmap_tiles
+from app.streams import encode_polyline
+from config import Config
+from test.unit.webapp import client
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def heatmap_tile_folder(tmp_path, monkeypatch):
+    """
+    Save the heatmap tiles in a temporary folder and only build the lower zoom levels.
+    :return: (Path) The temporary tile folder.
+    """
+    monkeypatch.setattr(Config, 'HEATMAP_TILE_FOLDER', str(tmp_path))
+    monkeypatch.setattr(Config, 'HEATMAP_MAX_ZOOM', 12)
+    return tmp_path
+
+
+def test_rasterize_track():
+    """
+    This function tests that a rasterized track has no gaps between its points and that each pixel is only counted once.
+    :return: None.
+    """
+    latitude = np.array([37.0, 37.1, 37.0])
+    longitude = np.array([-122.0, -122.0, -122.0])
+
+    pixels = rasterize_track(latitude, longitude, 12)
+    x, y = lat_lon_to_pixel(latitude, longitude, 12)
+
+    assert len(pixels) == len(np.unique(pixels))
+    assert len(pixels) == int(y[0]) - int(y[1]) + 1
+    assert np.all(pixels % (Config.HEATMAP_TILE_SIZE * 2 ** 12) == int(x[0]))
+
+
+def test_update_heatmap_tiles(heatmap_tile_folder):
+    """
+    This function tests that the tiles count each activity once, and that importing the same activity again does not
+    change the tiles.
+    :param heatmap_tile_folder: The temporary tile folder.
+    :return: None.
+    """
+    polyline = encode_polyline([37.0, 37.1], [-122.0, -122.1])
+    activities = [
+        SimpleNamespace(strava_activity_id=1, garmin_activity_id=None, route_polyline=polyline),
+        SimpleNamespace(strava_activity_id=None, garmin_activity_id=2, route_polyline=polyline),
+        SimpleNamespace(strava_activity_id=3, garmin_activity_id=None, route_polyline=None),
+    ]
+
+    assert update_heatmap_tiles(activities) == 2
+    assert load_heatmap_tile(0, 0, 0).max() == 2
+
+    assert update_heatmap_tiles(activities) == 0
+    assert load_heatmap_tile(0, 0, 0).max() == 2
+
+    # Zoom levels above the highest saved zoom level are enlarged from the saved tiles.
+    assert load_heatmap_tile(14, 2637, 6374).shape == (Config.HEATMAP_TILE_SIZE, Config.HEATMAP_TILE_SIZE)
+    assert load_heatmap_tile(5, 0, 0) is None
+
+
+def test_heatmap_tile_route(client, heatmap_tile_folder):
+    """
+    This function tests that the tile endpoint returns PNG images with cache headers, and a 404 for tiles outside the
+    map.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param heatmap_tile_folder: The temporary tile folder.
+    :return: None.
+    """
+    tile = client.get('/tiles/3/1/2')
+    assert tile.status_code == 200
+    assert tile.mimetype == 'image/png'
+    assert tile.cache_control.max_age == Config.HEATMAP_TILE_MAX_AGE
+    assert client.get('/tiles/3/1/2', headers={'If-None-Match': tile.headers['ETag']}).status_code == 304
+
+    assert client.get('/tiles/3/8/2').status_code == 404
@@ -0,0 +1,137 @@
+from app import create_app
+from app.models import Activity, db, is_database_schema_stale
+from config import Config, TestingConfig
+from app.routes import apply_activity_filters, apply_keyset_pagination
+from sqlalchemy import desc, or_, text
+from test.unit.webapp import client
+import sqlite3
+
+
+def explain_query_plan(query):
+    """
+    Get the SQLite query plan of a query.
+    :param query: (Query) The SQLAlchemy query.
+    :return: (str) The detail column of every step of the query plan, one step per line.
+    """
+    sql = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    return '\n'.join(row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}')))
+
+
+def test_activity_listing_query_plan(client):
+    """
+    This function checks that the activities page queries use the indexes on the Activity table instead of scanning
+    and sorting the whole table.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        filters = {'type-options': 'Ride', 'start-date': '2024-01-01', 'end-date': '2024-12-31'}
+        plan = explain_query_plan(
+            apply_activity_filters(Activity.query, filters).order_by(desc(Activity.start_time_utc)).limit(10)
+        )
+        assert 'USING INDEX ix_activity_activity_type_start_time_utc' in plan
+        assert 'TEMP B-TREE' not in plan
+
+        plan = explain_query_plan(Activity.query.order_by(desc(Activity.start_time_utc)).limit(10))
+        assert 'USING INDEX ix_activity_start_time_utc' in plan
+
+        plan = explain_query_plan(Activity.query.order_by(Activity.distance).limit(10))
+        assert 'USING INDEX ix_activity_distance' in plan
+        assert 'TEMP B-TREE' not in plan
+
+        plan = explain_query_plan(Activity.query.order_by(Activity.duration_seconds).limit(10))
+        assert 'USING INDEX ix_activity_duration_seconds' in plan
+        assert 'TEMP B-TREE' not in plan
+
+
+def test_keyset_pagination_query_plan(client):
+    """
+    This function checks that a page after a cursor seeks into the index of the sort column instead of sorting the
+    table, for every column the activities page can be sorted by.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        sort_columns = [
+            Activity.start_time_utc, Activity.activity_name, Activity.duration_seconds, Activity.distance,
+            Activity.average_speed, Activity.max_speed, Activity.elevation_gain, Activity.highest_elevation,
+            Activity.activity_type,
+        ]
+        for sort_column in sort_columns:
+            plan = explain_query_plan(
+                apply_keyset_pagination(Activity.query, sort_column, True, (1, 1)).limit(10)
+            )
+            assert 'USING INDEX' in plan
+            assert 'TEMP B-TREE' not in plan
+
+
+def test_activity_detail_query_plan(client):
+    """
+    This function checks that finding an activity by its Strava or Garmin id uses the unique indexes on both ids.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        plan = explain_query_plan(Activity.query.filter(
+            or_(
+                Activity.strava_activity_id == 1001,
+                Activity.garmin_activity_id == 1001,
+            )
+        ))
+        assert 'ix_activity_strava_activity_id' in plan
+        assert 'ix_activity_garmin_activity_id' in plan
+        assert 'SCAN activity' not in plan
+
+
+def test_sqlite_pragmas(client):
+    """
+    This function checks that every connection uses WAL journaling and the pragmas in Config.SQLITE_PRAGMAS.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        assert db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert db.session.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+        assert db.session.execute(text('PRAGMA temp_store')).scalar() == 2  # MEMORY
+        assert db.session.execute(text('PRAGMA cache_size')).scalar() == Config.SQLITE_PRAGMAS['cache_size']
+
+
+def test_stale_database_schema(client, tmp_path, monkeypatch):
+    """
+    This function checks that the app rebuilds a database created by an older version of the app when it starts,
+    instead of keeping tables that are missing the new columns, indexes and full text index.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param tmp_path: The Pytest temporary folder, for the old database.
+    :param monkeypatch: Points the app at the old database and keeps the tables when it starts.
+    :return: None.
+    """
+    with client.application.app_context():
+        assert not is_database_schema_stale()
+
+    # The activity table of the first version of the app.
+    database_path = tmp_path / Config.DATABASE_NAME
+    connection = sqlite3.connect(database_path)
+    connection.execute("""
+        CREATE TABLE activity (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, strava_activity_id BIGINT, garmin_activity_id BIGINT,
+            activity_name VARCHAR(200), activity_description VARCHAR(1000), start_time DATETIME NOT NULL,
+            activity_duration VARCHAR(200) NOT NULL, moving_time_seconds INTEGER, distance FLOAT, average_speed FLOAT,
+            max_speed FLOAT, elevation_gain FLOAT, highest_elevation FLOAT, activity_type VARCHAR(40) NOT NULL,
+            activity_gear VARCHAR(50), strava_filename VARCHAR(100), garmin_filename VARCHAR(100)
+        )
+    """)
+    connection.execute(
+        "INSERT INTO activity (strava_activity_id, start_time, activity_duration, activity_type) "
+        "VALUES (1, '2024-05-04 08:00:00', '1:00:00', 'Ride')"
+    )
+    connection.commit()
+    connection.close()
+
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{database_path}')
+    monkeypatch.setattr(Config, 'RESET_DATABASE_ON_START', False)
+    app = create_app()
+
+    with app.app_context():
+        assert not is_database_schema_stale()
+        assert Activity.query.count() == 0
+    assert app.test_client().get('/activities').status_code == 200
@@ -1,9 +1,26 @@
-from test.unit.webapp import client, driver, db_session
+from test.unit.webapp import assert_max_queries, client, driver, db_session, sample_activities
+from app.cache import cached, clear_cache
+from app.models import Activity, HeartRateHistogram, HeartRateZoneTime, db
+from app.routes import (apply_activity_filters, apply_keyset_pagination, build_search_query, decode_page_cursor,
+                        encode_page_cursor, get_activity_filter_bounds, query_activity_charts,
+                        query_activity_page, query_filtered_activity_totals)
 from app.database import Database
+from app.timing import clear_timings, record_queries, timed
+from flask import g
+from sqlalchemy.exc import OperationalError
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import Select
+from datetime import datetime
+import csv
+import io
+import json
+import pandas as pd
+import pytest
+import sqlite3
+import threading
 import time
 import subprocess
+import sys
 from bs4 import BeautifulSoup
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -925,6 +942,911 @@ def test_individual_activities(client):
         # Check that the activity page is displayed successfully
         assert activity.status_code == 200
 
+def test_activity_route(client, sample_activities):
+    """
+    This function checks that the route map endpoint returns the cached encoded polyline, null for an activity without
+    GPS data, and a 404 for an activity that does not exist.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    route = client.get('/api/activity/1001/route')
+    assert route.status_code == 200
+    assert route.get_json()['polyline'] == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+
+    route = client.get('/api/activity/2002/route')
+    assert route.status_code == 200
+    assert route.get_json()['polyline'] is None
+
+    assert client.get('/api/activity/3003/route').status_code == 404
+
+def test_mean_max_curves(client, sample_activities):
+    """
+    This function checks that the mean maximal curve endpoint returns the best value of each duration for all time and
+    for each season.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    curves = client.get('/api/mean-max-curves?channel=power&activity_type=Ride').get_json()
+    durations = curves['durations']
+
+    assert curves['all_time'][durations.index(5)] == 600
+    assert curves['all_time'][durations.index(60)] == 380
+    assert curves['all_time'][durations.index(3600)] == 220
+    assert curves['all_time'][durations.index(1)] is None
+    assert curves['seasons']['2024'][durations.index(60)] == 350
+    assert curves['seasons']['2023'][durations.index(5)] == 550
+
+    assert client.get('/api/mean-max-curves?channel=power&activity_type=Run').get_json()['seasons'] == {}
+    assert client.get('/api/mean-max-curves?channel=speed').status_code == 400
+
+def test_personal_records(client, sample_activities):
+    """
+    This function checks that the personal records page only lists an effort when it is faster than every effort
+    before it, and shows the pace of runs and the speed of rides.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    rides = client.get('/personal-records?sport=Ride').get_data(as_text=True)
+    assert '10:00' in rides and '09:10' in rides  # Both 5 km efforts were personal records.
+    assert '21:40' in rides and '23:20' not in rides  # The slower 10 km effort was not.
+    assert '20.3 MPH' in rides
+
+    runs = client.get('/personal-records?sport=Run').get_data(as_text=True)
+    assert '08:00' in runs and '08:00 /mi' in runs
+
+    assert 'Personal records are not calculated for Swim' in client.get(
+        '/personal-records?sport=Swim'
+    ).get_data(as_text=True)
+
+def test_heart_rate_zone_times(client, sample_activities, monkeypatch):
+    """
+    This function checks that the time in each heart rate zone is recalculated when the zones change, and that it is
+    summed over the activities that match the filters on the activities page.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :param monkeypatch: The Pytest monkeypatch fixture, used to restore the user settings after the test.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'USER_AGE', Config.USER_AGE)
+    monkeypatch.setattr(Config, 'HEART_RATE_ZONE_BOUNDARIES', None)
+
+    # Max HR 187, zones start at 93, 112, 130, 149, and 168 BPM.
+    zones = client.post('/hr-zones', data={'age': 30, 'activity-options': 'general'}).get_data(as_text=True)
+    assert '<td id="zone1-time">10:00</td>' in zones
+    assert '<td id="zone2-time">20:00</td>' in zones
+    assert '<td id="zone4-time">05:00</td>' in zones
+    assert '<td id="zone5-time">01:00</td>' in zones
+
+    # Max HR 143, zones start at 71, 85, 100, 114, and 128 BPM.
+    zones = client.post('/hr-zones', data={'age': 80, 'activity-options': 'cycling'}).get_data(as_text=True)
+    assert '<td id="zone3-time">10:00</td>' in zones
+    assert '<td id="zone4-time">20:00</td>' in zones
+    assert '<td id="zone5-time">06:00</td>' in zones
+
+    client.post('/activities', data={'start-date': '2024-01-01', 'end-date': '2024-12-31'})
+    zones = client.get('/hr-zones').get_data(as_text=True)
+    assert '<td id="zone4-time">00:00</td>' in zones
+    assert '<td id="zone5-time">06:00</td>' in zones
+
+def test_activity_filter_bounds(client, sample_activities):
+    """
+    This function checks that the filter ranges and dropdown options of the activities page are read with aggregate
+    queries, and that they are cached until the cache is cleared by an import.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        bounds = get_activity_filter_bounds()
+        assert bounds['ranges']['more-than-distance'] == 3.1
+        assert bounds['ranges']['less-than-distance'] == 40
+        assert bounds['ranges']['less-than-max-speed'] == 35.2
+        assert sorted(bounds['activity_types']) == ['Ride', 'Run']
+
+        # Empty dates are filled from the cached first and last start times, without another query.
+        activity_filters = {'start-date': '', 'end-date': ''}
+        with assert_max_queries(0):
+            apply_activity_filters(Activity.query, activity_filters)
+        assert activity_filters == {'start-date': '2023-07-01', 'end-date': '2024-05-05'}
+
+        Activity.query.filter(Activity.strava_activity_id == 1002).update({'distance': 100})
+        Activity.query.filter(Activity.strava_activity_id == 1002).update(
+            {'start_time_utc': Activity.start_time_utc - 365 * 86400})
+        db.session.commit()
+        assert get_activity_filter_bounds()['ranges']['less-than-distance'] == 40
+
+        clear_cache()
+        assert get_activity_filter_bounds()['ranges']['less-than-distance'] == 100
+        activity_filters = {'start-date': '', 'end-date': ''}
+        apply_activity_filters(Activity.query, activity_filters)
+        assert activity_filters == {'start-date': '2022-07-01', 'end-date': '2024-05-05'}
+
+
+def test_activity_filters_without_activities(client):
+    """
+    This function checks that the activities page can be filtered with empty dates before any activities are imported.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :return: None.
+    """
+    response = client.post('/activities', data={'start-date': '', 'end-date': '', 'type-options': 'Ride'})
+    assert response.status_code == 200
+    assert client.get('/api/activities/charts').status_code == 200
+
+    with client.application.app_context():
+        activity_filters = {'start-date': '', 'end-date': '2024-12-31'}
+        assert apply_activity_filters(Activity.query, activity_filters).count() == 0
+        assert activity_filters == {'start-date': '', 'end-date': '2024-12-31'}
+
+
+def test_activity_duration_sort_and_filter(client, sample_activities):
+    """
+    This function checks that activities are sorted and filtered by their duration in seconds, so a 30 minute activity
+    is shorter than a 2 hour activity even though '30:00' sorts after '2:00:00' as a string.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        bounds = get_activity_filter_bounds()['ranges']
+        assert [bounds['more-than-hours'], bounds['more-than-minutes'], bounds['more-than-seconds']] == [0, 30, 0]
+        assert [bounds['less-than-hours'], bounds['less-than-minutes'], bounds['less-than-seconds']] == [2, 0, 0]
+
+        filters = {'more-than-hours': '1', 'less-than-hours': '1', 'less-than-minutes': '30'}
+        activities = apply_activity_filters(Activity.query, filters).all()
+        assert [activity.strava_activity_id for activity in activities] == [1001]
+
+    response = client.get('/activities?sort=activity_duration&order=asc')
+    page = response.get_data(as_text=True)
+    assert page.index('Evening Run') < page.index('Morning Ride') < page.index('Last Year Ride')
+    assert '<td>1:00:00</td>' in page
+
+
+def test_keyset_pagination(client, sample_activities):
+    """
+    This function checks that walking forwards and backwards through the pages with cursors returns every activity once,
+    in the same order as sorting the whole table, including activities without a value in the sort column.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        Activity.query.filter(Activity.strava_activity_id == 1002).update({'duration_seconds': None})
+        db.session.commit()
+
+        for sort_column in [Activity.start_time_utc, Activity.duration_seconds, Activity.activity_type]:
+            for descending in [False, True]:
+                expected = [
+                    activity.id for activity in apply_keyset_pagination(Activity.query, sort_column, descending).all()
+                ]
+
+                pages = []
+                cursor = None
+                while True:
+                    page = apply_keyset_pagination(Activity.query, sort_column, descending, cursor).limit(1).all()
+                    if not page:
+                        break
+                    pages.append(page[0].id)
+                    cursor = decode_page_cursor(
+                        encode_page_cursor(getattr(page[-1], sort_column.key), page[-1].id), sort_column
+                    )
+                assert pages == expected
+
+                previous_page = apply_keyset_pagination(
+                    Activity.query, sort_column, descending, cursor, before=True
+                ).limit(2).all()
+                assert [activity.id for activity in reversed(previous_page)] == expected[-3:-1]
+
+        assert decode_page_cursor('not a cursor', Activity.start_time) is None
+
+    first_page = client.get('/activities?per_page=2&sort=distance&order=asc').get_data(as_text=True)
+    assert 'Evening Run' in first_page and 'Last Year Ride' not in first_page
+    next_link = first_page.split('<a href="')[-1].split('">>></a>')[0].replace('&amp;', '&')
+    second_page = client.get(next_link).get_data(as_text=True)
+    assert 'Last Year Ride' in second_page and 'Evening Run' not in second_page
+    assert '3 - 3 of 3' in second_page
+
+    filtered_page = client.post('/activities?per_page=1', data={'type-options': 'Ride'}).get_data(as_text=True)
+    next_link = filtered_page.split('<a href="')[-1].split('">>></a>')[0].replace('&amp;', '&')
+    assert '2 - 2 of 2' in client.get(next_link).get_data(as_text=True)
+
+
+def test_activity_search(client, sample_activities):
+    """
+    This function checks that the search box matches the start of words in the activity names and descriptions with
+    the full text index, that the index follows changes to the activities, and that search results are sorted by how
+    well they match.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    assert build_search_query('mor  rid!') == '"mor"* "rid"*'
+    assert build_search_query('"*') is None
+
+    with client.application.app_context():
+        def search(text):
+            return sorted(
+                activity.strava_activity_id or activity.garmin_activity_id
+                for activity in apply_activity_filters(Activity.query, {'activity-search': text}).all()
+            )
+
+        assert search('ride') == [1001, 1002]
+        assert search('hil') == [1001]
+        assert search('mor rid') == [1001]
+        assert search('swim') == []
+
+        Activity.query.filter(Activity.strava_activity_id == 1002).update({'activity_description': 'Swim after'})
+        db.session.commit()
+        assert search('swim') == [1002]
+        assert search('flat') == []
+
+    # The run has "run" in its name and description, so it is the best match.
+    page = client.post('/activities', data={'activity-search': 'run'}).get_data(as_text=True)
+    assert 'Evening Run' in page and 'Morning Ride' not in page
+
+    page = client.post('/activities', data={'activity-search': 'ride up'}).get_data(as_text=True)
+    assert 'Morning Ride' in page and 'Last Year Ride' not in page
+
+def test_activity_charts(client, sample_activities):
+    """
+    This function checks that the summary charts of the activities page are calculated from the filtered activities,
+    and are cached for each set of filters until the cache is cleared by an import.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    page = client.get('/activities').get_data(as_text=True)
+    assert 'plotly.js' not in page.lower()
+
+    charts = client.get('/api/activities/charts').get_json()
+    assert set(charts) == {
+        'moving-time-plot', 'distance-plot', 'avg-speed-plot', 'max-speed-plot', 'elevation-gain-plot',
+        'activity-type-plot'
+    }
+    activity_types = charts['activity-type-plot']['data'][0]
+    assert dict(zip(activity_types['labels'], activity_types['values'])) == {'Ride': 2, 'Run': 1}
+    distance = charts['distance-plot']['data'][0]
+    assert dict(zip(distance['x'], distance['y'])) == {'2023-07': 40, '2024-05': 23.6}
+
+    client.post('/activities', data={'type-options': 'Run'})
+    charts = client.get('/api/activities/charts').get_json()
+    assert charts['activity-type-plot']['data'][0]['labels'] == ['Run']
+
+    with client.application.app_context():
+        Activity.query.filter(Activity.garmin_activity_id == 2002).update({'activity_type': 'Walk'})
+        db.session.commit()
+        assert client.get('/api/activities/charts').get_json() == charts
+
+        clear_cache()
+        assert client.get('/api/activities/charts').get_json()['activity-type-plot']['data'][0]['labels'] == []
+
+        # The moving time chart uses the moving time, and the elapsed time of the activities without one.
+        Activity.query.filter(Activity.garmin_activity_id == 2002).update({'moving_time_seconds': 1500})
+        Activity.query.filter(Activity.strava_activity_id == 1002).update({'moving_time_seconds': None})
+        db.session.commit()
+        moving_time = json.loads(query_activity_charts(Activity.query))['moving-time-plot']['data'][0]
+        assert dict(zip(moving_time['x'], moving_time['y'])) == {'2023-07': 2, '2024-05': (3600 + 1500) / 3600}
+
+
+def test_cache_eviction(monkeypatch):
+    """
+    This function checks that the app level cache keeps only the most recently used values, so the totals and charts
+    cached for every set of filters do not grow without limit.
+    :param monkeypatch: Lowers Config.CACHE_MAX_ENTRIES for the test.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'CACHE_MAX_ENTRIES', 2)
+    calculations = []
+
+    def calculate(key):
+        calculations.append(key)
+        return key.upper()
+
+    clear_cache()
+    try:
+        assert cached('a', lambda: calculate('a')) == 'A'
+        assert cached('b', lambda: calculate('b')) == 'B'
+        assert cached('a', lambda: calculate('a')) == 'A'  # 'a' is now the most recently used value.
+        assert cached('c', lambda: calculate('c')) == 'C'  # Removes 'b'.
+        assert cached('a', lambda: calculate('a')) == 'A'
+        assert cached('b', lambda: calculate('b')) == 'B'
+        assert calculations == ['a', 'b', 'c', 'b']
+    finally:
+        clear_cache()
+
+
+def test_activity_totals(client, sample_activities):
+    """
+    This function checks that the weekly, monthly, yearly, and all time totals are read from the activity_total table,
+    and that new activities are added to the totals without rebuilding them.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    totals = client.get('/api/activity-totals?group_by=activity_type').get_json()['totals']
+    assert totals == [
+        {'activity_type': 'Ride', 'count': 2, 'distance': 60.5, 'moving_seconds': 10800, 'elevation_gain': 1400,
+         'max_speed': 35.2},
+        {'activity_type': 'Run', 'count': 1, 'distance': 3.1, 'moving_seconds': 1800, 'elevation_gain': 50,
+         'max_speed': 9.0},
+    ]
+
+    # The Saturday ride and the Sunday run are in the week that starts on Monday 2024-04-29.
+    weeks = client.get('/api/activity-totals?period=week').get_json()['totals']
+    assert [(week['period_start'], week['count']) for week in weeks] == [('2023-06-26', 1), ('2024-04-29', 2)]
+
+    years = client.get('/api/activity-totals?period=year&activity_gear=Road Bike').get_json()['totals']
+    assert [(year['period_start'], year['distance']) for year in years] == [('2023-01-01', 40), ('2024-01-01', 20.5)]
+
+    assert client.get('/api/activity-totals?period=decade').status_code == 400
+    assert client.get('/api/activity-totals?group_by=activity_name').status_code == 400
+
+    with client.application.app_context():
+        new_activity = Activity(
+            strava_activity_id=1003,
+            activity_name='Fast Ride',
+            start_time=datetime(2024, 5, 6, 7, 0, 0),
+            start_time_utc=1715004000,
+            activity_duration='30:00',
+            duration_seconds=1800,
+            distance=15,
+            average_speed=30,
+            max_speed=45,
+            elevation_gain=100,
+            highest_elevation=200,
+            activity_type='Ride',
+            activity_gear='Road Bike',
+        )
+        db.session.add(new_activity)
+        db.session.commit()
+        Database().add_activities_to_totals([new_activity])
+
+        added = client.get('/api/activity-totals?period=month&activity_type=Ride').get_json()['totals']
+        assert added[-1] == {'period_start': '2024-05-01', 'count': 2, 'distance': 35.5, 'moving_seconds': 5400,
+                             'elevation_gain': 1300, 'max_speed': 45}
+
+        Database().rebuild_activity_totals()
+        assert client.get('/api/activity-totals?period=month&activity_type=Ride').get_json()['totals'] == added
+
+        db.session.delete(new_activity)
+        db.session.commit()
+        Database().rebuild_activity_totals()
+
+    page = client.get('/totals').get_data(as_text=True)
+    assert 'Road Bike' in page and 'No Gear Listed' in page and '3:00:00' in page
+
+
+def test_filtered_activity_totals(client, sample_activities):
+    """
+    This function checks the totals row of the activities page, and that the average speed is weighted by moving time
+    while the Activity Duration column totals the elapsed time.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        totals = query_filtered_activity_totals(Activity.query)
+        assert totals['count'] == 3
+        assert totals['distance'] == pytest.approx(63.6)
+        assert totals['moving_seconds'] == 12600
+        assert totals['elevation_gain'] == 1450
+        assert totals['average_speed'] == pytest.approx(63.6 / 12600 * 3600)
+        assert totals['max_speed'] == 35.2
+
+        totals = query_filtered_activity_totals(apply_activity_filters(Activity.query, {'type-options': 'Ride'}))
+        assert totals['count'] == 2
+        assert totals['average_speed'] == pytest.approx(60.5 / 3)
+
+        # The moving time is used for the speed, and the elapsed time for the activities without a moving time.
+        Activity.query.filter(Activity.garmin_activity_id == 2002).update({'moving_time_seconds': 1500})
+        Activity.query.filter(Activity.strava_activity_id == 1002).update({'moving_time_seconds': None})
+        db.session.commit()
+        totals = query_filtered_activity_totals(Activity.query)
+        assert totals['duration_seconds'] == 12600
+        assert totals['moving_seconds'] == 12300
+        assert totals['average_speed'] == pytest.approx(63.6 / 12300 * 3600)
+
+        Database().rebuild_activity_totals()
+        clear_cache()
+        totals = client.get('/api/activity-totals?group_by=activity_type').get_json()['totals']
+        assert [total['moving_seconds'] for total in totals] == [10800, 1500]
+        clear_cache()
+
+    page = client.post('/activities', data={'type-options': 'Run'}).get_data(as_text=True)
+    assert 'Totals (1 Activities)' in page
+    assert '<th>30:00</th>' in page
+    assert '<th>7.44</th>' in page
+
+
+def test_export_activities(client, sample_activities):
+    """
+    This function checks that the export streams the filtered activities as CSV and newline delimited JSON, newest
+    first, and that an unknown format is rejected.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    response = client.get('/api/activities/export?format=csv')
+    assert response.is_streamed
+    assert response.mimetype == 'text/csv'
+    assert 'attachment; filename=activities.csv' == response.headers['Content-Disposition']
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [row['activity_name'] for row in rows] == ['Evening Run', 'Morning Ride', 'Last Year Ride']
+    assert rows[1]['duration_seconds'] == '3600'
+
+    client.post('/activities', data={'type-options': 'Ride'})
+    response = client.get('/api/activities/export')
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['strava_activity_id'] for row in rows] == [1001, 1002]
+    assert rows[0]['local_start_time'] == '2024-05-04 08:00:00'
+    assert rows[0]['start_time_utc'] == 1714834800
+
+    assert client.get('/api/activities/export?format=xlsx').status_code == 400
+
+
+def test_activity_page_rows(client, sample_activities):
+    """
+    This function checks that a page of the activities table is read as plain rows with only the listed columns, so no
+    Activity instances are loaded into the session.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    with client.application.app_context():
+        db.session.expunge_all()
+        query = apply_keyset_pagination(Activity.query, Activity.distance, True)
+        rows = query_activity_page(query, Activity.distance, 2)
+
+        assert [row.activity_name for row in rows] == ['Last Year Ride', 'Morning Ride']
+        assert [row.sort_value for row in rows] == [40, 20.5]
+        assert not hasattr(rows[0], 'activity_description')
+        assert len(db.session.identity_map) == 0
+
+    assert client.get('/activities?per_page=5000').status_code == 200
+
+
+def test_user_timezone_change(client, sample_activities, monkeypatch):
+    """
+    This function checks that the start times are shown, filtered and totalled in the timezone chosen on the settings
+    page as soon as it changes, without importing the activities again.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :param monkeypatch: Restores Config.USER_TIMEZONE after the test.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'USER_TIMEZONE', 'America/Los_Angeles')
+    assert '2024-05-05 18:30:00' in client.get('/activities').get_data(as_text=True)
+
+    client.post('/settings', data={'timezone-options': 'Europe/London'})
+    assert Config.USER_TIMEZONE == 'Europe/London'
+
+    page = client.get('/activities').get_data(as_text=True)
+    assert '2024-05-06 02:30:00' in page and '2024-05-04 16:00:00' in page
+
+    client.post('/activities', data={'start-date': '2024-05-06', 'end-date': '2024-05-06'})
+    response = client.get('/api/activities/export')
+    assert [json.loads(line)['activity_name'] for line in response.get_data(as_text=True).splitlines()] == [
+        'Evening Run'
+    ]
+
+    weeks = client.get('/api/activity-totals?period=week&activity_type=Run').get_json()['totals']
+    assert [week['period_start'] for week in weeks] == ['2024-05-06']
+
+    client.post('/settings', data={'timezone-options': 'Not/A_Timezone'})
+    assert Config.USER_TIMEZONE == 'Europe/London'
+
+
+def test_import_command(client, sample_activities, monkeypatch):
+    """
+    This function checks that the flask strava import command passes its options to the import pipeline and prints the
+    time of every stage, and that an incremental import skips the activities that are already in the database.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :param monkeypatch: Replaces the import pipeline and restores Config.STREAM_PROCESS_WORKERS after the test.
+    :return: None.
+    """
+    with client.application.app_context():
+        merged_activities = pd.DataFrame({
+            'strava_activity_id': pd.array([1001, None, 1003], dtype='Int64'),
+            'garmin_activity_id': pd.array([None, 2002, 2003], dtype='Int64'),
+        })
+        new_activities = Database.filter_new_activities(merged_activities)
+        assert new_activities['strava_activity_id'].tolist() == [1003]
+
+    import_options = {}
+
+    def convert_activity_csv_to_db(progress=None, **options):
+        import_options.update(options)
+        with timed('merge'):
+            progress(3, 3)
+        return 3
+
+    monkeypatch.setattr(Config, 'STREAM_PROCESS_WORKERS', None)
+    monkeypatch.setattr('app.cli.convert_activity_csv_to_db', convert_activity_csv_to_db)
+    runner = client.application.test_cli_runner()
+
+    result = runner.invoke(args=['strava', 'import', '--workers', '2', '--incremental', '--only', 'garmin'])
+    assert result.exit_code == 0
+    assert import_options == {'only': 'garmin', 'incremental': True, 'warm_file_cache': False}
+    assert Config.STREAM_PROCESS_WORKERS == 2
+    assert '3 activities imported' in result.output
+    assert 'merge' in result.output
+
+    result = runner.invoke(args=['strava', 'import', '--only', 'fitbit'])
+    assert result.exit_code == 2
+
+    # Loading the app for the flask strava commands keeps the imported activities.
+    environment = {name: value for name, value in os.environ.items() if name != 'RESET_DATABASE_ON_START'}
+    result = subprocess.run(
+        [sys.executable, '-m', 'flask', '--app', 'run', 'strava', '--help'], env=environment, capture_output=True
+    )
+    assert result.returncode == 0
+    with client.application.app_context():
+        assert Activity.query.count() == 3
+
+
+def test_import_new_activity_files(client, sample_activities, tmp_path, monkeypatch):
+    """
+    This function checks that a new activity file is imported without the Strava export, with its summary read from
+    the file, and that a copy of the file is not imported as a second activity.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :param tmp_path: The Pytest temporary folder, used as the Strava upload folder.
+    :param monkeypatch: Restores the Strava upload folder after the test.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'UPLOAD_FOLDER_STRAVA', str(tmp_path))
+    monkeypatch.setattr(Config, 'STREAM_PROCESS_WORKERS', 1)
+
+    def rebuild_zone_times(self, commit=True):
+        raise AssertionError('The zone times of every activity were rebuilt.')
+
+    monkeypatch.setattr(Database, 'update_heart_rate_zone_times', rebuild_zone_times)
+    (tmp_path / 'activities').mkdir()
+    file_paths = []
+    for filename in ['new_ride.gpx', 'new_ride_copy.gpx']:
+        shutil.copy('test_dir/real_activity_file/Strava/activities/10006900995.gpx', tmp_path / 'activities' / filename)
+        file_paths.append(os.path.join(str(tmp_path), 'activities', filename))
+
+    with client.application.app_context():
+        zone_time_count = HeartRateZoneTime.query.count()
+        try:
+            activities = Database().import_activity_files(file_paths)
+            assert len(activities) == 1
+            assert HeartRateZoneTime.query.count() == zone_time_count
+
+            new_activities = Activity.query.filter(Activity.start_time_utc == 1696866792).all()
+            assert len(new_activities) == 1
+            assert new_activities[0].strava_filename == 'activities/new_ride.gpx'
+            assert new_activities[0].activity_name == 'Morning Ride'
+            assert new_activities[0].route_polyline
+            assert 2 < new_activities[0].distance < 3
+
+            totals = client.get('/api/activity-totals?period=year&activity_type=cycling').get_json()['totals']
+            assert [total['count'] for total in totals] == [1]
+
+            # Files that are already imported, and the copy of an imported file, are skipped.
+            assert Database().import_activity_files(file_paths) == []
+        finally:
+            Activity.query.filter(Activity.start_time_utc == 1696866792).delete()
+            db.session.commit()
+            Database().rebuild_activity_totals()
+            clear_cache()
+
+
+def test_import_activity_file_of_existing_activity(client, sample_activities, tmp_path, monkeypatch):
+    """
+    This function checks that a new activity file of an activity that is already imported adds its streams and zone
+    times to that activity, and flags the activity when the elevation gain of the file does not match the export.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :param tmp_path: The Pytest temporary folder, used as the Strava upload folder.
+    :param monkeypatch: Restores the Strava upload folder after the test.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'UPLOAD_FOLDER_STRAVA', str(tmp_path))
+    monkeypatch.setattr(Config, 'STREAM_PROCESS_WORKERS', 1)
+    (tmp_path / 'activities').mkdir()
+    shutil.copy('test_dir/real_activity_file/Strava/activities/10006900995.gpx', tmp_path / 'activities' / 'ride.gpx')
+
+    with client.application.app_context():
+        try:
+            activity = Activity(
+                garmin_activity_id=2003,
+                activity_name='Morning Ride',
+                start_time=datetime(2023, 10, 9, 11, 53, 12),
+                start_time_utc=1696866792,
+                activity_duration='10:00',
+                moving_time_seconds=600,
+                duration_seconds=600,
+                distance=2.5,
+                elevation_gain=5000,
+                activity_type='Ride',
+                garmin_filename='activity_2003.fit',
+            )
+            db.session.add(activity)
+            db.session.commit()
+
+            activities = Database().import_activity_files([str(tmp_path / 'activities' / 'ride.gpx')])
+            assert [imported.id for imported in activities] == [activity.id]
+
+            activity = db.session.get(Activity, activity.id)
+            assert activity.strava_filename == 'activities/ride.gpx'
+            assert activity.calculated_elevation_gain < 1000
+            assert activity.elevation_gain_mismatch
+
+            # The zone times of an activity are replaced by the zone times of its new heart rate histogram.
+            activity.heart_rate_histogram = [HeartRateHistogram(heart_rate=60, seconds=300)]
+            db.session.flush()
+            Database().add_heart_rate_zone_times([activity])
+            activity.heart_rate_histogram = [HeartRateHistogram(heart_rate=200, seconds=120)]
+            db.session.flush()
+            Database().add_heart_rate_zone_times([activity])
+            zone_times = HeartRateZoneTime.query.filter(HeartRateZoneTime.activity_id == activity.id).all()
+            assert [(zone_time.zone, zone_time.seconds) for zone_time in zone_times] == [(5, 120)]
+        finally:
+            db.session.rollback()
+            for activity in Activity.query.filter(Activity.garmin_activity_id == 2003).all():
+                db.session.delete(activity)
+            db.session.commit()
+            clear_cache()
+
+
+def test_merge_duplicate_activities(client, tmp_path, monkeypatch):
+    """
+    This function checks that two fit files with the same start time, and an activity uploaded to Strava twice, are
+    merged into one row for each activity id, so the activities can be added to the activity table.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param tmp_path: The Pytest temporary folder, used for the Garmin export and the CSV files.
+    :param monkeypatch: Restores the Strava activities CSV file after the test.
+    :return: None.
+    """
+    with open(tmp_path / 'activity_summarizedActivities.json', 'w') as f:
+        json.dump([{'summarizedActivitiesExport': [{
+            'activityId': 3001,
+            'startTimeLocal': 1714820400000,
+            'startTimeGmt': 1714834800000,
+            'name': 'Morning Ride',
+            'activityType': {'typeKey': 'cycling'},
+            'distance': 3218700,
+            'duration': 3600000,
+        }]}], f)
+
+    database = Database()
+    database.garmin_activities_csv_file_dir_path = str(tmp_path)
+    database.garmin_activities_json_file_path = str(tmp_path)
+    database.output_csv = str(tmp_path / 'merged_activities.csv')
+
+    fit_files = pd.DataFrame({
+        'filename': ['ride_1.fit', 'ride_2.fit'],
+        'sport': ['cycling', 'cycling'],
+        'start_time': [datetime(2024, 5, 4, 15, 0, 0)] * 2,
+        'distance_m': [32187.0, 32187.0],
+        'duration_s': [3600.0, 3600.0],
+    })
+    database.process_garmin_activity_file(fit_files)
+
+    # The same ride uploaded to Strava twice.
+    strava_csv = tmp_path / 'strava_activities.csv'
+    pd.DataFrame({
+        'strava_activity_id': [4001, 4002],
+        'start_time': ['2024-05-04 08:00:00'] * 2,
+        'start_time_utc': [1714834800] * 2,
+        'activity_name': ['Morning Ride'] * 2,
+        'activity_type': ['Ride'] * 2,
+        'activity_description': [None] * 2,
+        'activity_gear': ['Road Bike'] * 2,
+        'strava_filename': ['activities/4001.fit.gz', 'activities/4002.fit.gz'],
+        'activity_duration': ['1:00:00'] * 2,
+        'moving_time_seconds': [3600] * 2,
+        'distance': [20.0] * 2,
+        'average_speed': [20.0] * 2,
+        'max_speed': [30.0] * 2,
+        'elevation_gain': [500.0] * 2,
+        'highest_elevation': [800.0] * 2,
+    }).to_csv(strava_csv, index=False)
+    monkeypatch.setattr(database, 'strava_activities_csv_file', str(strava_csv))
+
+    merged = database.merge_csv_files()
+    assert merged['garmin_activity_id'].tolist() == [3001]
+    assert merged['strava_activity_id'].tolist() == [4001]
+    assert merged['garmin_filename'].tolist() == ['ride_1.fit']
+
+    with client.application.app_context():
+        try:
+            database.add_activities(merged, commit=False)
+            assert Activity.query.filter(Activity.garmin_activity_id == 3001).count() == 1
+        finally:
+            db.session.rollback()
+
+
+def test_import_readers_see_old_activities(client, sample_activities, tmp_path, monkeypatch):
+    """
+    This function checks that a page reading the database while the activities are imported sees all the old
+    activities until the new ones are committed, without waiting for the import.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :param tmp_path: The Pytest temporary folder, for the database name create_db_tables() connects to.
+    :param monkeypatch: Runs the reader in the middle of the import.
+    :return: None.
+    """
+    activity_counts = []
+
+    def read_activity_count(self, commit=True):
+        # A separate connection, like another request, that fails at once if the database is locked.
+        connection = sqlite3.connect(Config.DATABASE_PATH, timeout=0)
+        activity_counts.append(connection.execute('SELECT count(*) FROM activity').fetchone()[0])
+        connection.close()
+
+    monkeypatch.setattr(Database, 'update_heart_rate_zone_times', read_activity_count)
+
+    with client.application.app_context():
+        Database().create_db_tables(str(tmp_path / Config.DATABASE_NAME), Config.ACTIVITY_TABLE_NAME, pd.DataFrame())
+
+        assert activity_counts == [3]
+        assert Activity.query.count() == 0
+
+
+def test_server_timing(client, sample_activities):
+    """
+    This function checks that the time of each stage of a request is sent in the Server-Timing header and that the
+    percentiles of every route and stage are shown on the /debug/perf page.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :return: None.
+    """
+    clear_timings()
+    response = client.get('/activities')
+    stages = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+    for stage in ['filters', 'count', 'page-query', 'bounds', 'render', 'db', 'total', 'queries']:
+        assert stage in stages
+
+    assert 'charts;dur=' in client.get('/api/activities/charts').headers['Server-Timing']
+    assert 'Server-Timing' not in client.get('/not-a-page').headers
+
+    with client.application.test_request_context():
+        with timed('parse'):
+            pass
+        with timed('parse'):
+            pass
+        assert list(g.stage_timings) == ['parse']
+
+    page = client.get('/debug/perf').get_data(as_text=True)
+    assert '<td>/activities</td>' in page and '<td>page-query</td>' in page
+    assert '<td>/not-a-page</td>' not in page
+
+
+def test_query_counts(client, sample_activities, monkeypatch, capsys, tmp_path):
+    """
+    This function checks the number of SQL statements of the activities pages, so a change that adds a query per row or
+    a query that is not needed is caught, and that slow statements are printed with their parameters.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :param monkeypatch: Restores Config.SLOW_QUERY_MS and Config.UPLOAD_FOLDER_STRAVA after the test.
+    :param capsys: Captures the printed slow statements.
+    :param tmp_path: The Pytest temporary folder, used as the Strava upload folder.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'UPLOAD_FOLDER_STRAVA', str(tmp_path))
+    (tmp_path / 'activities').mkdir()
+    shutil.copy('test_dir/real_activity_file/Strava/activities/10006900995.gpx', tmp_path / 'activities' / '1001.gpx')
+    with client.application.app_context():
+        Activity.query.filter(Activity.strava_activity_id == 1001).update({'strava_filename': 'activities/1001.gpx'})
+        db.session.commit()
+
+    # The first page reads the totals and filter bounds, which are cached for the next pages.
+    with assert_max_queries(6):
+        response = client.get('/activities')
+    assert 'queries;desc="' in response.headers['Server-Timing']
+
+    with assert_max_queries(2):
+        client.get('/activities?per_page=2&sort=distance&order=asc')
+
+    with assert_max_queries(2):
+        client.get('/api/activities/charts')
+
+    # The activity, its mean maximal curves, the season and all time bests, and its time in zone.
+    with assert_max_queries(5):
+        page = client.get('/activity/1001').get_data(as_text=True)
+    assert 'id="error-msg"' not in page
+    assert '<p id="description">Up the hill and back</p>' in page
+
+    with assert_max_queries(6):
+        client.post('/activities', data={'type-options': 'Ride', 'activity-search': 'ride'})
+
+    monkeypatch.setattr(Config, 'SLOW_QUERY_MS', 0)
+    capsys.readouterr()
+    client.get('/activity/1001')
+    assert 'parameters: (1001, 1001, 1, 0)' in capsys.readouterr().out
+
+    # A failed statement does not leave its start time on the connection.
+    with client.application.app_context():
+        connection = db.session.connection()
+        with pytest.raises(OperationalError):
+            connection.exec_driver_sql('SELECT * FROM missing_table')
+        assert not connection.info.get('query_start')
+        db.session.rollback()
+
+    # The statements of another thread are not recorded.
+    other_thread_recording = threading.Event()
+    main_thread_done = threading.Event()
+    other_thread_statements = []
+
+    def record_other_thread():
+        with record_queries() as statements:
+            other_thread_recording.set()
+            main_thread_done.wait(5)
+        other_thread_statements.extend(statements)
+
+    thread = threading.Thread(target=record_other_thread)
+    thread.start()
+    other_thread_recording.wait(5)
+    with record_queries() as statements:
+        client.get('/activities')
+    main_thread_done.set()
+    thread.join()
+    assert statements
+    assert other_thread_statements == []
+
+
+def test_request_profile(client, sample_activities, tmp_path, monkeypatch):
+    """
+    This function checks that adding ?_profile=1 to any page saves a collapsed stack profile and a table of the top
+    functions, and that the profiles are listed on the /debug/perf page.
+    :param client: The Pytest test_client defined in webapp/__init__.py.
+    :param sample_activities: The activities added to the database, defined in webapp/__init__.py.
+    :param tmp_path: The temporary profile folder.
+    :param monkeypatch: Restores the profile settings after the test.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'PROFILE_FOLDER', str(tmp_path))
+    monkeypatch.setattr(Config, 'PROFILE_INTERVAL', 0.0001)
+
+    # The page query is slowed down so the sampler always sees the route, however fast the rest of the page is.
+    def slow_query_activity_page(*args, **kwargs):
+        time.sleep(0.05)
+        return query_activity_page(*args, **kwargs)
+
+    monkeypatch.setattr('app.routes.query_activity_page', slow_query_activity_page)
+
+    assert 'X-Profile' not in client.get('/activities').headers
+
+    response = client.get('/activities?_profile=1')
+    assert response.status_code == 200
+    profile = response.headers['X-Profile']
+    assert profile.endswith('-activity.folded')
+
+    stacks = (tmp_path / profile).read_text().splitlines()
+    assert stacks and all(line.rsplit(' ', 1)[1].isdigit() for line in stacks)
+    assert any('activity (routes.py' in line for line in stacks)
+    assert 'total %' in (tmp_path / profile.replace('.folded', '.txt')).read_text()
+
+    page = client.get('/debug/perf').get_data(as_text=True)
+    assert profile in page
+    assert client.get(f'/debug/profiles/{profile}').get_data(as_text=True) == (tmp_path / profile).read_text()
+
+    response = client.get('/activities?_profile=1', environ_base={'REMOTE_ADDR': '192.168.1.20'})
+    assert 'X-Profile' not in response.headers
+    assert client.get('/debug/perf', environ_base={'REMOTE_ADDR': '192.168.1.20'}).status_code == 404
+    assert client.get(
+        f'/debug/profiles/{profile}', environ_base={'REMOTE_ADDR': '192.168.1.20'}
+    ).status_code == 404
+
+    # The profiler of a request that raises an exception is stopped and saved too.
+    def raise_error(*args, **kwargs):
+        raise RuntimeError('Query failed')
+
+    monkeypatch.setattr('app.routes.query_activity_page', raise_error)
+    thread_count = threading.active_count()
+    with pytest.raises(RuntimeError):
+        client.get('/activities?_profile=1')
+    assert threading.active_count() == thread_count
+    assert len(list(tmp_path.glob('*.folded'))) == 2
+
+
 def file_upload_testing(driver, file_path):
     """
     Remove the activities.csv file, if it exists, then copy the specified activities.csv file into the uploads
@@ -0,0 +1,207 @@
+from app.streams import (SAMPLE_CHANNELS, analyze_new_activity_file, best_efforts, build_sample_frame,
+                         clean_sample_frame, elevation_gain_and_loss, encode_polyline, heart_rate_histogram,
+                         mean_maximal_curve, read_gpx_file, reject_impossible_jumps, resample_to_seconds,
+                         simplify_track)
+import numpy as np
+import pandas as pd
+import time
+
+GPX_TEST_FILE = 'test_dir/real_activity_file/Strava/activities/10006900995.gpx'
+FIT_TEST_FILE = 'test_dir/real_activity_file/Strava/activities/14799848951.fit.gz'
+
+
+def test_sample_frame_alignment():
+    """
+    This function tests that the channels of a sample frame are aligned to the time axis, the time axis starts at zero,
+    and channels that were not recorded are NaN.
+    :return: None.
+    """
+    frame = build_sample_frame({
+        'time': [100, 101, 102],
+        'heart_rate': [120, None, 125],
+        'power': [],
+    })
+
+    assert list(frame.columns) == SAMPLE_CHANNELS
+    assert list(frame['time']) == [0, 1, 2]
+    assert np.isnan(frame['heart_rate'][1])
+    assert frame['power'].isna().all()
+
+
+def test_gpx_sample_frame():
+    """
+    This function tests that a real .gpx file is parsed into a numeric sample frame.
+    :return: None.
+    """
+    with open(GPX_TEST_FILE, 'r') as f:
+        frame = read_gpx_file(f)
+
+    assert len(frame) > 0
+    assert frame['time'].is_monotonic_increasing
+    assert frame['distance'].is_monotonic_increasing
+    assert frame['latitude'].notna().all()
+    assert frame['time'].dtype == np.float64
+
+
+def test_clean_sample_frame():
+    """
+    This function tests that a GPS spike and an altitude spike are removed from a real .gpx file, and that the distance
+    does not include the spike.
+    :return: None.
+    """
+    with open(GPX_TEST_FILE, 'r') as f:
+        frame = read_gpx_file(f)
+
+    distance = frame['distance'].iloc[-1]
+    frame.loc[100, ['latitude', 'longitude']] = [38.0, -121.0]
+    frame.loc[200, 'altitude'] = 400
+    frame.loc[101:, 'distance'] += 100000
+
+    cleaned = clean_sample_frame(frame, 'Ride')
+
+    assert cleaned[['latitude', 'longitude']].iloc[100].isna().all()
+    assert cleaned['altitude'][200] < 20
+    assert cleaned['distance'].iloc[-1] < distance + 1000
+    assert len(cleaned) == len(frame)
+
+
+def test_reject_distance_jump_after_missing_first_sample():
+    """
+    This function tests that a distance jump is removed when the first distance sample was not recorded, instead of
+    the whole distance channel becoming NaN.
+    :return: None.
+    """
+    frame = build_sample_frame({
+        'time': [0, 1, 2, 3, 4, 5],
+        'distance': [np.nan, 5, 10, 100000, 100005, 100010],
+    })
+
+    cleaned = reject_impossible_jumps(frame, max_speed=30, max_vertical_speed=10)
+
+    assert np.isnan(cleaned['distance'][0])
+    assert list(cleaned['distance'][1:]) == [5, 10, 10, 15, 20]
+
+
+def test_elevation_gain_and_loss():
+    """
+    This function tests that noise smaller than the threshold is not counted as elevation gain, and that a climb and
+    descent of 100 meters are counted.
+    :return: None.
+    """
+    noise = pd.Series([100, 101, 100, 101, 100, 101, 100] * 20)
+    assert elevation_gain_and_loss(noise, 3, 1) == (0, 0)
+
+    climb = pd.Series(np.concatenate((np.linspace(0, 100, 200), np.linspace(100, 0, 200))))
+    gain, loss = elevation_gain_and_loss(climb + np.resize([0, 1], 400), 3, 5)
+    assert abs(gain - 100) < 3
+    assert abs(loss - 100) < 3
+
+    assert elevation_gain_and_loss(pd.Series([np.nan, np.nan]), 3, 5) == (None, None)
+
+    # A steady climb from 0 to 99 meters with 1 meter dips, smaller than the threshold, counts the whole climb.
+    ramp = pd.Series(np.arange(98) + np.resize([0, 2], 98), dtype='float64')
+    assert elevation_gain_and_loss(ramp, 5, 1) == (99, 0)
+
+
+def test_simplify_and_encode_route():
+    """
+    This function tests that a track is simplified to the target number of points, keeps its start and end, and that
+    the polyline encoding matches the example in Google's documentation.
+    :return: None.
+    """
+    with open(GPX_TEST_FILE, 'r') as f:
+        frame = read_gpx_file(f)
+
+    latitude, longitude = simplify_track(frame['latitude'], frame['longitude'], 50)
+    assert len(latitude) <= 50
+    assert latitude[0] == frame['latitude'].iloc[0]
+    assert longitude[-1] == frame['longitude'].iloc[-1]
+
+    assert encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]) == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+
+
+def test_mean_maximal_curve():
+    """
+    This function tests that the prefix sum mean maximal curve matches a sliding window average, that windows with a
+    missing value are not used, and that recording gaps are only interpolated up to the max gap.
+    :return: None.
+    """
+    power = np.random.default_rng(0).uniform(0, 400, 1000)
+    power[500] = np.nan
+
+    curve = mean_maximal_curve(power, [1, 30, 600, 2000])
+    sliding_30 = pd.Series(power).rolling(30).mean().max()
+
+    assert abs(curve[0] - np.nanmax(power)) < 1e-9
+    assert abs(curve[1] - sliding_30) < 1e-9
+    assert curve[2] is None
+    assert curve[3] is None
+
+    resampled = resample_to_seconds([0, 2, 4, 30, 31], [100, 200, 300, 400, 500], 10)
+    assert list(resampled[:5]) == [100, 150, 200, 250, 300]
+    assert np.isnan(resampled[5:30]).all()
+    assert len(resampled) == 32
+
+
+def test_best_efforts():
+    """
+    This function tests that the two pointer sweep finds the fastest part of an activity, interpolates the start of the
+    effort between samples, and returns None for distances longer than the activity.
+    :return: None.
+    """
+    time = np.arange(0, 1000.0)
+    speed = np.where((time >= 300) & (time < 400), 6.0, 3.0)  # 100 seconds at 6 m/s in the middle.
+    distance = np.concatenate(([0], np.cumsum(speed[:-1])))
+
+    efforts = best_efforts(time, distance, [300, 600, 5000])
+
+    assert efforts[0] == (50, 300)
+    assert abs(efforts[1][0] - 100) < 1e-9
+    assert efforts[2] is None
+
+
+def test_heart_rate_histogram():
+    """
+    This function tests that each heart rate sample counts for the time until the next sample, and that paused
+    recordings and missing heart rates are not counted.
+    :return: None.
+    """
+    histogram = heart_rate_histogram([0, 1, 2, 3, 40, 41], [100, 100.4, 101, np.nan, 120, 121], 10)
+
+    assert histogram == {100: 2, 101: 1, 120: 1}
+    assert heart_rate_histogram([0, 1], [np.nan, np.nan], 10) == {}
+
+
+def test_new_activity_file_summary():
+    """
+    This function tests that the summary of an activity that is not in the Strava export is read from a real .gpx file,
+    with the start time, type and name recorded in the file.
+    :return: None.
+    """
+    result = analyze_new_activity_file((GPX_TEST_FILE, None))
+
+    assert result['start_time_utc'] == 1696866792  # 2023-10-09T15:53:12Z, the time of the first track point.
+    assert result['activity_type'] == 'cycling'
+    assert result['activity_name'] == 'Morning Ride'
+    assert result['duration_seconds'] == 598
+    assert 0 < result['moving_time_seconds'] <= result['duration_seconds']
+    assert 3000 < result['distance'] < 4500
+    assert result['streams']['route_polyline']
+
+
+def test_new_activity_file_start_time_in_utc(monkeypatch):
+    """
+    This function tests that the start time of a .fit file, which records naive UTC times, does not depend on the time
+    zone of the computer.
+    :param monkeypatch: Sets the TZ environment variable for the test.
+    :return: None.
+    """
+    monkeypatch.setenv('TZ', 'America/Los_Angeles')
+    time.tzset()
+    try:
+        result = analyze_new_activity_file((FIT_TEST_FILE, None))
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    assert result['start_time_utc'] == 1741811392  # The start time in the Strava activities.csv.
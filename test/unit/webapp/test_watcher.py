@@ -0,0 +1,130 @@
+from test.unit.webapp import client
+from app.watcher import InotifyWatcher, PollingWatcher, is_activity_file, watch_activity_folders
+from config import Config
+from zipfile import BadZipFile
+import logging
+import os
+import sys
+import threading
+import pytest
+
+
+def test_is_activity_file():
+    """
+    This function tests that only the files the importer reads are picked up in each watched folder.
+    :return: None.
+    """
+    folders = {'strava': ['*.fit.gz', '*.gpx'], 'garmin': ['UploadedFiles*.zip']}
+
+    assert is_activity_file(os.path.join('strava', '123.fit.gz'), folders)
+    assert is_activity_file(os.path.join('strava', '123.GPX'), folders)
+    assert not is_activity_file(os.path.join('strava', '123.fit.gz.part'), folders)
+    assert is_activity_file(os.path.join('garmin', 'UploadedFiles_0-_Part4.zip'), folders)
+    assert not is_activity_file(os.path.join('garmin', 'garmin_activities.csv'), folders)
+    assert not is_activity_file(os.path.join('other', '123.gpx'), folders)
+
+
+@pytest.mark.parametrize('watcher_class', [
+    PollingWatcher,
+    pytest.param(InotifyWatcher, marks=pytest.mark.skipif(sys.platform != 'linux', reason='inotify is Linux only')),
+])
+def test_folder_watcher(tmp_path, watcher_class):
+    """
+    This function tests that a watcher reports a new file once, and does not report the files that were there before it
+    started.
+    :param tmp_path: The Pytest temporary folder that is watched.
+    :param watcher_class: The watcher that is tested.
+    :return: None.
+    """
+    (tmp_path / 'old.gpx').write_text('old')
+    watcher = watcher_class([str(tmp_path)])
+    try:
+        (tmp_path / 'new.gpx').write_text('new')
+
+        assert watcher.poll(0.1) == {str(tmp_path / 'new.gpx')}
+        assert watcher.poll(0.1) == set()
+    finally:
+        watcher.close()
+
+
+def test_watch_activity_folders(tmp_path, monkeypatch):
+    """
+    This function tests that the files copied into the watched folders are imported in one batch once they stop
+    changing.
+    :param tmp_path: The Pytest temporary folder, used as the upload folders.
+    :param monkeypatch: Restores the upload folders and watch settings after the test.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'UPLOAD_FOLDER_STRAVA', str(tmp_path / 'Strava'))
+    monkeypatch.setattr(Config, 'GARMIN_ACTIVITY_CSV_FILE_DIR', str(tmp_path / 'Garmin'))
+    monkeypatch.setattr(Config, 'WATCH_POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(Config, 'WATCH_DEBOUNCE_SECONDS', 0.2)
+
+    batches = []
+    stop = threading.Event()
+
+    def import_files(file_paths):
+        batches.append(file_paths)
+        stop.set()
+
+    def copy_files():
+        stop.wait(0.2)
+        for filename in ['1.gpx', '2.fit.gz', 'notes.txt']:
+            (tmp_path / 'Strava' / 'activities' / filename).write_text('activity')
+
+    (tmp_path / 'Strava' / 'activities').mkdir(parents=True)
+    copy_thread = threading.Thread(target=copy_files)
+    copy_thread.start()
+    watch_activity_folders(import_files, polling=True, stop=stop)
+    copy_thread.join()
+
+    activity_folder = str(tmp_path / 'Strava' / 'activities')
+    assert batches == [[os.path.join(activity_folder, '1.gpx'), os.path.join(activity_folder, '2.fit.gz')]]
+
+
+def test_watch_activity_folders_after_failed_import(client, tmp_path, monkeypatch, caplog):
+    """
+    This function tests that a batch of files that fails to import is logged, and that the folders are still watched
+    and the next batch is imported.
+    :param client: The Pytest test_client defined in webapp/__init__.py, for the app context and logger.
+    :param tmp_path: The Pytest temporary folder, used as the upload folders.
+    :param monkeypatch: Restores the upload folders and watch settings after the test.
+    :param caplog: Captures the logged error.
+    :return: None.
+    """
+    monkeypatch.setattr(Config, 'UPLOAD_FOLDER_STRAVA', str(tmp_path / 'Strava'))
+    monkeypatch.setattr(Config, 'GARMIN_ACTIVITY_CSV_FILE_DIR', str(tmp_path / 'Garmin'))
+    monkeypatch.setattr(Config, 'WATCH_POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(Config, 'WATCH_DEBOUNCE_SECONDS', 0.2)
+
+    batches = []
+    first_batch_failed = threading.Event()
+    stop = threading.Event()
+
+    def import_files(file_paths):
+        batches.append(file_paths)
+        if len(batches) == 1:
+            first_batch_failed.set()
+            raise BadZipFile('File is not a zip file')
+        stop.set()
+
+    def copy_files():
+        stop.wait(0.2)
+        (tmp_path / 'Garmin' / 'UploadedFiles_0-_Part1.zip').write_text('not a zip file')
+        first_batch_failed.wait(5)
+        (tmp_path / 'Strava' / 'activities' / '1.gpx').write_text('activity')
+
+    (tmp_path / 'Strava' / 'activities').mkdir(parents=True)
+    (tmp_path / 'Garmin').mkdir()
+    copy_thread = threading.Thread(target=copy_files)
+    copy_thread.start()
+    with client.application.app_context(), caplog.at_level(logging.ERROR):
+        watch_activity_folders(import_files, polling=True, stop=stop)
+    copy_thread.join()
+
+    assert batches == [
+        [str(tmp_path / 'Garmin' / 'UploadedFiles_0-_Part1.zip')],
+        [str(tmp_path / 'Strava' / 'activities' / '1.gpx')],
+    ]
+    assert 'UploadedFiles_0-_Part1.zip could not be imported' in caplog.text
+    assert 'BadZipFile' in caplog.text